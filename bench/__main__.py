@@ -0,0 +1,3 @@
+from bench.run import cli
+from bench import load  # registers the load command
+cli()
@@ -0,0 +1,99 @@
+"""Synthetic packet log generator.
+
+Generates rows in the `client addfrom` format with a realistic shape: a
+skewed (Zipf-like) distribution of host addresses, a weighted protocol mix
+and protocol-dependent packet lengths. Output is fully determined by the
+seed.
+
+Write a million rows to a file with:
+
+    python -m bench.generate 1000000 > packets.txt
+
+"""
+import sys
+import bisect
+import random
+import itertools
+
+# (protocol, weight, (min length, max length))
+PROTOCOLS = (
+    ('TCP', 60, (54, 1514)),
+    ('UDP', 15, (42, 1024)),
+    ('DNS', 10, (60, 512)),
+    ('SSDP', 5, (160, 360)),
+    ('DB-LSP-DISC', 4, (180, 200)),
+    ('SNMP', 3, (80, 160)),
+    ('ICMP', 3, (42, 98)),
+)
+
+class PacketGenerator:
+    """Seeded generator of synthetic packet rows.
+
+    Parameters:
+
+    seed (optional)
+      seed for the random number generator
+
+    hosts (optional)
+      number of distinct host addresses
+
+    skew (optional)
+      Zipf exponent of host frequency; higher values concentrate more
+      traffic on the most popular hosts
+
+    """
+
+    def __init__(self, seed=0, hosts=1000, skew=1.1):
+        self.random = random.Random(seed)
+        self.hosts = [self.address() for _ in range(hosts)]
+        self.host_weights = list(itertools.accumulate(
+            1 / (rank + 1) ** skew for rank in range(hosts)))
+        self.protocol_weights = list(itertools.accumulate(
+            weight for _, weight, _ in PROTOCOLS))
+
+    def address(self):
+        """Return a random IPv4 address, mostly from private ranges."""
+        rand = self.random.randrange
+        kind = self.random.random()
+        if kind < 0.4:
+            return '10.{}.{}.{}'.format(rand(4), rand(256), rand(1, 255))
+        elif kind < 0.6:
+            return '192.168.{}.{}'.format(rand(4), rand(1, 255))
+        return '{}.{}.{}.{}'.format(rand(1, 224), rand(256), rand(256),
+                                    rand(1, 255))
+
+    def host(self):
+        """Return a host address drawn from the skewed distribution."""
+        point = self.random.random() * self.host_weights[-1]
+        return self.hosts[bisect.bisect(self.host_weights, point)]
+
+    def packet(self):
+        """Return one (source, destination, protocol, length) row."""
+        point = self.random.random() * self.protocol_weights[-1]
+        protocol, _, (low, high) = PROTOCOLS[
+            bisect.bisect(self.protocol_weights, point)]
+        # most TCP packets are bare acknowledgements
+        if protocol == 'TCP' and self.random.random() < 0.4:
+            length = self.random.choice((54, 60, 66))
+        else:
+            length = self.random.randint(low, high)
+        source = self.host()
+        destination = self.host()
+        while destination == source:
+            destination = self.host()
+        return source, destination, protocol, length
+
+    def packets(self, rows):
+        """Yield the given number of rows."""
+        for _ in range(rows):
+            yield self.packet()
+
+def write_packets(packets, wfile):
+    """Write rows in the `client addfrom` file format."""
+    for packet in packets:
+        wfile.write('\t'.join(str(field) for field in packet) + '\n')
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    write_packets(PacketGenerator(seed).packets(rows), sys.stdout)
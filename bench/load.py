@@ -0,0 +1,280 @@
+"""Concurrent load test.
+
+Starts a logdb server on localhost with a fresh database of synthetic rows
+and drives it over HTTP with concurrent client processes: ingesters adding
+packets at a fixed rate, and queriers issuing a weighted mix of lookup,
+count, average and correlate queries for hosts drawn with a Zipf-like skew.
+Throughput and p50/p95/p99 latency are reported per endpoint, overall and
+for each interval of the run.
+
+    python -m bench load --rows 10000 --ingesters 2 --ingest-rate 20 \\
+        --queriers 4 --mix lookup=4,count=3,average=2,correlate=1
+
+Ingesters are open-loop: each request's latency is measured from when it
+was due, so a server that falls behind is charged for the queueing too.
+Queriers are closed-loop, sending each query when the last returns.
+"""
+import os
+import sys
+import json
+import math
+import time
+import bisect
+import random
+import socket
+import shutil
+import itertools
+import subprocess
+import tempfile
+import multiprocessing
+
+import click
+
+from bench.generate import PacketGenerator
+from bench.run import Timer, cli, ingest, setup_django
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OPERATIONS = ('lookup', 'count', 'average', 'correlate')
+PERCENTILES = (50, 95, 99)
+
+# Seconds to wait for the server to accept connections.
+STARTUP_TIMEOUT = 30
+
+def parse_mix(value):
+    """Return [(operation, weight)] for a string like "lookup=4,count=1"."""
+    mix = []
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise click.UsageError('unknown operation {!r} in mix, expected '
+                                   'one of {}'.format(name,
+                                                      ', '.join(OPERATIONS)))
+        try:
+            weight = float(weight or 1)
+        except ValueError:
+            raise click.UsageError('invalid weight for {}'.format(name))
+        if weight > 0:
+            mix.append((name, weight))
+    if not mix:
+        raise click.UsageError('the query mix is empty')
+    return mix
+
+def percentile(ordered, p):
+    """Return the nearest-rank pth percentile of a sorted list."""
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def start_server(database, port):
+    """Start a logdb server on a database and wait until it is up."""
+    env = dict(os.environ, EDB_DATABASE=database,
+               DJANGO_SETTINGS_MODULE='settings')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'manage.py'), 'runserver',
+         str(port), '--noreload'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise click.ClickException('server exited with status {}'.format(
+                server.returncode))
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise click.ClickException('server did not start on port {}'.format(port))
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def run_worker(job):
+    """Run one client process and return its (endpoint, start, latency, ok)
+    samples, with start relative to the start of the run."""
+    from edb import crypto
+    from edb.errors import EDBError
+    from logdb.client import Client
+    kind, keys, port, seed, number, options, start_at, duration = job
+    client = Client(port=port, _keyinfo=crypto.postdeserialize_keyinfo(keys))
+    # the same hosts as the preloaded rows, drawn in a different order
+    generator = PacketGenerator(seed, options['hosts'], options['skew'])
+    generator.random.seed(seed * 1000 + number + 1)
+    rand = random.Random(seed * 1000 + number + 1)
+    if kind == 'query':
+        names = [name for name, _ in options['mix']]
+        weights = list(itertools.accumulate(w for _, w in options['mix']))
+    samples = []
+    time.sleep(max(0, start_at - time.time()))
+    end_at = start_at + duration
+    due = start_at
+    while True:
+        if kind == 'ingest':
+            # Poisson arrivals at the ingest rate
+            due += rand.expovariate(options['rate'])
+            if due >= end_at:
+                break
+            time.sleep(max(0, due - time.time()))
+            begin = due
+            source, destination, protocol, length = generator.packet()
+            endpoint = 'ingest'
+            call = lambda: client.create(
+                source=source.encode(), destination=destination.encode(),
+                protocol=protocol.encode(), length=length)
+        else:
+            begin = time.time()
+            if begin >= end_at:
+                break
+            endpoint = names[bisect.bisect(weights,
+                                           rand.random() * weights[-1])]
+            source = generator.host().encode()
+            call = {
+                'lookup': lambda: len(client.search(source=source)),
+                'count': lambda: client.count(source=source),
+                'average': lambda: client.average(source=source),
+                'correlate': lambda: client.correlate(
+                    source, generator.host().encode()),
+            }[endpoint]
+        try:
+            call()
+            ok = True
+        except EDBError:
+            ok = False
+        samples.append((endpoint, begin - start_at, time.time() - begin, ok))
+    return samples
+
+def summarize(samples, duration, interval):
+    """Return the report of a run: per endpoint totals, then per interval."""
+    def stats(group, seconds):
+        latencies = sorted(latency for _, _, latency, ok in group if ok)
+        result = {
+            'requests': len(group),
+            'errors': sum(1 for sample in group if not sample[3]),
+            'throughput': len(latencies) / seconds if seconds else 0,
+        }
+        for p in PERCENTILES:
+            value = percentile(latencies, p)
+            result['p{}_ms'.format(p)] = (None if value is None
+                                          else value * 1000)
+        return result
+    endpoints = sorted({sample[0] for sample in samples})
+    report = {'endpoints': {}, 'intervals': []}
+    for endpoint in endpoints:
+        group = [sample for sample in samples if sample[0] == endpoint]
+        report['endpoints'][endpoint] = stats(group, duration)
+    for start in range(0, int(math.ceil(duration)), interval):
+        window = min(interval, duration - start)
+        report['intervals'].append({
+            'start': start,
+            'endpoints': {
+                endpoint: stats([sample for sample in samples
+                                 if sample[0] == endpoint
+                                 and start <= sample[1] < start + interval],
+                                window)
+                for endpoint in endpoints
+            },
+        })
+    return report
+
+def print_stats(label, endpoints):
+    for endpoint, result in sorted(endpoints.items()):
+        values = []
+        for p in PERCENTILES:
+            value = result['p{}_ms'.format(p)]
+            values.append('{:>9}'.format('-') if value is None
+                          else '{:>9.1f}'.format(value))
+        print('{:<8} {:<10} {:>8} {:>6} {:>8.1f}/s {}'.format(
+            label, endpoint, result['requests'], result['errors'],
+            result['throughput'], ' '.join(values)))
+
+@cli.command()
+@click.option('-n', '--rows', default=10000,
+        help='synthetic rows loaded before the run (default 10000)')
+@click.option('--seed', default=0, help='random seed (default 0)')
+@click.option('-d', '--duration', default=30,
+        help='seconds of load (default 30)')
+@click.option('-i', '--interval', default=5,
+        help='seconds per reporting interval (default 5)')
+@click.option('--ingesters', default=1,
+        help='ingesting client processes (default 1)')
+@click.option('--ingest-rate', default=10.0,
+        help='packets per second sent by each ingester (default 10)')
+@click.option('--queriers', default=2,
+        help='querying client processes (default 2)')
+@click.option('--mix', default='lookup=4,count=3,average=2,correlate=1',
+        help='weights of the query operations (default '
+             '"lookup=4,count=3,average=2,correlate=1")')
+@click.option('--hosts', default=1000,
+        help='distinct host addresses (default 1000)')
+@click.option('--skew', default=1.1,
+        help='Zipf exponent of host popularity in rows and queries '
+             '(default 1.1)')
+@click.option('--port', default=8765,
+        help='localhost port of the server under test (default 8765)')
+@click.option('-o', '--output', help='also write the report to this JSON file')
+def load(rows, seed, duration, interval, ingesters, ingest_rate, queriers,
+         mix, hosts, skew, port, output):
+    """Run a concurrent load test against a local server."""
+    from django.db import connection
+    from edb import crypto
+    from edb.client import Client
+    mix = parse_mix(mix)
+    if interval <= 0 or duration <= 0:
+        raise click.UsageError('duration and interval must be positive')
+    keys = crypto.generate_keyinfo(Client.KEY_SCHEMA)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        database = os.path.join(tmpdir, 'load.sqlite3')
+        setup_django(database)
+        if rows:
+            ingest(Timer(), Client(_keyinfo=keys),
+                   PacketGenerator(seed, hosts, skew), rows)
+        # the server and workers open their own connections
+        connection.close()
+        server = start_server(database, port)
+        try:
+            options = {'hosts': hosts, 'skew': skew, 'mix': mix,
+                       'rate': ingest_rate}
+            start_at = time.time() + 1
+            keyinfo = crypto.preserialize_keyinfo(keys)
+            jobs = [(kind, keyinfo, port, seed, number, options, start_at,
+                     duration)
+                    for number, kind in enumerate(
+                        ['ingest'] * ingesters + ['query'] * queriers)]
+            pool = multiprocessing.Pool(len(jobs))
+            try:
+                samples = [sample for result in pool.map(run_worker, jobs)
+                           for sample in result]
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            stop_server(server)
+    finally:
+        shutil.rmtree(tmpdir)
+    report = summarize(samples, duration, interval)
+    report['meta'] = {
+        'rows': rows, 'seed': seed, 'duration': duration,
+        'ingesters': ingesters, 'ingest_rate': ingest_rate,
+        'queriers': queriers, 'mix': dict(mix), 'hosts': hosts,
+        'skew': skew, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    print('{:<8} {:<10} {:>8} {:>6} {:>10} {}'.format(
+        'time', 'endpoint', 'requests', 'errors', 'rate',
+        ' '.join('{:>9}'.format('p{} ms'.format(p)) for p in PERCENTILES)))
+    for window in report['intervals']:
+        print_stats('{}s'.format(window['start']), window['endpoints'])
+    print_stats('total', report['endpoints'])
+    if output:
+        with open(output, 'w') as wfile:
+            json.dump(report, wfile, indent=2, sort_keys=True)
+        print('Wrote results to {}'.format(output), file=sys.stderr)
@@ -0,0 +1,186 @@
+"""Benchmark suite.
+
+Times the main EDB operations over a synthetic packet log: key generation,
+client-side encryption, ingest, encrypted scans (`encrypted_filter`), the
+count/average/correlate computations and client-side decryption. Results
+are written as JSON so that runs can be compared.
+
+Run the suite and compare against an earlier run with:
+
+    python -m bench run --rows 100000 --output new.json
+    python -m bench compare old.json new.json
+
+Each run uses a fresh temporary database.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+
+import click
+
+from bench.generate import PacketGenerator
+
+FIELDS = ('source', 'destination', 'protocol', 'length')
+BATCH_SIZE = 1000
+
+class Timer:
+    """Collect named timings."""
+
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.results = {}
+
+    def record(self, name, seconds, ops=1):
+        """Record the total time of ops operations."""
+        self.results[name] = {
+            'seconds': seconds,
+            'ops': ops,
+            'per_op': seconds / ops if ops else 0,
+        }
+        print('{:<24} {:>10.4f}s {:>12.3e}s/op'.format(
+            name, seconds, self.results[name]['per_op']), file=sys.stderr)
+
+    def time(self, name, func, ops=1):
+        """Record the best time of calling func, returning its result."""
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.record(name, best, ops)
+        return result
+
+def setup_django(database):
+    """Configure Django with a fresh database at the given path."""
+    os.environ['EDB_DATABASE'] = database
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+def ingest(timer, client, generator, rows):
+    """Encrypt and store rows in batches, timing both phases."""
+    from django.db import transaction
+    from logdb.models import Packet
+    encrypt_time = ingest_time = 0
+    packets = generator.packets(rows)
+    remaining = rows
+    while remaining > 0:
+        size = min(BATCH_SIZE, remaining)
+        remaining -= size
+        batch = [dict(zip(FIELDS, (field.encode() for field in packet[:3])),
+                      length=packet[3])
+                 for packet, _ in zip(packets, range(size))]
+        start = time.perf_counter()
+        encrypted = [client.encrypt_model(model, paillier_fields=['length'])
+                     for model in batch]
+        encrypt_time += time.perf_counter() - start
+        start = time.perf_counter()
+        with transaction.atomic():
+            Packet.objects.bulk_create(Packet(**model) for model in encrypted)
+        ingest_time += time.perf_counter() - start
+    timer.record('encrypt_model', encrypt_time, rows)
+    timer.record('ingest', ingest_time, rows)
+
+def query_benchmarks(timer, client, generator, rows):
+    """Time the server-side query operations and client decryption."""
+    from edb import paillier
+    from logdb.models import Packet
+    key = client.keys['paillier'].public()
+    busy = client.query(generator.hosts[0].encode())
+    rare = client.query(generator.hosts[-1].encode())
+    tcp = client.query(b'TCP')
+    scan = Packet.objects.encrypted_filter
+
+    timer.time('encrypted_filter', lambda: scan(source=busy), rows)
+    timer.time('encrypted_filter_miss', lambda: scan(source=rare), rows)
+    timer.time('count', lambda: len(scan(protocol=tcp)), rows)
+
+    def average():
+        lengths = [int(packet.length) for packet in scan(source=busy)]
+        return paillier.average(key, lengths)
+    timer.time('average', average, rows)
+
+    def correlate():
+        srccount = len(scan(source=busy))
+        bothcount = len(scan(source=busy, protocol=tcp))
+        return bothcount / srccount if srccount else 0
+    timer.time('correlate', correlate, rows)
+
+    matches = [{field: getattr(packet, field) for field in FIELDS}
+               for packet in scan(source=busy)]
+    timer.time('decrypt_model', lambda: [
+        client.decrypt_model(model, paillier_fields=['length'])
+        for model in matches], len(matches))
+
+@click.group()
+def cli():
+    """EDB benchmark suite."""
+
+@cli.command()
+@click.option('-n', '--rows', default=10000,
+        help='number of synthetic rows (default 10000)')
+@click.option('--seed', default=0, help='random seed (default 0)')
+@click.option('--repeat', default=3,
+        help='runs per timing, the best is kept (default 3)')
+@click.option('-o', '--output', default='bench.json',
+        help='results file (default "bench.json")')
+def run(rows, seed, repeat, output):
+    """Run the benchmarks."""
+    from edb import crypto
+    from edb.client import Client
+    timer = Timer(repeat)
+    keys = timer.time('keygen',
+                      lambda: crypto.generate_keyinfo(Client.KEY_SCHEMA))
+    client = Client(_keyinfo=keys)
+    generator = PacketGenerator(seed)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        setup_django(os.path.join(tmpdir, 'bench.sqlite3'))
+        ingest(timer, client, generator, rows)
+        query_benchmarks(timer, client, generator, rows)
+    finally:
+        shutil.rmtree(tmpdir)
+    report = {
+        'meta': {
+            'rows': rows,
+            'seed': seed,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': timer.results,
+    }
+    with open(output, 'w') as wfile:
+        json.dump(report, wfile, indent=2, sort_keys=True)
+    print('Wrote results to {}'.format(output), file=sys.stderr)
+
+@cli.command()
+@click.argument('baseline', type=click.File('r'), help='earlier results')
+@click.argument('current', type=click.File('r'), help='new results')
+@click.option('-t', '--threshold', default=0.10,
+        help='slowdown ratio flagged as a regression (default 0.10)')
+@click.pass_context
+def compare(context, baseline, current, threshold):
+    """Compare two result files for regressions."""
+    old = json.load(baseline)['results']
+    new = json.load(current)['results']
+    regressions = compare_results(old, new, threshold)
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]['per_op'], new[name]['per_op']
+        change = (after - before) / before if before else 0
+        flag = '  REGRESSION' if name in regressions else ''
+        print('{:<24} {:>12.3e} {:>12.3e} {:>+8.1%}{}'.format(
+            name, before, after, change, flag))
+    if regressions:
+        context.exit(1)
+
+def compare_results(old, new, threshold):
+    """Return the names whose per-op time grew by more than threshold."""
+    return [name for name in sorted(set(old) & set(new))
+            if new[name]['per_op'] > old[name]['per_op'] * (1 + threshold)]
@@ -1,10 +1,93 @@
 """EDB client."""
+import json
 import base64
+import bisect
+import hashlib
+import ipaddress
+import multiprocessing
+import collections.abc
 
 from edb import crypto, paillier
-from edb.constants import BLOCK_BYTES, MATCH_BYTES, LEFT_BYTES, PAILLIER_BITS
+from edb.constants import (BLOCK_BYTES, MATCH_BYTES, LEFT_BYTES, TAG_BYTES,
+                           PAILLIER_BITS, BUCKET_BITS)
 from edb.errors import EDBError
 
+QUERY_CACHE_SIZE = 4096
+
+# Lengths of the IPv4 network prefixes that encrypt_model can index.
+IP_PREFIXES = (8, 16, 24)
+
+def prefix_field(field, length):
+    """Return the name of the column holding field's /length prefix."""
+    return '{}_p{}'.format(field, length)
+
+def ip_prefixes(address, lengths=IP_PREFIXES):
+    """Return {length: network} for the prefixes of an IPv4 address.
+
+    Each network is in canonical form as bytes, such as b'10.1.2.0/24'. If
+    address is not an IPv4 address, the result is empty.
+
+    """
+    if isinstance(address, (bytes, bytearray)):
+        address = bytes(address).decode(errors='replace')
+    try:
+        address = ipaddress.IPv4Address(address)
+    except ValueError:
+        return {}
+    return {length: str(ipaddress.IPv4Network((address, length),
+                                              strict=False)).encode()
+            for length in lengths}
+
+def bucket_field(field):
+    """Return the name of the column holding field's bucket counters."""
+    return '{}_buckets'.format(field)
+
+def bucket_scheme_field(field):
+    """Return the name of the column holding the fingerprint of the bucket
+    bounds of field's counters."""
+    return '{}_bucket_scheme'.format(field)
+
+def bucket_scheme(bounds):
+    """Return a short fingerprint of bucket bounds and the counter width.
+
+    Counters packed for different bounds use their slots for different
+    buckets, so only those of one scheme can be added up.
+
+    """
+    text = '{}:{}'.format(BUCKET_BITS, ','.join(str(int(bound))
+                                                  for bound in bounds))
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def bucket_index(bounds, value):
+    """Return the bucket of a number given the ascending bucket bounds.
+
+    Bucket 0 holds values below bounds[0], bucket i values in
+    [bounds[i-1], bounds[i]) and the last bucket values from bounds[-1] up,
+    so there are len(bounds) + 1 buckets.
+
+    """
+    return bisect.bisect_right(bounds, value)
+
+def prefix_query(field, network):
+    """Return the plaintext query {column: word} for an IPv4 network.
+
+    A /32 network is an exact match on field itself; other networks must
+    have one of the IP_PREFIXES lengths.
+
+    """
+    if isinstance(network, (bytes, bytearray)):
+        network = bytes(network).decode(errors='replace')
+    try:
+        network = ipaddress.IPv4Network(network, strict=False)
+    except ValueError:
+        raise EDBError('invalid IPv4 network {!r}'.format(network))
+    if network.prefixlen == 32:
+        return {field: str(network.network_address).encode()}
+    if network.prefixlen not in IP_PREFIXES:
+        raise EDBError('prefix length must be one of {} or 32'.format(
+            ', '.join(map(str, IP_PREFIXES))))
+    return {prefix_field(field, network.prefixlen): str(network).encode()}
+
 class Client:
     """Client to access an EDB.
 
@@ -50,6 +133,18 @@ class Client:
             self.keys = crypto.read_keyinfo(keyfile)
         else:
             self.keys = crypto.generate_keyinfo(self.KEY_SCHEMA)
+        self._query_cache = {}
+
+    def key_id(self):
+        """Return a short fingerprint of the keys.
+
+        Stored in plaintext alongside rows, it tells which keys encrypted
+        them without revealing anything about the keys.
+
+        """
+        serialized = json.dumps(crypto.preserialize_keyinfo(self.keys),
+                                sort_keys=True)
+        return hashlib.sha256(serialized.encode()).hexdigest()[:16]
 
     def encrypt_query(self, params):
         return {
@@ -57,8 +152,35 @@ class Client:
             for field, value in params.items()
         }
 
-    def encrypt_model(self, model, exclude_fields=(), paillier_fields=()):
+    def encrypt_model(self, model, exclude_fields=(), paillier_fields=(),
+                      prefix_fields=(), index_fields=(), bucket_fields=None):
+        """Encrypt each field of a model.
+
+        For each IPv4 address in one of the prefix_fields, the encrypted
+        networks containing it are added too, one per length in IP_PREFIXES,
+        under the names given by prefix_field. A whole network can then be
+        searched with the single token of its prefix.
+
+        If index_fields are given, the keyword tags of their words (and of
+        their networks, for prefix fields) are added under 'index', for
+        servers keeping an encrypted inverted index.
+
+        bucket_fields may map numeric fields to ascending bucket bounds (see
+        bucket_index). Each such field's bucket is then also stored, under
+        the name given by bucket_field, as one Paillier ciphertext of packed
+        counters (see bucket_plaintext). Multiplying these ciphertexts
+        counts the rows in every bucket at once, giving a histogram. The
+        plaintext bucket_scheme of the bounds is stored alongside, under
+        bucket_scheme_field, so that only counters of the same bounds are
+        multiplied together.
+
+        """
         result = {}
+        words = {}
+        for field, bounds in (bucket_fields or {}).items():
+            result[bucket_field(field)] = self.paillier_encrypt(
+                self.bucket_plaintext(bounds, model[field]))
+            result[bucket_scheme_field(field)] = bucket_scheme(bounds)
         for field, value in model.items():
             if field in exclude_fields:
                 result[field] = value
@@ -66,6 +188,16 @@ class Client:
                 result[field] = self.paillier_encrypt(value)
             else:
                 result[field] = self.encrypt(value)
+                if field in index_fields:
+                    words[field] = value
+        for field in prefix_fields:
+            for length, network in ip_prefixes(model.get(field)).items():
+                name = prefix_field(field, length)
+                result[name] = self.encrypt(network)
+                if field in index_fields:
+                    words[name] = network
+        if index_fields:
+            result['index'] = self.index_query(words)
         return result
 
     def decrypt_model(self, model, exclude_fields=(), paillier_fields=()):
@@ -79,6 +211,28 @@ class Client:
                 result[field] = self.decrypt(value)
         return result
 
+    def lazy_decrypt_model(self, model, exclude_fields=(), paillier_fields=()):
+        """Return a LazyModel that decrypts each field on first access."""
+        return LazyModel(self, model, exclude_fields, paillier_fields)
+
+    def decrypt_models(self, models, exclude_fields=(), paillier_fields=(),
+                       processes=None, chunksize=64):
+        """Eagerly decrypt many models across a pool of worker processes.
+
+        Models that fail to decrypt are dropped from the result. If processes
+        is None, one worker is started per CPU.
+
+        """
+        keys = crypto.preserialize_keyinfo(self.keys)
+        jobs = ((model, exclude_fields, paillier_fields) for model in models)
+        pool = multiprocessing.Pool(processes, _init_decrypt_worker, (keys,))
+        try:
+            results = pool.map(_decrypt_worker, jobs, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+        return [result for result in results if result is not None]
+
     def encrypt(self, word):
         """Encrypt a word."""
         salt = crypto.get_random_bytes(BLOCK_BYTES)
@@ -103,11 +257,49 @@ class Client:
         return self.postprocess(preword)
 
     def query(self, word):
-        """Return the search parameters (preword, word_key) for word."""
+        """Return the search parameters (preword, word_key) for word.
+
+        Query tokens are deterministic, so they are cached per client.
+
+        """
+        try:
+            return self._query_cache[word]
+        except KeyError:
+            pass
         preword = self.preprocess(word)
         left_part = self.left_part(preword)
         word_key = self.word_key(left_part)
-        return base64.encodebytes(preword + word_key).decode()
+        token = base64.encodebytes(preword + word_key).decode()
+        if len(self._query_cache) >= QUERY_CACHE_SIZE:
+            self._query_cache.clear()
+        self._query_cache[word] = token
+        return token
+
+    def index_tag(self, field, word):
+        """Return the keyword tag of word in field for the inverted index.
+
+        Tags are deterministic, so they are cached like query tokens.
+
+        """
+        if isinstance(word, str):
+            word = word.encode()
+        try:
+            return self._query_cache[field, word]
+        except KeyError:
+            pass
+        index_key = crypto.prfunction(self.keys['hash'], b'edb index')
+        tag = crypto.prfunction(index_key, field.encode() + b'\0' + word,
+                                TAG_BYTES)
+        tag = base64.b64encode(tag).decode()
+        if len(self._query_cache) >= QUERY_CACHE_SIZE:
+            self._query_cache.clear()
+        self._query_cache[field, word] = tag
+        return tag
+
+    def index_query(self, params):
+        """Return the comma-separated tags of all words in params."""
+        return ','.join(sorted(self.index_tag(field, word)
+                               for field, word in params.items()))
 
     def paillier_encrypt(self, ptxt):
         """Encrypt a number using homomorphic methods."""
@@ -125,6 +317,24 @@ class Client:
             raise EDBError("can only homomorphic decrypt integers")
         return paillier.decrypt(self.keys['paillier'], ctxt)
 
+    def bucket_plaintext(self, bounds, value):
+        """Return the packed counters of value's bucket: 1 in its slot."""
+        buckets = len(bounds) + 1
+        if buckets > paillier.slots(self.keys['paillier'], BUCKET_BITS):
+            raise EDBError('too many buckets for the Paillier key')
+        try:
+            value = int(value)
+        except ValueError:
+            raise EDBError("can only bucket integers")
+        counters = [0] * buckets
+        counters[bucket_index(bounds, value)] = 1
+        return paillier.pack(counters, BUCKET_BITS)
+
+    def decrypt_buckets(self, ctxt, bounds):
+        """Return the bucket counts from a sum of packed bucket counters."""
+        return paillier.unpack(self.paillier_decrypt(ctxt), len(bounds) + 1,
+                               BUCKET_BITS)
+
     def stream_encrypt(self, salt, preword):
         """Encrypt a (preprocessed) word with given salt."""
         left_part = self.left_part(preword)
@@ -172,8 +382,70 @@ class Client:
     def postprocess(self, preword):
         """Postdecrypt and unpad a (preproccessed) word."""
         padded_word = self.block_decrypt(preword)
-        return crypto.unpad(padded_word)
+        try:
+            return crypto.unpad(padded_word)
+        except ValueError:
+            raise EDBError("invalid ciphertext -- bad padding")
 
     def left_part(self, block):
         """Return the left_part of a block."""
         return block[:(LEFT_BYTES)]
+
+class LazyModel(collections.abc.Mapping):
+    """Read-only mapping over an encrypted model.
+
+    Fields are decrypted on first access and cached, so callers only pay for
+    the fields they actually read. Decryption errors are raised as EDBError
+    when the failing field is accessed.
+
+    """
+
+    __slots__ = ('_client', '_model', '_exclude_fields', '_paillier_fields',
+                 '_cache')
+
+    def __init__(self, client, model, exclude_fields=(), paillier_fields=()):
+        self._client = client
+        self._model = model
+        self._exclude_fields = exclude_fields
+        self._paillier_fields = paillier_fields
+        self._cache = {}
+
+    def __getitem__(self, field):
+        try:
+            return self._cache[field]
+        except KeyError:
+            pass
+        value = self._model[field]
+        if field in self._exclude_fields:
+            ptxt = value
+        elif field in self._paillier_fields:
+            ptxt = self._client.paillier_decrypt(value)
+        else:
+            ptxt = self._client.decrypt(value)
+        self._cache[field] = ptxt
+        return ptxt
+
+    def __iter__(self):
+        return iter(self._model)
+
+    def __len__(self):
+        return len(self._model)
+
+    def __repr__(self):
+        return '<LazyModel {}>'.format(sorted(self._model))
+
+# Per-process client used by Client.decrypt_models workers.
+_worker_client = None
+
+def _init_decrypt_worker(psz_keyinfo):
+    global _worker_client
+    keyinfo = crypto.postdeserialize_keyinfo(psz_keyinfo)
+    _worker_client = Client(_keyinfo=keyinfo)
+
+def _decrypt_worker(job):
+    model, exclude_fields, paillier_fields = job
+    try:
+        return _worker_client.decrypt_model(model, exclude_fields,
+                                            paillier_fields)
+    except EDBError:
+        return None
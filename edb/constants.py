@@ -3,5 +3,7 @@
 BLOCK_BYTES = 32 # 256 bits
 MATCH_BYTES = 4  # only last 32 bits of message are checked during search
 LEFT_BYTES = BLOCK_BYTES - MATCH_BYTES
+TAG_BYTES = 16   # keyword tags of the encrypted inverted index
 
 PAILLIER_BITS = 512
+BUCKET_BITS = 32 # width of each counter packed into a Paillier plaintext
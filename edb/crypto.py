@@ -231,10 +231,18 @@ def pad(message):
     return message + bytes([padlen]) * padlen
 
 def unpad(message):
-    """Unpad message."""
+    """Unpad message, raising ValueError if its padding is invalid.
+
+    A word decrypted with the wrong keys almost never has valid padding, so
+    this is also how such words are detected.
+
+    """
     if len(message) != BLOCK_BYTES:
         raise TypeError("expected 256-bit padded message")
     padlen = message[-1]
+    if not 1 <= padlen <= BLOCK_BYTES or message[-padlen:] != bytes(
+            [padlen]) * padlen:
+        raise ValueError("invalid padding")
     return message[:-padlen]
 
 def xor(original, *others):
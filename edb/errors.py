@@ -1,2 +1,15 @@
 class EDBError(RuntimeError):
     """Generic EDB error."""
+
+class QueryTimeout(EDBError):
+    """Encrypted scan passed its deadline.
+
+    The rows matched so far are in results, and scanned holds the (first,
+    last) ids of the rows examined, or None if no rows were examined.
+
+    """
+
+    def __init__(self, results, scanned):
+        super().__init__('query timed out')
+        self.results = results
+        self.scanned = scanned
@@ -76,3 +76,36 @@ def average(key, ctxts):
         tally = (tally*ctxt) % nsquared
     # client can decrypt and perform division upon receipt
     return tally, encrypt(key, len(ctxts))
+
+def total(key, ctxts):
+    """Return the encrypted sum of ciphertexts.
+
+    The sum starts from a fresh encryption of zero, so an empty sum cannot
+    be told apart from any other.
+
+    """
+    nsquared = key.modulus * key.modulus
+    tally = encrypt(key, 0)
+    for ctxt in ctxts:
+        tally = (tally*ctxt) % nsquared
+    return tally
+
+# Several small counters can share one plaintext, each in its own run of
+# bits. Adding two packed plaintexts adds their counters slot by slot, as
+# long as no counter outgrows its bits.
+
+def slots(key, bits):
+    """Return how many counters of the given bits fit in one plaintext."""
+    return (key.modulus.bit_length() - 1) // bits
+
+def pack(counters, bits):
+    """Return the plaintext holding counters, the first in the low bits."""
+    plaintext = 0
+    for i, counter in enumerate(counters):
+        plaintext |= counter << (i * bits)
+    return plaintext
+
+def unpack(plaintext, count, bits):
+    """Return the first count counters packed into a plaintext."""
+    mask = (1 << bits) - 1
+    return [(plaintext >> (i * bits)) & mask for i in range(count)]
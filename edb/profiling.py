@@ -0,0 +1,194 @@
+"""Opt-in profiling of the server and client.
+
+A Profile runs cProfile and/or a stack sampler over one thread. A single
+thread per process wakes every SAMPLE_INTERVAL seconds and records the call
+stacks of all the threads being sampled, so sampling costs little enough to
+run on every request, however many run at once; cProfile counts every call
+but slows the profiled code down several times.
+
+Profiles are written as three files sharing a prefix:
+
+    PREFIX.prof       cProfile stats, for pstats or snakeviz
+    PREFIX.collapsed  sampled stacks, one "frame;frame;... count" line each,
+                      for flamegraph.pl or speedscope
+    PREFIX.txt        a summary of the crypto hot paths (HOT_MODULES)
+"""
+import io
+import sys
+import time
+import cProfile
+import pstats
+import threading
+import collections
+
+# Seconds between stack samples.
+SAMPLE_INTERVAL = 0.005
+
+# Modules whose functions are summarized in the .txt output.
+HOT_MODULES = ('edb.crypto', 'edb.paillier', 'edb.server.util')
+
+# matches the file names of HOT_MODULES in pstats output
+_HOT_PATTERN = '|'.join(r'{}\.py'.format(module.replace('.', r'[/\\]'))
+                        for module in HOT_MODULES)
+
+def frame_label(frame):
+    """Return "package.module:function" for a stack frame."""
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'),
+                          frame.f_code.co_name)
+
+class StackSampler:
+    """Periodically record the call stack of one thread.
+
+    Parameters:
+
+    thread_id (optional)
+      ident of the thread to sample, by default the calling thread
+
+    interval (optional)
+      seconds between samples; while several samplers run, all are sampled
+      at the shortest of their intervals
+
+    """
+
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def start(self):
+        _sampling.add(self)
+
+    def stop(self):
+        _sampling.remove(self)
+
+    def record(self, frame):
+        """Count the stack ending at frame."""
+        stack = []
+        while frame is not None:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Return the samples in collapsed-stack format."""
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+    def inclusive(self):
+        """Return {frame label: samples with the frame on the stack}."""
+        counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            for label in set(stack.split(';')):
+                counts[label] += count
+        return counts
+
+class _SamplingThread:
+    """The one thread that samples for every running StackSampler."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samplers = set()
+        self.thread = None
+
+    def add(self, sampler):
+        with self.lock:
+            self.samplers.add(sampler)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def remove(self, sampler):
+        """Stop sampling for sampler; no samples are recorded after this."""
+        with self.lock:
+            self.samplers.discard(sampler)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.samplers:
+                    self.thread = None
+                    return
+                interval = min(sampler.interval for sampler in self.samplers)
+            time.sleep(interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for sampler in self.samplers:
+                    sampler.record(frames.get(sampler.thread_id))
+            del frames
+
+_sampling = _SamplingThread()
+
+class Profile:
+    """Profile the calling thread between start() and stop().
+
+    Parameters:
+
+    deterministic (optional)
+      whether to run cProfile as well as the stack sampler
+
+    interval (optional)
+      seconds between stack samples
+
+    """
+
+    def __init__(self, deterministic=True, interval=SAMPLE_INTERVAL):
+        self.sampler = StackSampler(interval=interval)
+        self.profiler = cProfile.Profile() if deterministic else None
+        self.elapsed = None
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        self.sampler.start()
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # another profiler is active (Python 3.12+ allows only one)
+                self.profiler = None
+        return self
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.sampler.stop()
+        self.elapsed = time.perf_counter() - self._start
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def write(self, prefix):
+        """Write the profile to files named PREFIX.*; return their paths."""
+        paths = []
+        if self.profiler is not None:
+            self.profiler.dump_stats(prefix + '.prof')
+            paths.append(prefix + '.prof')
+        with open(prefix + '.collapsed', 'w') as wfile:
+            wfile.write(self.sampler.collapsed())
+        with open(prefix + '.txt', 'w') as wfile:
+            wfile.write(self.summary())
+        return paths + [prefix + '.collapsed', prefix + '.txt']
+
+    def summary(self):
+        """Return a text summary of the time spent in the crypto hot paths."""
+        total = sum(self.sampler.stacks.values())
+        lines = ['elapsed: {:.3f}s, {} stack samples'.format(self.elapsed or 0,
+                                                          total), '']
+        hot = [(count, label)
+               for label, count in self.sampler.inclusive().items()
+               if label.split(':')[0] in HOT_MODULES]
+        if hot:
+            lines.append('sampled hot paths (share of samples, inclusive):')
+            for count, label in sorted(hot, reverse=True):
+                lines.append('  {:6.1%}  {}'.format(count / total, label))
+            lines.append('')
+        if self.profiler is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(_HOT_PATTERN)
+            lines.append(stream.getvalue())
+        return '\n'.join(lines)
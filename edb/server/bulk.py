@@ -0,0 +1,59 @@
+"""Bulk in-place updates of encrypted rows.
+
+Clients rewriting many rows at once, such as when rotating keys, send a JSON
+list of rows, each with its id and the fields to replace. All rows are
+updated in one transaction, with one UPDATE per row and no per-row signals.
+Index postings are replaced along with the rows and segment stores are
+updated afterwards. The table's version (see edb.server.etags) is bumped in
+the same transaction.
+"""
+from django.db import transaction
+from rest_framework.exceptions import APIException
+
+from edb.server import index
+from edb.server.models import bump_version, segment_store
+
+# Most rows accepted in one request.
+MAX_ROWS = 5000
+
+class InvalidBulkUpdate(APIException):
+    status_code = 403
+    default_detail = ("expected a list of at most {} rows, each with an id "
+                      "and fields of the table".format(MAX_ROWS))
+
+def update_rows(model, rows):
+    """Update rows in place and return how many existed."""
+    if not isinstance(rows, list) or len(rows) > MAX_ROWS:
+        raise InvalidBulkUpdate
+    fields = {field.name for field in model._meta.fields
+              if not field.primary_key}
+    updates = []
+    for row in rows:
+        if not isinstance(row, dict):
+            raise InvalidBulkUpdate
+        row = dict(row)
+        try:
+            pk = int(row.pop('id'))
+        except (KeyError, ValueError, TypeError):
+            raise InvalidBulkUpdate
+        tags = row.pop(index.INDEX_PARAM, None)
+        if tags is not None:
+            index.parse_tags(tags)
+        if not row or not set(row) <= fields:
+            raise InvalidBulkUpdate
+        updates.append((pk, row, tags))
+    updated = []
+    with transaction.atomic():
+        for pk, values, tags in updates:
+            if model.objects.filter(pk=pk).update(**values):
+                index.update_tags(model, pk, tags, values)
+                updated.append(pk)
+        if updated:
+            bump_version(model)
+    store = segment_store(model)
+    if store is not None and updated:
+        store.extend((row.pk, {name: getattr(row, name)
+                               for name in store.fields})
+                     for row in model.objects.fetch(updated))
+        store.discard(len(updated))
+    return len(updated)
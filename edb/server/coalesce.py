@@ -0,0 +1,90 @@
+"""Single-flight coalescing of identical concurrent queries.
+
+Query tokens are deterministic, so identical queries sent at the same time
+(for example by dashboard panels refreshing together) are byte-identical.
+Instead of scanning once per request, the first request for a key runs the
+scan and the others wait for it and share its result.
+
+Coalescing happens between threads of one server process. It is enabled by
+the EDB_COALESCE_QUERIES setting (default True).
+"""
+import threading
+
+from django.conf import settings
+
+from edb.server import metrics
+
+COALESCED = metrics.Counter('edb_coalesced_requests_total',
+                            'Requests answered by a concurrent identical '
+                            'query.', ['endpoint'])
+
+class _Call:
+    """An in-flight call and its eventual outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Run at most one call per key at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        """Return (result, shared) for func, sharing in-flight calls.
+
+        If a call with the same key is already running, wait for it and
+        return its result (or raise its error) with shared set to True.
+
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+_flights = SingleFlight()
+
+def coalesce(endpoint, params, func, stats):
+    """Return (result, stats, shared) of func for a query on an endpoint.
+
+    Concurrent calls with the same endpoint and params share one result.
+    The stats parameter is the ScanStats that func records into; a call
+    that shared another's result gets that call's stats back instead, since
+    its own recorded nothing.
+
+    """
+    if not getattr(settings, 'EDB_COALESCE_QUERIES', True):
+        return func(), stats, False
+    key = (endpoint, tuple(sorted(params.items())))
+    (result, stats), shared = _flights.do(key, lambda: (func(), stats))
+    if shared:
+        COALESCED.inc(endpoint=endpoint)
+    return result, stats, shared
+
+def mark(response, shared):
+    """Flag a response that shared another request's result."""
+    if shared:
+        response['X-EDB-Coalesced'] = '1'
+    return response
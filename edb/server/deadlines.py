@@ -0,0 +1,75 @@
+"""Query deadlines and partial results.
+
+Requests can limit how long their encrypted scans run with `timeout_ms`; the
+EDB_QUERY_TIMEOUT_MS setting gives the default (None for no limit). An
+expired query fails with 503, unless it was sent with `partial=1`, in which
+case it returns what was found so far along with the range of row ids that
+were scanned.
+"""
+import time
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+from edb.errors import QueryTimeout
+
+class QueryTimeoutError(APIException):
+    status_code = 503
+    default_detail = "query timed out"
+
+class InvalidTimeout(APIException):
+    status_code = 403
+    default_detail = "timeout_ms must be a positive integer"
+
+def pop_deadline(params):
+    """Remove the timeout options from params.
+
+    Return (deadline, partial): the time.monotonic() deadline, or None for
+    no limit, and whether partial results were requested.
+
+    """
+    timeout_ms = params.pop('timeout_ms', None)
+    partial = params.pop('partial', '0') not in ('', '0', 'false')
+    if timeout_ms is None:
+        timeout_ms = getattr(settings, 'EDB_QUERY_TIMEOUT_MS', None)
+    if timeout_ms is None:
+        return None, partial
+    try:
+        timeout_ms = int(timeout_ms)
+    except ValueError:
+        raise InvalidTimeout
+    if timeout_ms <= 0:
+        raise InvalidTimeout
+    return time.monotonic() + timeout_ms / 1000, partial
+
+def scan(manager, queries, stats, deadline, partial, ids=None, filters=None,
+         limit=None, visit=None):
+    """Run an encrypted scan under a deadline, optionally limited to ids,
+    plaintext filters and a number of rows, and calling visit with each
+    chunk of matching rows (see EncryptedManager.encrypted_scan).
+
+    Return (rows, scanned), where scanned is None for a complete scan or the
+    (first, last) ids examined by an expired one. Raise QueryTimeoutError if
+    the scan expired and partial results were not requested.
+
+    """
+    try:
+        return manager.encrypted_scan(queries, stats, deadline, ids,
+                                      filters, limit, visit), None
+    except QueryTimeout as err:
+        if not partial:
+            raise QueryTimeoutError
+        return err.results, err.scanned or (None, None)
+
+def mark_partial(response, scanned):
+    """Annotate a response built from partial results."""
+    if scanned is None:
+        return response
+    first, last = scanned
+    response['X-EDB-Partial'] = '1'
+    response['X-EDB-Scanned-Range'] = '{}-{}'.format(
+        '' if first is None else first, '' if last is None else last)
+    if isinstance(response.data, dict):
+        response.data['partial'] = True
+        response.data['scanned_range'] = [first, last]
+    return response
@@ -0,0 +1,64 @@
+"""Conditional GET requests for encrypted search and compute results.
+
+Every write to an encrypted table bumps its version (see
+edb.server.models.bump_version). Responses to queries on the table carry an
+ETag derived from that version, the path and the query params, tokens
+included, so the tag changes whenever the rows or the query do. A request
+whose If-None-Match holds the current tag gets 304 Not Modified without any
+scan. Partial results are never tagged. The edb_etag_requests_total metric
+counts the requests answered each way.
+"""
+import json
+import hashlib
+import functools
+
+from rest_framework.response import Response
+
+from edb.server import metrics
+from edb.server.models import table_version
+
+ETAG_REQUESTS = metrics.Counter('edb_etag_requests_total',
+                                'Conditional GETs answered with 304 (hit) '
+                                'or by running the query (miss).',
+                                ['result'])
+
+def etag(model, path, params):
+    """Return the quoted ETag of a query on a model's table."""
+    key = json.dumps([model._meta.db_table, table_version(model), path,
+                      sorted(params.lists())])
+    return '"{}"'.format(hashlib.sha1(key.encode()).hexdigest())
+
+def if_none_match(request):
+    """Return the set of ETags in a request's If-None-Match header."""
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return {tag.strip() for tag in header.split(',') if tag.strip()}
+
+def conditional_response(request, model, respond):
+    """Answer a GET with 304 if its ETag matches, or else call respond().
+
+    The version is read before respond() runs, so a write during the scan
+    only makes the tag stale, never the cached response.
+
+    """
+    tag = etag(model, request.path, request.QUERY_PARAMS)
+    tags = if_none_match(request)
+    if tag in tags or '*' in tags:
+        ETAG_REQUESTS.inc(result='hit')
+        response = Response(status=304)
+    else:
+        ETAG_REQUESTS.inc(result='miss')
+        response = respond()
+        if response.status_code != 200 or response.has_header('X-EDB-Partial'):
+            return response
+    response['ETag'] = tag
+    return response
+
+def conditional(model):
+    """Decorate a GET view of a model's rows to support If-None-Match."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return conditional_response(
+                request, model, lambda: view(request, *args, **kwargs))
+        return wrapper
+    return decorator
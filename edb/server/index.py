@@ -0,0 +1,106 @@
+"""Encrypted inverted index for sublinear search.
+
+Matching Song et al. tokens costs one HMAC per row, so every query scans the
+whole table. Models with `search_mode = INDEX` can also be searched through
+an inverted index: when adding a row, the client sends a keyword tag for
+each indexed (field, word) pair, a PRF of the two under a key the server
+never sees. The server files the row under each tag. A search sends the tags
+of the query words in the `index` parameter, and costs one indexed lookup
+per tag plus one fetch per matching row.
+
+Leakage profile. Tags are deterministic, so unlike the Song ciphertexts
+they leak before any query is made:
+
+* at rest, the server learns which rows share a value in an indexed field
+  (the equality pattern) and so how often each value occurs, as with
+  deterministic encryption of that field;
+* per query, it learns which earlier queries asked for the same words (the
+  search pattern) and which rows matched (the access pattern), as with the
+  scan.
+
+The server still learns no plaintext words, and rows added without tags are
+not indexed. Postings hold plain row ids, since the server sees which row
+each tag came with when it is added.
+"""
+import base64
+import binascii
+
+from rest_framework.exceptions import APIException
+
+from edb.constants import TAG_BYTES
+from edb.server.models import INDEX, IndexEntry, bump_version
+
+INDEX_PARAM = 'index'
+
+class IndexDisabled(APIException):
+    status_code = 403
+    default_detail = "this table has no encrypted index"
+
+class InvalidTags(APIException):
+    status_code = 403
+    default_detail = "index must be a comma-separated list of keyword tags"
+
+def parse_tags(value):
+    """Return the list of tags in a comma-separated string."""
+    tags = [tag for tag in value.split(',') if tag]
+    for tag in tags:
+        try:
+            raw = base64.b64decode(tag.encode(), validate=True)
+        except (binascii.Error, ValueError):
+            raise InvalidTags
+        if len(raw) != TAG_BYTES:
+            raise InvalidTags
+    return tags
+
+def pop_tags(params, model):
+    """Remove the index option from params.
+
+    Return the list of tags to look up, or None to scan.
+
+    """
+    value = params.pop(INDEX_PARAM, None)
+    if value is None:
+        return None
+    if model.search_mode != INDEX:
+        raise IndexDisabled
+    return parse_tags(value) or None
+
+def lookup(model, tags):
+    """Return the set of ids of the rows filed under every tag."""
+    table = model._meta.db_table
+    ids = None
+    for tag in sorted(set(tags)):
+        rows = set(IndexEntry.objects.filter(table=table, tag=tag)
+                                     .values_list('row', flat=True))
+        ids = rows if ids is None else ids & rows
+        if not ids:
+            break
+    return ids or set()
+
+def save_tags(model, pk, value):
+    """File row pk under the tags in a comma-separated string.
+
+    The row's previous postings, if any, are replaced. Models that do not
+    use the index ignore the tags.
+
+    """
+    if model.search_mode != INDEX or value is None:
+        return
+    tags = set(parse_tags(value))
+    table = model._meta.db_table
+    IndexEntry.objects.filter(table=table, row=pk).delete()
+    IndexEntry.objects.bulk_create(
+        [IndexEntry(table=table, tag=tag, row=pk) for tag in tags])
+    bump_version(model)
+
+def update_tags(model, pk, value, fields):
+    """File row pk under new tags after an update of the named fields.
+
+    If the update changed a searchable field but came without tags, the
+    row's postings would no longer match it, so they are removed: the row
+    can then only be found by scanning until it is updated with tags.
+
+    """
+    if value is None and set(fields) & set(model.searchable_fields()):
+        value = ''
+    save_tags(model, pk, value)
@@ -0,0 +1,187 @@
+"""
+Lightweight WSGI application for encrypted queries.
+
+Serves the read-only query endpoints (packet search and the compute
+endpoints) straight from sqlite3 cursors, skipping Django's middleware, the
+REST framework and the ORM. Matching semantics and response shapes are the
+same as the Django views in `logdb.views`. Writes and the admin stay in the
+Django application (`edb.server.wsgi`), which should own the same database.
+
+Run standalone on port 8001 (for example) with:
+
+    python -m edb.server.lite 8001
+
+or point any WSGI server at `edb.server.lite:application`.
+"""
+
+import os
+import json
+import sqlite3
+import importlib
+import threading
+from urllib.parse import parse_qsl
+
+from edb import paillier
+from edb.server.util import decode_query, match_decoded
+
+TABLE = 'logdb_packet'
+FIELDS = ('id', 'source', 'destination', 'protocol', 'length', 'captured_at',
+          'key_id')
+SEARCH_FIELDS = ('source', 'destination', 'protocol', 'length',
+                 'source_p8', 'source_p16', 'source_p24',
+                 'destination_p8', 'destination_p16', 'destination_p24')
+
+INVALID_PAGE = 'after_id and limit must be non-negative integers'
+
+class HTTPError(Exception):
+    """Error response with a status line and a detail message."""
+
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+def database_path():
+    """Return the path of the default database from the Django settings."""
+    module = os.environ.get('DJANGO_SETTINGS_MODULE', 'settings')
+    settings = importlib.import_module(module)
+    return settings.DATABASES['default']['NAME']
+
+class LiteApplication:
+    """WSGI application serving encrypted queries from a SQLite database."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.local = threading.local()
+        self.routes = {
+            '/packets': self.packets,
+            '/compute/average': self.average,
+            '/compute/count': self.count,
+            '/compute/correlate': self.correlate,
+        }
+
+    def connection(self):
+        """Return this thread's read-only connection."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            path = self.path or database_path()
+            conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+            self.local.conn = conn
+        return conn
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '/')
+        try:
+            if environ['REQUEST_METHOD'] != 'GET':
+                raise HTTPError('405 METHOD NOT ALLOWED',
+                    'Method "{}" not allowed.'.format(environ['REQUEST_METHOD']))
+            handler = self.routes.get(path.rstrip('/'))
+            if handler is None:
+                raise HTTPError('404 NOT FOUND', 'Not found')
+            params = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+            # query stats are only reported by the Django views
+            params.pop('explain', None)
+            if 'timeout_ms' in params or 'partial' in params:
+                raise HTTPError('403 FORBIDDEN', 'query deadlines are not '
+                                'supported by this server')
+            if 'approx' in params or 'approx_rows' in params:
+                raise HTTPError('403 FORBIDDEN', 'approximate queries are '
+                                'not supported by this server')
+            if 'since' in params or 'until' in params:
+                raise HTTPError('403 FORBIDDEN', 'time ranges are not '
+                                'supported by this server')
+            if 'index' in params:
+                raise HTTPError('403 FORBIDDEN', 'indexed queries are not '
+                                'supported by this server')
+            status, body = '200 OK', handler(params)
+        except HTTPError as err:
+            status, body = err.status, {'detail': err.detail}
+        data = json.dumps(body).encode()
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(data))),
+        ])
+        return [data]
+
+    def scan(self, queries, columns, after_id=0):
+        """Yield the given columns of each row matching all queries, in id
+        order, starting after the row with id after_id."""
+        decoded = []
+        for field_name, query in queries.items():
+            decoded_query = decode_query(query)
+            if field_name not in SEARCH_FIELDS or decoded_query is None:
+                return
+            decoded.append((len(columns) + len(decoded), decoded_query))
+        select = list(columns) + [field_name for field_name in queries]
+        cursor = self.connection().execute(
+            'SELECT {} FROM {} WHERE id > ? ORDER BY id'.format(
+                ', '.join(select), TABLE), (after_id,))
+        for row in cursor:
+            if all(match_decoded(row[index], *query)
+                   for index, query in decoded):
+                yield row[:len(columns)]
+
+    def packets(self, params):
+        try:
+            after_id = int(params.pop('after_id', 0))
+            limit = params.pop('limit', None)
+            limit = None if limit is None else int(limit)
+        except ValueError:
+            raise HTTPError('403 FORBIDDEN', INVALID_PAGE)
+        if after_id < 0 or (limit is not None and limit < 0):
+            raise HTTPError('403 FORBIDDEN', INVALID_PAGE)
+        results = []
+        for row in self.scan(params, FIELDS, after_id):
+            if len(results) == limit:
+                break
+            packet = dict(zip(FIELDS, row))
+            if packet['captured_at'] is not None:
+                # Django stores UTC datetimes as 'YYYY-MM-DD HH:MM:SS'
+                packet['captured_at'] = packet['captured_at'].replace(
+                    ' ', 'T') + 'Z'
+            results.append(packet)
+        return results
+
+    def count(self, params):
+        return {'count': sum(1 for _ in self.scan(params, ('id',)))}
+
+    def correlate(self, params):
+        if set(params.keys()) != {'source', 'destination'}:
+            raise HTTPError('403 FORBIDDEN',
+                            'requires source and desination params')
+        srccount = self.count({'source': params['source']})['count']
+        if srccount == 0:
+            bothcount = 0
+            coef = 0
+        else:
+            bothcount = self.count(params)['count']
+            coef = bothcount / srccount
+        return {'coefficient': coef, 'source_count': srccount,
+                'both_count': bothcount}
+
+    def average(self, params):
+        modulus = params.pop('modulus', None)
+        generator = params.pop('generator', None)
+        if modulus is None or generator is None:
+            raise HTTPError('403 FORBIDDEN',
+                'must provide public key for homomorphic operations')
+        try:
+            key = paillier.PublicKey(int(modulus), int(generator))
+        except ValueError:
+            raise HTTPError('403 FORBIDDEN', 'invalid public key')
+        try:
+            lengths = [int(row[0]) for row in self.scan(params, ('length',))]
+        except ValueError:
+            raise HTTPError('500 INTERNAL SERVER ERROR',
+                            'invalid database state -- non-int packet lengths')
+        ctxt_sum, ctxt_count = paillier.average(key, lengths)
+        return {'sum': ctxt_sum, 'count': ctxt_count}
+
+application = LiteApplication()
+
+if __name__ == '__main__':
+    import sys
+    from wsgiref.simple_server import make_server
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    print('Serving encrypted queries on port {}'.format(port))
+    make_server('', port, application).serve_forever()
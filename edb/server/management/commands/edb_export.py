@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_models
+
+from edb.server.models import EncryptedModel, IndexEntry
+from edb.server.snapshots import write_snapshot
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Export every encrypted table, with its index postings, to a '
+            'binary snapshot file.')
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('usage: edb_export FILE')
+        models = [model for model in get_models()
+                  if issubclass(model, EncryptedModel)]
+        models.append(IndexEntry)
+        with open(args[0], 'wb') as wfile:
+            counts = write_snapshot(wfile, models)
+        for table, count in sorted(counts.items()):
+            self.stdout.write('{}: {} rows'.format(table, count))
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from edb.errors import EDBError
+from edb.server.snapshots import restore
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Load a snapshot written by edb_export into empty tables.'
+    option_list = BaseCommand.option_list + (
+        make_option('--flush', action='store_true', default=False,
+                    help='delete the rows of each table before loading it'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('usage: edb_import [--flush] FILE')
+        try:
+            with open(args[0], 'rb') as rfile:
+                counts = restore(rfile, flush=options['flush'])
+        except EDBError as err:
+            raise CommandError(str(err))
+        for table, count in sorted(counts.items()):
+            self.stdout.write('{}: {} rows'.format(table, count))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_models
+
+from edb.server.models import (EncryptedModel, IndexEntry, bump_version,
+                               compact_segments, segment_store)
+from edb.server.timerange import InvalidTimeRange, parse_time
+
+class Command(BaseCommand):
+    args = '<before>'
+    help = ('Delete rows captured before a time (an ISO 8601 datetime or '
+            'Unix timestamp) from every encrypted table with a time field.')
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('usage: edb_prune BEFORE')
+        try:
+            before = parse_time(args[0])
+        except InvalidTimeRange as err:
+            raise CommandError(err.detail)
+        for model in get_models():
+            if not issubclass(model, EncryptedModel) or not model.time_field:
+                continue
+            rows = model.objects.filter(
+                **{model.time_field + '__lt': before})
+            with transaction.atomic():
+                count = rows.count()
+                IndexEntry.objects.filter(table=model._meta.db_table,
+                                          row__in=rows.values('pk')).delete()
+                # a single indexed range DELETE, without loading each row
+                # to send delete signals
+                rows._raw_delete(rows.db)
+                if count:
+                    bump_version(model)
+            store = segment_store(model)
+            if store is not None and count:
+                store.discard(count)
+                if store.needs_compaction():
+                    compact_segments(model, store)
+            self.stdout.write('{}: deleted {} rows'.format(
+                model._meta.db_table, count))
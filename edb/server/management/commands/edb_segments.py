@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_models
+
+from edb.server.models import (EncryptedModel, compact_segments,
+                               rebuild_segments, segment_store)
+
+class Command(BaseCommand):
+    args = '<rebuild|compact>'
+    help = ('Rebuild the ciphertext segment stores from the database, '
+            'or compact those with enough dead records.')
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', default=False,
+                    help='compact every store, however few records are dead'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ('rebuild', 'compact'):
+            raise CommandError('usage: edb_segments rebuild|compact [--force]')
+        models = [model for model in get_models()
+                  if issubclass(model, EncryptedModel)]
+        for model in models:
+            store = segment_store(model)
+            if store is None:
+                raise CommandError('EDB_SEGMENT_DIR is not set')
+            if args[0] == 'rebuild':
+                rebuild_segments(model, store)
+            elif options['force'] or store.needs_compaction():
+                compact_segments(model, store)
+            self.stdout.write('{}: {} records'.format(
+                model._meta.db_table, store.records()))
@@ -0,0 +1,216 @@
+"""Server metrics in the Prometheus text format.
+
+Metrics are kept in memory per process. Each metric has its own lock, held
+only to update a dict entry, so recording is cheap. To aggregate across
+several worker processes, set EDB_METRICS_DIR to a shared directory: each
+process then saves a snapshot there (at most once a second, and on every
+scrape) and the /metrics view sums the snapshots of all processes.
+"""
+import os
+import json
+import time
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+
+# Upper bounds of the request latency buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+# Endpoint label of requests that matched no named route.
+OTHER_ENDPOINT = 'other'
+
+# Minimum time between snapshots saved to EDB_METRICS_DIR, in seconds.
+SAVE_INTERVAL = 1
+
+REGISTRY = []
+
+class Metric:
+    """Base class for a named metric with optional labels."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        """Return the current values as a JSON-serializable list."""
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, escape_label(value))
+                              for name, value in pairs) + '}'
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    @staticmethod
+    def merge(value, other):
+        return value + other
+
+    def lines(self, values):
+        for key, value in sorted(values.items()):
+            yield '{}{} {}'.format(self.name, self.format_labels(key), value)
+
+class Histogram(Metric):
+    """Distribution of observations over fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        key = self.key(labels)
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                # one count per bucket, then the sum and total count
+                value = self.values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    value[index] += 1
+            value[-2] += amount
+            value[-1] += 1
+
+    @staticmethod
+    def merge(value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def lines(self, values):
+        for key, value in sorted(values.items()):
+            for bound, count in zip(self.buckets, value):
+                labels = self.format_labels(key, [('le', bound)])
+                yield '{}_bucket{} {}'.format(self.name, labels, count)
+            labels = self.format_labels(key, [('le', '+Inf')])
+            yield '{}_bucket{} {}'.format(self.name, labels, value[-1])
+            labels = self.format_labels(key)
+            yield '{}_sum{} {}'.format(self.name, labels, value[-2])
+            yield '{}_count{} {}'.format(self.name, labels, value[-1])
+
+REQUEST_LATENCY = Histogram('edb_request_duration_seconds',
+                            'Request latency by endpoint.', ['endpoint'])
+ROWS_SCANNED = Counter('edb_rows_scanned_total',
+                       'Rows examined by encrypted scans.')
+ROWS_MATCHED = Counter('edb_rows_matched_total',
+                       'Rows matched by encrypted scans.')
+INGEST_ROWS = Counter('edb_ingest_rows_total',
+                      'Rows written to encrypted tables.')
+PAILLIER_OPS = Counter('edb_paillier_operations_total',
+                       'Paillier operations performed by the server.',
+                       ['op'])
+
+def snapshot():
+    """Return this process's metric values keyed by metric name."""
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+def merged_values():
+    """Return {name: {labels: value}} summed over all processes."""
+    directory = getattr(settings, 'EDB_METRICS_DIR', None)
+    if directory:
+        save_snapshot(force=True)
+        snapshots = []
+        for name in os.listdir(directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as rfile:
+                    snapshots.append(json.load(rfile))
+            except (OSError, ValueError):
+                # a snapshot being replaced; skip it this time
+                continue
+    else:
+        snapshots = [snapshot()]
+    merged = {}
+    for metric in REGISTRY:
+        values = merged[metric.name] = {}
+        for process in snapshots:
+            for key, value in process.get(metric.name, ()):
+                key = tuple(key)
+                if key in values:
+                    values[key] = metric.merge(values[key], value)
+                else:
+                    values[key] = value
+    return merged
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    merged = merged_values()
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        lines.extend(metric.lines(merged[metric.name]))
+    return '\n'.join(lines) + '\n'
+
+_last_save = 0
+
+def save_snapshot(force=False):
+    """Save this process's snapshot to EDB_METRICS_DIR, if set."""
+    global _last_save
+    directory = getattr(settings, 'EDB_METRICS_DIR', None)
+    now = time.time()
+    if not directory or (not force and now - _last_save < SAVE_INTERVAL):
+        return
+    _last_save = now
+    path = os.path.join(directory, '{}.json'.format(os.getpid()))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as wfile:
+        json.dump(snapshot(), wfile)
+    os.replace(tmp_path, path)
+
+def escape_label(value):
+    """Escape a label value for the text exposition format."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def endpoint_label(request):
+    """Return the name of the route a request resolved to.
+
+    Requests for unknown URLs, or routes without names, all share the label
+    OTHER_ENDPOINT, so that clients cannot create a series per path.
+
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.url_name:
+        return OTHER_ENDPOINT
+    return match.url_name
+
+class MetricsMiddleware:
+    """Record the latency of each request."""
+
+    def process_request(self, request):
+        request._edb_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        start = getattr(request, '_edb_start', None)
+        if start is not None:
+            REQUEST_LATENCY.observe(time.perf_counter() - start,
+                                    endpoint=endpoint_label(request))
+            save_snapshot()
+        return response
+
+def metrics_view(request):
+    """Serve all metrics to a Prometheus scraper."""
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4')
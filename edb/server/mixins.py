@@ -1,11 +1,101 @@
+from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.exceptions import APIException
+
+from edb.server import deadlines, index, writer
+from edb.server.coalesce import coalesce, mark
+from edb.server.deadlines import mark_partial, pop_deadline
+from edb.server.etags import conditional_response
+from edb.server.stats import ScanStats, annotate, pop_explain
+from edb.server.timerange import pop_time_range
+
+class InvalidPage(APIException):
+    status_code = 403
+    default_detail = "after_id and limit must be non-negative integers"
+
+def pop_page(params):
+    """Remove the paging options from params.
+
+    Return (filters, limit): the filter for rows after the after_id option,
+    and the maximum number of rows, or None.
+
+    """
+    try:
+        after_id = int(params.pop('after_id', 0))
+        limit = params.pop('limit', None)
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        raise InvalidPage
+    if after_id < 0 or (limit is not None and limit < 0):
+        raise InvalidPage
+    return ({'pk__gt': after_id} if after_id else {}), limit
 
 class EncryptedSearchMixin:
-    """Mix into a ViewSet to allow encrypted GET search queries."""
+    """Mix into a ViewSet to allow encrypted GET search queries.
+
+    Results can be paged through in id order with the after_id and limit
+    options, and are sent with an ETag for conditional requests. New rows
+    are inserted through the group-commit writer.
+
+    """
 
     def list(self, request):
+        return conditional_response(request, self.model,
+                                    lambda: self.search(request))
+
+    def search(self, request):
         params = request.QUERY_PARAMS.dict()
-        results = self.model.objects.encrypted_filter(**params)
-        serializer = self.serializer_class(results, many=True)
-        return Response(serializer.data)
+        explain = pop_explain(params)
+        stats = ScanStats()
+        query = dict(params)
+        deadline, partial = pop_deadline(params)
+        filters = pop_time_range(params, self.model)
+        page, limit = pop_page(params)
+        filters.update(page)
+        tags = index.pop_tags(params, self.model)
+
+        def scan():
+            ids = None if tags is None else index.lookup(self.model, tags)
+            results, scanned = deadlines.scan(self.model.objects, params,
+                                              stats, deadline, partial, ids,
+                                              filters, limit)
+            with stats.phase('serialize'):
+                serializer = self.serializer_class(results, many=True)
+                return serializer.data, scanned
+
+        endpoint = self.model._meta.db_table + '.list'
+        (data, scanned), stats, shared = coalesce(endpoint, query, scan,
+                                                  stats)
+        response = annotate(Response(data), stats, explain)
+        return mark(mark_partial(response, scanned), shared)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.DATA,
+                                         files=request.FILES)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+        self.pre_save(serializer.object)
+        tags = request.DATA.get(index.INDEX_PARAM)
+        # the index postings commit along with the row
+        self.object = writer.save(
+            serializer.object,
+            lambda obj: index.save_tags(type(obj), obj.pk, tags))
+        self.post_save(self.object, created=True)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers=headers)
+
+    def pre_save(self, obj):
+        super().pre_save(obj)
+        tags = self.request.DATA.get(index.INDEX_PARAM)
+        if tags is not None:
+            index.parse_tags(tags)
+
+    def post_save(self, obj, created=False):
+        super().post_save(obj, created)
+        if not created:
+            index.update_tags(type(obj), obj.pk,
+                              self.request.DATA.get(index.INDEX_PARAM),
+                              self.request.DATA.keys())
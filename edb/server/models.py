@@ -1,22 +1,331 @@
+import os
+import time
+import itertools
+
+from django.conf import settings
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from edb.errors import QueryTimeout
+from edb.server import metrics, writer
+from edb.server.segments import SegmentStore
+from edb.server.stats import ScanStats
+from edb.server.util import decode_query, decode_field, match_ciphertext
+
+# Maximum ids per IN clause when loading segment scan candidates.
+FETCH_BATCH = 500
+
+# Rows fetched from the database per step of an encrypted scan.
+SCAN_CHUNK = 1000
+
+# Search modes of encrypted models; see EncryptedModel.search_mode.
+SCAN = 'scan'
+INDEX = 'index'
+
+_segment_stores = {}
+
+def segment_store(model):
+    """Return the segment store for an encrypted model, or None.
 
-from edb.server.util import match
+    Segment stores are enabled by setting EDB_SEGMENT_DIR to a directory.
+
+    """
+    directory = getattr(settings, 'EDB_SEGMENT_DIR', None)
+    if not directory:
+        return None
+    table = model._meta.db_table
+    store = _segment_stores.get(table)
+    if store is None:
+        store = SegmentStore(os.path.join(directory, table),
+                             model.searchable_fields())
+        _segment_stores[table] = store
+    return store
 
 class EncryptedManager(models.Manager):
     """Object manager for encrypted models."""
     def encrypted_filter(self, **queries):
         """Filter on encrypted data."""
-        return [model for model in self.all()
-                if all(match(getattr(model, field_name, None), query)
-                       for field_name, query in queries.items())]
+        return self.encrypted_scan(queries)
+
+    def encrypted_scan(self, queries, stats=None, deadline=None, ids=None,
+                       filters=None, limit=None, visit=None):
+        """Return the rows matching every encrypted query.
+
+        Parameters:
+
+        queries
+          dict mapping field names to base64 query tokens
+
+        stats (optional)
+          ScanStats to record rows scanned and matched and per-phase times
+
+        deadline (optional)
+          time.monotonic() value after which the scan stops between chunks,
+          or between segments of the segment store, and raises QueryTimeout
+          with the partial results
+
+        ids (optional)
+          collection of row ids to restrict the scan to
+
+        filters (optional)
+          dict of plaintext queryset filters, such as a time range, applied
+          in SQL before any row is matched
+
+        limit (optional)
+          maximum number of rows to return; the scan stops once it has them
+
+        visit (optional)
+          function called with each chunk of matching rows, as part of the
+          match phase, so that the deadline also bounds work done per row
+
+        Rows are scanned in id order. Filtered scans skip the segment store,
+        since an indexed range usually selects far fewer rows than it holds.
+
+        """
+        if stats is None:
+            stats = ScanStats()
+        scanned, matched = stats.rows_scanned, stats.rows_matched
+        decoded = []
+        for field_name, query in queries.items():
+            decoded_query = decode_query(query)
+            if decoded_query is None:
+                return []
+            decoded.append((field_name, decoded_query))
+        queryset = self.filter(**filters) if filters else self.all()
+        store = segment_store(self.model)
+        use_store = (ids is None and not filters and decoded
+                     and store is not None
+                     and all(field_name in store.fields
+                             for field_name, _ in decoded))
+        # set when the segment scan expired: the candidates it found are
+        # still checked, then the scan raises QueryTimeout
+        expired = None
+        if use_store:
+            with stats.phase('segment_scan'):
+                try:
+                    ids = store.scan(decoded, stats, deadline)
+                except QueryTimeout as err:
+                    ids, expired = err.results, err
+        if ids is not None:
+            rows = self.fetch(ids, queryset)
+        else:
+            rows = queryset.order_by('pk').iterator()
+        results = []
+        scanned_range = None
+        while True:
+            with stats.phase('fetch'):
+                chunk = list(itertools.islice(rows, SCAN_CHUNK))
+            if not chunk:
+                break
+            if (expired is None and deadline is not None
+                    and time.monotonic() >= deadline):
+                self._count_scan(stats, scanned, matched, len(results))
+                raise QueryTimeout(results, scanned_range)
+            first = scanned_range[0] if scanned_range else chunk[0].pk
+            scanned_range = (first, chunk[-1].pk)
+            if not use_store:
+                stats.rows_scanned += len(chunk)
+            with stats.phase('decode'):
+                ciphertexts = [[decode_field(getattr(model, field_name, None))
+                                for field_name, _ in decoded]
+                               for model in chunk]
+            with stats.phase('match'):
+                start = len(results)
+                for model, fields in zip(chunk, ciphertexts):
+                    if all(ciphertext is not None
+                           and match_ciphertext(ciphertext, *query)
+                           for ciphertext, (_, query) in zip(fields, decoded)):
+                        results.append(model)
+                if limit is not None:
+                    del results[limit:]
+                if visit is not None:
+                    visit(results[start:])
+            if limit is not None and len(results) >= limit:
+                break
+        self._count_scan(stats, scanned, matched, len(results))
+        if expired is not None:
+            raise QueryTimeout(results, expired.scanned)
+        return results
+
+    def _count_scan(self, stats, scanned, matched, results):
+        stats.rows_matched += results
+        metrics.ROWS_SCANNED.inc(stats.rows_scanned - scanned)
+        metrics.ROWS_MATCHED.inc(stats.rows_matched - matched)
+
+    def fetch(self, ids, queryset=None):
+        """Yield the rows with the given ids, in batches."""
+        if queryset is None:
+            queryset = self.all()
+        ids = sorted(ids)
+        for start in range(0, len(ids), FETCH_BATCH):
+            batch = ids[start:start + FETCH_BATCH]
+            yield from queryset.filter(pk__in=batch).order_by('pk')
 
 class EncryptedModel(models.Model):
     """Abstract base class for an encrypted model."""
     objects = EncryptedManager()
 
+    # Names of the fields encrypted with Song et al.'s scheme, or None to
+    # use every CharField.
+    encrypted_fields = None
+
+    # Names of the fields holding Paillier ciphertexts.
+    paillier_fields = ()
+
+    # Name of an indexed plaintext timestamp field that queries can limit
+    # with since/until, or None.
+    time_field = None
+
+    # SCAN to only search by matching tokens against every row, or INDEX to
+    # also keep the keyword tags sent with rows in an encrypted inverted
+    # index (see edb.server.index for what this reveals).
+    search_mode = SCAN
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def searchable_fields(cls):
+        if cls.encrypted_fields is not None:
+            return tuple(cls.encrypted_fields)
+        return tuple(field.name for field in cls._meta.fields
+                     if isinstance(field, models.CharField))
+
+class IndexEntry(models.Model):
+    """Posting of a row under one keyword tag of the encrypted index."""
+    table = models.CharField(max_length=100)
+    tag = models.CharField(max_length=64)
+    row = models.IntegerField()
+
+    class Meta:
+        index_together = [('table', 'tag'), ('table', 'row')]
+
+class Subscription(models.Model):
+    """Standing encrypted query evaluated against each new row."""
+    table = models.CharField(max_length=100, db_index=True)
+    # JSON object mapping field names to base64 query tokens
+    queries = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+class TableVersion(models.Model):
+    """Count of writes to an encrypted table, from which ETags are made."""
+    table = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+
+def table_version(model):
+    """Return the current write version of a model's table."""
+    versions = TableVersion.objects.filter(table=model._meta.db_table)
+    return versions.values_list('version', flat=True).first() or 0
+
+def bump_version(model):
+    """Record a write to a model's table, changing the ETags of its queries.
+
+    Call this once the write is visible to readers (or inside the same
+    transaction), so that no ETag is ever paired with older rows.
+
+    """
+    versions = TableVersion.objects.filter(table=model._meta.db_table)
+    if versions.update(version=F('version') + 1):
+        return
+    _, created = TableVersion.objects.get_or_create(
+        table=model._meta.db_table, defaults={'version': 1})
+    if not created:
+        versions.update(version=F('version') + 1)
+
+class SubscriptionMatch(models.Model):
+    """New row matching a subscription, kept until the subscriber has it."""
+    subscription = models.ForeignKey(Subscription, related_name='matches')
+    row = models.IntegerField()
+
+@receiver(connection_created)
+def _configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and getattr(settings, 'EDB_SQLITE_WAL',
+                                                 False):
+        # persistent in the database file; a no-op for in-memory databases
+        connection.cursor().execute('PRAGMA journal_mode=WAL')
+
+@receiver(post_save)
+def _count_ingest(sender, created, **kwargs):
+    if created and issubclass(sender, EncryptedModel):
+        writer.on_commit(metrics.INGEST_ROWS.inc)
+
+@receiver(post_save)
+def _bump_saved(sender, **kwargs):
+    if issubclass(sender, EncryptedModel):
+        bump_version(sender)
+
+@receiver(post_delete)
+def _bump_deleted(sender, **kwargs):
+    if issubclass(sender, EncryptedModel):
+        bump_version(sender)
+
+@receiver(post_save)
+def _evaluate_subscriptions(sender, instance, created, **kwargs):
+    if created and issubclass(sender, EncryptedModel):
+        from edb.server import subscriptions
+        subscriptions.evaluate(sender, [instance])
+
+@receiver(post_save)
+def _append_segment(sender, instance, created, **kwargs):
+    if not issubclass(sender, EncryptedModel):
+        return
+    store = segment_store(sender)
+    if store is None:
+        return
+    values = {name: getattr(instance, name) for name in store.fields}
+    pk = instance.pk
+
+    def append():
+        store.append(pk, values)
+        if not created:
+            store.discard()
+    writer.on_commit(append)
+
+@receiver(post_delete)
+def _delete_postings(sender, instance, **kwargs):
+    if issubclass(sender, EncryptedModel) and sender.search_mode == INDEX:
+        IndexEntry.objects.filter(table=sender._meta.db_table,
+                                  row=instance.pk).delete()
+
+@receiver(post_delete)
+def _delete_segment(sender, instance, **kwargs):
+    if not issubclass(sender, EncryptedModel):
+        return
+    store = segment_store(sender)
+    if store is not None:
+        store.discard()
+
+def compact_segments(model, store):
+    """Compact a model's segment store against the rows in the database.
+
+    Compaction locks the store for every process, so it is left to the
+    edb_segments command rather than run while serving requests.
+
+    """
+    def live_ids(ids):
+        return set(model.objects.filter(pk__in=ids)
+                   .values_list('pk', flat=True))
+    store.compact(live_ids)
+
+# Rows appended to a segment store at a time by rebuild_segments.
+REBUILD_BATCH = 1000
+
+def rebuild_segments(model, store):
+    """Replace a model's segment store with the rows in the database."""
+    with store.locked():
+        store.clear()
+        batch = []
+        for row in model.objects.all().iterator():
+            values = {name: getattr(row, name) for name in store.fields}
+            batch.append((row.pk, values))
+            if len(batch) >= REBUILD_BATCH:
+                store.extend(batch)
+                batch = []
+        store.extend(batch)
+
 class _Ping(EncryptedModel):
     """Concrete model for test cases."""
     source = models.CharField(max_length=700)
@@ -0,0 +1,45 @@
+"""Request profiling middleware.
+
+Enabled by setting EDB_PROFILE_DIR to a directory. A random
+EDB_PROFILE_SAMPLE fraction of requests is profiled with cProfile and the
+stack sampler. If EDB_PROFILE_THRESHOLD_MS is set, every other request is
+stack-sampled, which is cheap since one thread samples them all, and its
+profile kept only if it took longer than the threshold. See edb.profiling for the files written.
+"""
+import os
+import time
+import random
+
+from django.conf import settings
+
+from edb.profiling import Profile
+from edb.server.metrics import endpoint_label
+
+class ProfilingMiddleware:
+    """Profile a sample of requests, or those slower than a threshold."""
+
+    def process_request(self, request):
+        directory = getattr(settings, 'EDB_PROFILE_DIR', None)
+        if not directory:
+            return
+        sample = getattr(settings, 'EDB_PROFILE_SAMPLE', 0)
+        threshold = getattr(settings, 'EDB_PROFILE_THRESHOLD_MS', None)
+        if sample and random.random() < sample:
+            request._edb_profile = Profile().start()
+            request._edb_profile_threshold = None
+        elif threshold is not None:
+            request._edb_profile = Profile(deterministic=False).start()
+            request._edb_profile_threshold = threshold / 1000
+
+    def process_response(self, request, response):
+        profile = getattr(request, '_edb_profile', None)
+        if profile is None:
+            return response
+        profile.stop()
+        threshold = request._edb_profile_threshold
+        if threshold is None or profile.elapsed > threshold:
+            name = '{}-{}-{}-{}ms'.format(
+                time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+                endpoint_label(request), int(profile.elapsed * 1000))
+            profile.write(os.path.join(settings.EDB_PROFILE_DIR, name))
+        return response
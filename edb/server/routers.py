@@ -0,0 +1,37 @@
+"""Database routing for separate read connections.
+
+If DATABASES has a READ_ALIAS entry for the same database, queries read
+through its connections while writes go to the default alias. Django keeps
+one connection per thread and alias, so an ingest transaction holding the
+default connection never makes a scan wait for it; with SQLite in WAL mode
+(EDB_SQLITE_WAL), readers see the last commit while a write is under way.
+
+Reads inside a transaction on the default alias stay on it, so that a
+transaction always sees its own writes.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+READ_ALIAS = 'read'
+
+class ReadRouter:
+    """Send reads to READ_ALIAS and writes to the default database."""
+
+    def db_for_read(self, model, **hints):
+        if READ_ALIAS not in settings.DATABASES:
+            return None
+        if transaction.get_connection(DEFAULT_DB_ALIAS).in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return READ_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases are the same database
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db == DEFAULT_DB_ALIAS
+
+    allow_migrate = allow_syncdb
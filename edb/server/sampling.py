@@ -0,0 +1,135 @@
+"""Approximate queries over a uniform random sample of rows.
+
+Requests to the count and average endpoints can pass `approx=<fraction>`
+or `approx_rows=<n>` to match the query tokens against a random sample of
+rows instead of the whole table. Counts are scaled up to the table size
+and returned with a confidence interval; averages are computed from the
+sample alone.
+"""
+import math
+import random
+
+from django.db.models import Max, Min
+from rest_framework.exceptions import APIException
+
+# z-score of the reported confidence interval
+CONFIDENCE = 0.95
+Z_SCORE = 1.96
+
+class InvalidSample(APIException):
+    status_code = 403
+    default_detail = ("approx must be a fraction in (0, 1] and approx_rows "
+                      "a positive integer")
+
+def pop_sample(params):
+    """Remove the sampling options from params.
+
+    Return (fraction, rows), both None for an exact query.
+
+    """
+    fraction = params.pop('approx', None)
+    rows = params.pop('approx_rows', None)
+    try:
+        if fraction is not None:
+            fraction = float(fraction)
+            if not 0 < fraction <= 1:
+                raise InvalidSample
+        if rows is not None:
+            rows = int(rows)
+            if rows <= 0:
+                raise InvalidSample
+    except ValueError:
+        raise InvalidSample
+    return fraction, rows
+
+# Rounds of random id probes before sample_ids falls back to sorting the
+# rows randomly in the database, and the fewest existing rows per id in the
+# table's id range for probing to be worth it.
+PROBE_ROUNDS = 8
+MIN_DENSITY = 0.05
+
+# Most ids in one pk__in lookup, under SQLite's limit on query parameters.
+PROBE_BATCH = 500
+
+def sample_ids(manager, fraction=None, rows=None, filters=None):
+    """Return (ids, total): a uniform random sample of row ids.
+
+    If filters are given, only rows matching them are sampled and counted.
+    Rather than loading every id, random ids between the smallest and
+    largest are probed and those of existing rows kept, which picks each
+    row with the same chance. Small or sparse id ranges, and samples of most
+    of the rows, are drawn with ORDER BY RANDOM() in the database instead.
+
+    """
+    queryset = manager.filter(**filters) if filters else manager.all()
+    total = queryset.count()
+    size = total
+    if fraction is not None:
+        size = min(size, int(math.ceil(total * fraction)))
+    if rows is not None:
+        size = min(size, rows)
+    if size == 0:
+        return [], total
+    if size == total:
+        return list(queryset.values_list('pk', flat=True)), total
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    span = high - low + 1
+    ids = set()
+    if 2 * size <= total and total >= MIN_DENSITY * span:
+        for _ in range(PROBE_ROUNDS):
+            need = size - len(ids)
+            if need <= 0:
+                break
+            probes = min(span, int(math.ceil(need * span / total * 1.25)) + 8)
+            candidates = random.sample(range(low, high + 1), probes)
+            for start in range(0, len(candidates), PROBE_BATCH):
+                batch = candidates[start:start + PROBE_BATCH]
+                ids.update(queryset.filter(pk__in=batch)
+                                   .values_list('pk', flat=True))
+    if len(ids) < size:
+        return list(queryset.order_by('?').values_list('pk', flat=True)
+                            [:size]), total
+    return random.sample(sorted(ids), size), total
+
+def sampled_rows(ids, scanned):
+    """Return how many sampled ids a (possibly partial) scan examined."""
+    if scanned is None:
+        return len(ids)
+    last = scanned[1]
+    return 0 if last is None else sum(1 for pk in ids if pk <= last)
+
+def estimate_count(matched, sampled, total):
+    """Return (estimate, low, high) of the matching rows in the table.
+
+    Uses the Wilson score interval, which stays wide when the sample has no
+    matches or only matches, with a finite population correction, and
+    clips the interval to the counts the sample allows.
+
+    """
+    if sampled == 0:
+        return 0, 0, 0
+    proportion = matched / sampled
+    estimate = int(round(total * proportion))
+    correction = (total - sampled) / (total - 1) if total > 1 else 0
+    if correction <= 0:
+        # the whole table was sampled
+        return estimate, estimate, estimate
+    # the corrected sample counts as this many draws with replacement
+    draws = sampled / correction
+    z_squared = Z_SCORE * Z_SCORE
+    scale = 1 + z_squared / draws
+    center = (proportion + z_squared / (2 * draws)) / scale
+    error = Z_SCORE / scale * math.sqrt(
+        proportion * (1 - proportion) / draws
+        + z_squared / (4 * draws * draws))
+    low = max(matched, int(math.floor(total * (center - error))))
+    high = min(total - (sampled - matched),
+               int(math.ceil(total * (center + error))))
+    return estimate, low, high
+
+def approximate(data, sampled, total):
+    """Add the sample description to a response body."""
+    data.update(approximate=True, sampled=sampled, total=total,
+                confidence=CONFIDENCE)
+    return data
@@ -0,0 +1,348 @@
+"""Append-only segment files of fixed-width ciphertexts.
+
+Song et al.'s scheme has to check every row's ciphertext, so the cheapest
+layout for a scan is a dense file of fixed-width records. A SegmentStore keeps
+one record per row: the row id as an unsigned 64-bit little-endian integer,
+followed by the raw (unsalted, decoded) ciphertext of each searchable field.
+
+Records are appended to an active segment, which is sealed once it reaches
+the size threshold. Scans map each segment with mmap and, if NumPy is
+installed, match a whole segment through array views of the mapped file.
+
+The database remains the source of truth: a scan only returns candidate ids,
+which the caller must load and re-check. Updated rows are appended again and
+deleted rows are left in place until the next compaction, which keeps the
+newest record of each live id.
+
+Several server processes may share a directory, so the count of dead records
+is kept in a file beside the segments, and appends, compaction and rebuilds
+hold an exclusive lock on the directory's lock file while they run. Scans
+hold a shared lock only while they list and open the segments, and then read
+from the open files, which renames and removals leave in place.
+"""
+
+import os
+import mmap
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from edb import crypto
+from edb.errors import QueryTimeout
+from edb.constants import BLOCK_BYTES, MATCH_BYTES, LEFT_BYTES
+from edb.server.util import decode_field, match_ciphertext
+
+ID_BYTES = 8
+SEAL_BYTES = 64 * 1024 * 1024
+SEALED_SUFFIX = '.seg'
+ACTIVE_SUFFIX = '.active'
+DEAD_FILE = 'dead'
+LOCK_FILE = 'lock'
+# Compact a segment store once this fraction of its records is dead.
+COMPACT_RATIO = 0.25
+# Maximum ids checked against the database at a time while compacting.
+COMPACT_BATCH = 1000
+
+class SegmentStore:
+    """Fixed-width ciphertext segments for one table.
+
+    Parameters:
+
+    directory
+      directory holding this table's segment files
+
+    fields
+      names of the searchable fields stored in each record
+
+    seal_bytes (optional)
+      size at which the active segment is sealed
+
+    """
+
+    def __init__(self, directory, fields, seal_bytes=SEAL_BYTES):
+        self.directory = directory
+        self.fields = tuple(fields)
+        self.record_bytes = ID_BYTES + BLOCK_BYTES * len(self.fields)
+        self.seal_bytes = seal_bytes
+        self.lock = threading.RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        """Hold the store's lock, shared with other processes."""
+        with self.lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                self._lock_file = open(
+                    os.path.join(self.directory, LOCK_FILE), 'a')
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    # closing the file releases the lock
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    @contextmanager
+    def shared(self):
+        """Hold a shared lock, keeping other processes from changing the
+        segment files."""
+        if fcntl is None:
+            with self.lock:
+                yield
+            return
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lfile:
+            fcntl.flock(lfile, fcntl.LOCK_SH)
+            yield
+
+    @property
+    def dead(self):
+        """The number of records superseded since the last compaction."""
+        try:
+            with open(os.path.join(self.directory, DEAD_FILE)) as dfile:
+                return int(dfile.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _set_dead(self, count):
+        path = os.path.join(self.directory, DEAD_FILE)
+        with open(path + '.tmp', 'w') as dfile:
+            dfile.write(str(count))
+        os.replace(path + '.tmp', path)
+
+    def segments(self):
+        """Return the paths of all segments, oldest first."""
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith((SEALED_SUFFIX, ACTIVE_SUFFIX))]
+        names.sort(key=lambda name: int(name.split('.')[0]))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def records(self):
+        """Return the number of records stored, including dead ones."""
+        return sum(os.path.getsize(path) // self.record_bytes
+                   for path in self.segments())
+
+    def append(self, pk, values):
+        """Append the record for row pk, given its base64 field values."""
+        self.extend([(pk, values)])
+
+    def extend(self, rows):
+        """Append records for many (pk, values) pairs."""
+        data = b''.join(self.pack(pk, values) for pk, values in rows)
+        with self.locked():
+            path = self._active_path()
+            with open(path, 'ab') as afile:
+                afile.write(data)
+            if os.path.getsize(path) >= self.seal_bytes:
+                self.seal()
+
+    def discard(self, count=1):
+        """Note that count records were superseded by updates or deletes."""
+        with self.locked():
+            self._set_dead(self.dead + count)
+
+    def needs_compaction(self, ratio=COMPACT_RATIO):
+        """Return whether more than ratio of the records are dead."""
+        return self.dead > ratio * self.records()
+
+    def clear(self):
+        """Remove every segment."""
+        with self.locked():
+            for path in self.segments():
+                os.remove(path)
+            self._set_dead(0)
+
+    def seal(self):
+        """Seal the active segment, if any."""
+        with self.locked():
+            for path in self.segments():
+                if path.endswith(ACTIVE_SUFFIX):
+                    os.rename(path, path[:-len(ACTIVE_SUFFIX)] + SEALED_SUFFIX)
+
+    def pack(self, pk, values):
+        """Return the fixed-width record for a row."""
+        parts = [int(pk).to_bytes(ID_BYTES, 'little')]
+        for field_name in self.fields:
+            parts.append(self._ciphertext(values.get(field_name)))
+        return b''.join(parts)
+
+    def scan(self, queries, stats=None, deadline=None):
+        """Return the set of candidate ids matching every query.
+
+        The queries parameter is a sequence of (field_name, (preword,
+        word_key)) pairs, as returned by util.decode_query. If stats is given,
+        the number of records examined is added to its rows_scanned.
+
+        If deadline, a time.monotonic() value, passes, the scan stops before
+        the next segment and raises QueryTimeout with the candidates found so
+        far and the lowest and highest ids at the ends of the segments
+        examined (None if there were none).
+
+        """
+        columns = [(ID_BYTES + BLOCK_BYTES * self.fields.index(field_name),
+                    preword, word_key)
+                   for field_name, (preword, word_key) in queries]
+        ids = set()
+        bounds = []
+        with self.shared():
+            files = [open(path, 'rb') for path in self.segments()]
+        try:
+            for sfile in files:
+                if deadline is not None and time.monotonic() >= deadline:
+                    scanned = (min(bounds), max(bounds)) if bounds else None
+                    raise QueryTimeout(ids, scanned)
+                count = os.fstat(sfile.fileno()).st_size // self.record_bytes
+                if count == 0:
+                    continue
+                if stats is not None:
+                    stats.rows_scanned += count
+                with mmap.mmap(sfile.fileno(), 0,
+                               access=mmap.ACCESS_READ) as buf:
+                    if numpy is not None:
+                        ids.update(self._scan_numpy(buf, count, columns))
+                    else:
+                        ids.update(self._scan_python(buf, count, columns))
+                    last = (count - 1) * self.record_bytes
+                    bounds.append(int.from_bytes(buf[:ID_BYTES], 'little'))
+                    bounds.append(int.from_bytes(
+                        buf[last:last + ID_BYTES], 'little'))
+        finally:
+            for sfile in files:
+                sfile.close()
+        return ids
+
+    def compact(self, live_ids):
+        """Rewrite all segments, keeping the newest record of each live id.
+
+        The live_ids parameter is a function taking a list of at most
+        COMPACT_BATCH ids and returning the set of those that still exist.
+
+        """
+        with self.locked():
+            self.seal()
+            old_paths = self.segments()
+            latest = {}
+            for number, path in enumerate(old_paths):
+                for offset, pk in self._read_ids(path):
+                    latest[pk] = (number, offset)
+            ids = list(latest)
+            for start in range(0, len(ids), COMPACT_BATCH):
+                batch = ids[start:start + COMPACT_BATCH]
+                live = live_ids(batch)
+                for pk in batch:
+                    if pk not in live:
+                        del latest[pk]
+            del ids
+            next_number = self._next_number()
+            out_path, out_file = None, None
+            try:
+                for number, path in enumerate(old_paths):
+                    with open(path, 'rb') as sfile:
+                        for offset, pk in self._read_ids(path):
+                            if latest.get(pk) != (number, offset):
+                                continue
+                            if out_file is None:
+                                out_path = os.path.join(self.directory,
+                                    str(next_number) + ACTIVE_SUFFIX)
+                                out_file = open(out_path, 'wb')
+                                next_number += 1
+                            sfile.seek(offset)
+                            out_file.write(sfile.read(self.record_bytes))
+                            if out_file.tell() >= self.seal_bytes:
+                                out_file.close()
+                                self._seal_path(out_path)
+                                out_file = None
+            finally:
+                if out_file is not None:
+                    out_file.close()
+                    self._seal_path(out_path)
+            for path in old_paths:
+                os.remove(path)
+            self._set_dead(0)
+
+    def _scan_numpy(self, buf, count, columns):
+        records = numpy.frombuffer(buf, dtype=numpy.uint8,
+                                   count=count * self.record_bytes)
+        records = records.reshape(count, self.record_bytes)
+        candidates = numpy.arange(count)
+        for offset, preword, word_key in columns:
+            blocks = records[candidates, offset:offset + BLOCK_BYTES]
+            blocks ^= numpy.frombuffer(preword, dtype=numpy.uint8)
+            digests = b''.join(
+                crypto.prfunction(word_key, prefix.tobytes(), MATCH_BYTES)
+                for prefix in blocks[:, :LEFT_BYTES])
+            digests = numpy.frombuffer(digests, dtype=numpy.uint8)
+            digests = digests.reshape(-1, MATCH_BYTES)
+            matched = (digests == blocks[:, LEFT_BYTES:]).all(axis=1)
+            candidates = candidates[matched]
+            if len(candidates) == 0:
+                break
+        ids = records[candidates, :ID_BYTES].copy().view('<u8').ravel()
+        del records
+        return ids.tolist()
+
+    def _scan_python(self, buf, count, columns):
+        ids = []
+        view = memoryview(buf)
+        try:
+            for start in range(0, count * self.record_bytes,
+                               self.record_bytes):
+                for offset, preword, word_key in columns:
+                    ciphertext = bytes(view[start + offset:
+                                            start + offset + BLOCK_BYTES])
+                    if not match_ciphertext(ciphertext, preword, word_key):
+                        break
+                else:
+                    pk = bytes(view[start:start + ID_BYTES])
+                    ids.append(int.from_bytes(pk, 'little'))
+        finally:
+            view.release()
+        return ids
+
+    def _read_ids(self, path):
+        """Yield (offset, id) for each record in a segment."""
+        with open(path, 'rb') as sfile:
+            offset = 0
+            while True:
+                record = sfile.read(self.record_bytes)
+                if len(record) < self.record_bytes:
+                    return
+                yield offset, int.from_bytes(record[:ID_BYTES], 'little')
+                offset += self.record_bytes
+
+    def _ciphertext(self, b64field):
+        """Return the raw ciphertext of a field, or zeros if invalid."""
+        ciphertext = decode_field(b64field)
+        if ciphertext is None:
+            return b'\0' * BLOCK_BYTES
+        return ciphertext
+
+    def _active_path(self):
+        for path in self.segments():
+            if path.endswith(ACTIVE_SUFFIX):
+                return path
+        return os.path.join(self.directory,
+                            str(self._next_number()) + ACTIVE_SUFFIX)
+
+    def _next_number(self):
+        paths = self.segments()
+        if not paths:
+            return 1
+        return int(os.path.basename(paths[-1]).split('.')[0]) + 1
+
+    def _seal_path(self, path):
+        os.rename(path, path[:-len(ACTIVE_SUFFIX)] + SEALED_SUFFIX)
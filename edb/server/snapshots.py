@@ -0,0 +1,277 @@
+"""Binary snapshots of encrypted tables.
+
+A snapshot is a stream of table sections:
+
+    MAGIC
+    for each table:
+      b'T' u32 header length, JSON header {model, table, columns}
+      for each chunk of up to CHUNK_ROWS rows:
+        b'C' u32 rows, u32 payload length, payload, u32 CRC-32 of payload
+      b'E' u64 total rows
+    b'Z'
+
+All integers are little-endian. In the payload, each row is its id as a u64
+followed by one cell per column. A cell starts with a tag byte:
+
+    EMPTY    ''
+    BLOCK    the 2 * BLOCK_BYTES raw bytes of a base64 Song ciphertext
+    INTEGER  u16 length, then a big-endian unsigned integer (Paillier values)
+    TEXT     u32 length, then UTF-8 text, parsed back with the field
+    NULL     None
+
+Ciphertext columns are therefore fixed-width; a value that would not come
+back byte-for-byte from its compact form is stored as TEXT instead.
+"""
+import json
+import base64
+import struct
+import zlib
+
+from django.core.management.color import no_style
+from django.db import connection, router, transaction
+from django.db.models import get_model
+
+from edb.constants import BLOCK_BYTES
+from edb.errors import EDBError
+from edb.server import subscriptions
+from edb.server.models import (EncryptedModel, bump_version,
+                               rebuild_segments, segment_store)
+
+MAGIC = b'EDBSNAP1'
+
+# Rows per checksummed chunk, which is also the restore transaction size.
+CHUNK_ROWS = 5000
+
+EMPTY, BLOCK, INTEGER, TEXT, NULL = range(5)
+
+# Column kinds in the header.
+ID, CIPHERTEXT, PAILLIER, PLAIN = 'id', 'ciphertext', 'paillier', 'plain'
+
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+def columns(model):
+    """Return [(attname, kind)] of the columns of a model, id first."""
+    searchable, paillier = set(), set()
+    if issubclass(model, EncryptedModel):
+        searchable.update(model.searchable_fields())
+        paillier.update(model.paillier_fields)
+    result = [(model._meta.pk.attname, ID)]
+    for field in model._meta.fields:
+        if field.primary_key:
+            continue
+        if field.name in searchable:
+            kind = CIPHERTEXT
+        elif field.name in paillier:
+            kind = PAILLIER
+        else:
+            kind = PLAIN
+        result.append((field.attname, kind))
+    return result
+
+def write_snapshot(stream, models):
+    """Write the rows of each model to a binary stream.
+
+    Every table is read in one transaction, so a snapshot of a server that
+    is taking writes holds no index postings for rows it left out. Return
+    {table: rows written}.
+
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'postgresql':
+            # each statement would otherwise see the latest commits
+            connection.cursor().execute(
+                'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        return _write_tables(stream, models)
+
+def _write_tables(stream, models):
+    stream.write(MAGIC)
+    counts = {}
+    for model in models:
+        cols = columns(model)
+        header = json.dumps({
+            'model': '{}.{}'.format(model._meta.app_label,
+                                    model._meta.object_name),
+            'table': model._meta.db_table,
+            'columns': cols,
+        }).encode()
+        stream.write(b'T' + _u32.pack(len(header)) + header)
+        names = [name for name, _ in cols]
+        total, after = 0, None
+        while True:
+            rows = model.objects.order_by('pk')
+            if after is not None:
+                rows = rows.filter(pk__gt=after)
+            rows = list(rows.values_list(*names)[:CHUNK_ROWS])
+            if not rows:
+                break
+            payload = b''.join(_pack_row(row, cols) for row in rows)
+            stream.write(b'C' + _u32.pack(len(rows)) +
+                         _u32.pack(len(payload)) + payload +
+                         _u32.pack(zlib.crc32(payload)))
+            total += len(rows)
+            after = rows[-1][0]
+        stream.write(b'E' + _u64.pack(total))
+        counts[model._meta.db_table] = total
+    stream.write(b'Z')
+    return counts
+
+def read_snapshot(stream):
+    """Yield (model, rows) for each table section of a snapshot.
+
+    rows is an iterator over chunks, each a list of model instances; it
+    must be consumed before the next section is read. Raise EDBError if the
+    stream is not a valid snapshot or a chunk fails its checksum.
+
+    """
+    if _read(stream, len(MAGIC)) != MAGIC:
+        raise EDBError('not an EDB snapshot')
+    while True:
+        kind = _read(stream, 1)
+        if kind == b'Z':
+            return
+        if kind != b'T':
+            raise EDBError('corrupt snapshot: expected a table')
+        header = json.loads(_read(stream, _unpack(_u32, stream)).decode())
+        app_label, name = header['model'].split('.')
+        model = get_model(app_label, name)
+        if model is None:
+            raise EDBError('unknown model {}'.format(header['model']))
+        yield model, _read_chunks(stream, model, header['columns'])
+
+def restore(stream, flush=False):
+    """Load a snapshot, one transaction and bulk insert per chunk.
+
+    Tables must be empty unless flush is true, in which case their rows are
+    deleted first. Restored rows of encrypted models are matched against
+    subscriptions like any new rows, and their segment stores, if enabled,
+    are rebuilt. Return {table: rows loaded}.
+
+    """
+    counts = {}
+    models = []
+    for model, chunks in read_snapshot(stream):
+        if model.objects.exists():
+            if not flush:
+                raise EDBError('table {} is not empty'.format(
+                    model._meta.db_table))
+            model.objects.all()._raw_delete(router.db_for_write(model))
+        total = 0
+        for chunk in chunks:
+            with transaction.atomic():
+                model.objects.bulk_create(chunk)
+                # bulk_create sends no post_save, so match restored rows
+                # against standing queries here
+                if issubclass(model, EncryptedModel):
+                    subscriptions.evaluate(model, chunk)
+            total += len(chunk)
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+            cursor.execute(sql)
+        counts[model._meta.db_table] = total
+        models.append(model)
+        if issubclass(model, EncryptedModel):
+            # bulk_create skips the post_save that appends to the store
+            store = segment_store(model)
+            if store is not None:
+                rebuild_segments(model, store)
+    # once the index is loaded too, so no ETag pairs with half a restore
+    for model in models:
+        bump_version(model)
+    return counts
+
+def _pack_row(row, cols):
+    parts = [_u64.pack(row[0])]
+    for value, (_, kind) in zip(row[1:], cols[1:]):
+        parts.append(_pack_cell(value, kind))
+    return b''.join(parts)
+
+def _pack_cell(value, kind):
+    if value is None:
+        return bytes([NULL])
+    if value == '':
+        return bytes([EMPTY])
+    if kind == CIPHERTEXT:
+        try:
+            raw = base64.decodebytes(value.encode())
+        except (ValueError, TypeError):
+            raw = None
+        if (raw is not None and len(raw) == 2 * BLOCK_BYTES
+                and base64.encodebytes(raw).decode() == value):
+            return bytes([BLOCK]) + raw
+    elif kind == PAILLIER:
+        try:
+            number = int(value)
+        except ValueError:
+            number = None
+        if number is not None and number >= 0 and str(number) == value:
+            data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+            return bytes([INTEGER]) + _u16.pack(len(data)) + data
+    text = (value if isinstance(value, str) else str(value)).encode()
+    return bytes([TEXT]) + _u32.pack(len(text)) + text
+
+def _read_chunks(stream, model, cols):
+    fields = {field.attname: field for field in model._meta.fields}
+    names = [name for name, _ in cols]
+    total = 0
+    while True:
+        kind = _read(stream, 1)
+        if kind == b'E':
+            if _unpack(_u64, stream) != total:
+                raise EDBError('corrupt snapshot: row count mismatch in '
+                               '{}'.format(model._meta.db_table))
+            return
+        if kind != b'C':
+            raise EDBError('corrupt snapshot: expected a chunk')
+        count = _unpack(_u32, stream)
+        payload = _read(stream, _unpack(_u32, stream))
+        if zlib.crc32(payload) != _unpack(_u32, stream):
+            raise EDBError('corrupt snapshot: checksum mismatch in {}'.format(
+                model._meta.db_table))
+        view = memoryview(payload)
+        offset = 0
+        chunk = []
+        for _ in range(count):
+            pk = _u64.unpack_from(view, offset)[0]
+            offset += _u64.size
+            values = {names[0]: pk}
+            for name in names[1:]:
+                value, offset = _unpack_cell(view, offset)
+                if isinstance(value, str) and name in fields:
+                    value = fields[name].to_python(value)
+                values[name] = value
+            chunk.append(model(**values))
+        total += count
+        yield chunk
+
+def _unpack_cell(view, offset):
+    tag = view[offset]
+    offset += 1
+    if tag == NULL:
+        return None, offset
+    if tag == EMPTY:
+        return '', offset
+    if tag == BLOCK:
+        raw = bytes(view[offset:offset + 2 * BLOCK_BYTES])
+        return base64.encodebytes(raw).decode(), offset + 2 * BLOCK_BYTES
+    if tag == INTEGER:
+        length = _u16.unpack_from(view, offset)[0]
+        offset += _u16.size
+        number = int.from_bytes(bytes(view[offset:offset + length]), 'big')
+        return str(number), offset + length
+    if tag == TEXT:
+        length = _u32.unpack_from(view, offset)[0]
+        offset += _u32.size
+        return bytes(view[offset:offset + length]).decode(), offset + length
+    raise EDBError('corrupt snapshot: bad cell tag {}'.format(tag))
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise EDBError('truncated snapshot')
+    return data
+
+def _unpack(fmt, stream):
+    return fmt.unpack(_read(stream, fmt.size))[0]
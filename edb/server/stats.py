@@ -0,0 +1,65 @@
+"""Per-query timing breakdown and scan statistics.
+
+A ScanStats object is threaded through an encrypted query. Scans record the
+rows they examine and match, and time each phase per chunk of rows, so the
+overhead stays small enough to leave collection on.
+
+Stats are reported when the EDB_QUERY_STATS setting is true or the request
+has `explain=1`: as `Server-Timing` and `X-EDB-Rows-*` response headers, and,
+with `explain=1`, as an `explain` section of dict responses.
+"""
+import time
+import collections
+import contextlib
+
+from django.conf import settings
+
+class ScanStats:
+    """Timings and row counts for one encrypted query."""
+
+    def __init__(self):
+        self.rows_scanned = 0
+        self.rows_matched = 0
+        self.phases = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to the named phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def as_dict(self):
+        return {
+            'rows_scanned': self.rows_scanned,
+            'rows_matched': self.rows_matched,
+            'phases_ms': {name: round(seconds * 1000, 3)
+                          for name, seconds in self.phases.items()},
+        }
+
+    def headers(self):
+        """Return the response headers describing this query."""
+        timing = ', '.join('{};dur={:.3f}'.format(name, seconds * 1000)
+                           for name, seconds in self.phases.items())
+        return {
+            'Server-Timing': timing,
+            'X-EDB-Rows-Scanned': str(self.rows_scanned),
+            'X-EDB-Rows-Matched': str(self.rows_matched),
+        }
+
+def pop_explain(params):
+    """Remove the explain flag from query params and return it."""
+    return params.pop('explain', '0') not in ('', '0', 'false')
+
+def annotate(response, stats, explain=False):
+    """Attach stats to a response if enabled."""
+    if not (explain or getattr(settings, 'EDB_QUERY_STATS', False)):
+        return response
+    for header, value in stats.headers().items():
+        response[header] = value
+    if explain and isinstance(response.data, dict):
+        response.data['explain'] = stats.as_dict()
+    return response
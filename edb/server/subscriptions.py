@@ -0,0 +1,135 @@
+"""Standing queries matched against new rows as they are written.
+
+Instead of polling a search endpoint, which scans the whole table each time,
+a client can register its query tokens once as a subscription. Every row
+added afterwards is matched against the registered tokens only, and each
+hit is recorded until the subscriber collects it with a long-poll request.
+Rows saved one at a time are matched from the post_save signal; bulk paths
+that skip it call evaluate() themselves, as snapshot restores do. Bulk
+updates of existing rows are not matched, since subscriptions are for new
+rows.
+
+Waiting requests are woken as soon as a matched row commits in the same
+process; matches written by other server processes are picked up within
+POLL_INTERVAL.
+"""
+import json
+import math
+import time
+import threading
+
+from rest_framework.exceptions import APIException
+
+from edb.server import writer
+from edb.server.models import Subscription, SubscriptionMatch
+from edb.server.util import decode_query, match_decoded
+
+# Longest time a poll waits for new matches, in seconds.
+MAX_WAIT = 30
+
+# How often a waiting poll checks for matches from other processes.
+POLL_INTERVAL = 0.5
+
+# How long the subscriptions of a table are cached by each process.
+REFRESH_INTERVAL = 1.0
+
+_cache = {}
+_cache_lock = threading.Lock()
+_new_matches = threading.Condition()
+
+class InvalidSubscription(APIException):
+    status_code = 403
+    default_detail = "subscriptions need valid query tokens on searchable fields"
+
+class InvalidPoll(APIException):
+    status_code = 403
+    default_detail = "after must be a match id and wait a number of seconds"
+
+def subscribe(model, queries):
+    """Register the query tokens of a subscription to a model's new rows."""
+    if not queries:
+        raise InvalidSubscription
+    for field_name, query in queries.items():
+        if (field_name not in model.searchable_fields()
+                or decode_query(query) is None):
+            raise InvalidSubscription
+    subscription = Subscription.objects.create(
+        table=model._meta.db_table, queries=json.dumps(queries))
+    _forget(model)
+    return subscription
+
+def unsubscribe(model, subscription):
+    """Remove a subscription and its uncollected matches."""
+    subscription.delete()
+    _forget(model)
+
+def evaluate(model, rows):
+    """Record the matches of new rows against the model's subscriptions."""
+    matches = []
+    for subscription_id, decoded in _subscriptions(model):
+        for row in rows:
+            if all(match_decoded(getattr(row, field_name, None), *query)
+                   for field_name, query in decoded):
+                matches.append(SubscriptionMatch(
+                    subscription_id=subscription_id, row=row.pk))
+    if matches:
+        SubscriptionMatch.objects.bulk_create(matches)
+        # waiters cannot see the matches before they commit
+        writer.on_commit(_notify)
+
+def _notify():
+    with _new_matches:
+        _new_matches.notify_all()
+
+def poll(subscription, after=0, wait=0):
+    """Return the matches after the given match id, waiting for some.
+
+    Matches up to and including after are taken as collected and deleted.
+    If there are no newer matches, wait up to `wait` seconds (at most
+    MAX_WAIT) for one.
+
+    """
+    subscription.matches.filter(pk__lte=after).delete()
+    deadline = time.monotonic() + min(wait, MAX_WAIT)
+    while True:
+        matches = list(subscription.matches.filter(pk__gt=after)
+                                           .order_by('pk'))
+        remaining = deadline - time.monotonic()
+        if matches or remaining <= 0:
+            return matches
+        with _new_matches:
+            _new_matches.wait(min(remaining, POLL_INTERVAL))
+
+def pop_poll(params):
+    """Return the (after, wait) options of a poll request, with wait
+    clamped to MAX_WAIT."""
+    try:
+        after = int(params.get('after', 0))
+        wait = float(params.get('wait', 0))
+    except ValueError:
+        raise InvalidPoll
+    if not math.isfinite(wait) or wait < 0:
+        raise InvalidPoll
+    return after, min(wait, MAX_WAIT)
+
+def _subscriptions(model):
+    """Return [(id, decoded queries)] for the model's subscriptions."""
+    table = model._meta.db_table
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(table)
+        if cached is not None and now - cached[0] < REFRESH_INTERVAL:
+            return cached[1]
+    subscriptions = []
+    for subscription in Subscription.objects.filter(table=table):
+        queries = json.loads(subscription.queries)
+        decoded = [(field_name, decode_query(query))
+                   for field_name, query in queries.items()]
+        subscriptions.append((subscription.pk, decoded))
+    with _cache_lock:
+        _cache[table] = (now, subscriptions)
+    return subscriptions
+
+def _forget(model):
+    with _cache_lock:
+        _cache.pop(model._meta.db_table, None)
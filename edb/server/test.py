@@ -1,7 +1,24 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 
 from edb.client import Client
+from edb.errors import QueryTimeout
+from edb.server import metrics, models, segments
+from edb.server.coalesce import SingleFlight, _flights, coalesce
 from edb.server.models import _Ping
+from edb.server.routers import READ_ALIAS, ReadRouter
+from edb.server.stats import ScanStats
+from edb.server.util import decode_query
+from edb.server.writer import GroupCommitWriter, _Job
 
 class EncryptedModelTestCase(TestCase):
 
@@ -25,3 +42,260 @@ class EncryptedModelTestCase(TestCase):
         dests = [result.destination for result in results]
         self.assertIn(self.ip2, dests)
         self.assertIn(self.ip3, dests)
+
+class SegmentStoreTestCase(EncryptedModelTestCase):
+    """Run the encrypted model tests against a segment store."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(EDB_SEGMENT_DIR=self.tmpdir)
+        self.override.enable()
+        models._segment_stores.clear()
+        super().setUp()
+
+    def tearDown(self):
+        self.override.disable()
+        models._segment_stores.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_deleted_rows_not_returned(self):
+        query = self.client.query(self.ip1_ptxt)
+        _Ping.objects.filter(destination=self.ip2).delete()
+        results = _Ping.objects.encrypted_filter(source=query)
+        self.assertEqual([self.ip3], [result.destination for result in results])
+
+    def test_deadline_between_segments(self):
+        models.segment_store(_Ping).seal()
+        _Ping.objects.create(source=self.ip1, destination=self.ip1)
+        query = self.client.query(self.ip1_ptxt)
+        # the deadline passes after the first segment is scanned
+        with mock.patch('time.monotonic', side_effect=[0, 100]):
+            with self.assertRaises(QueryTimeout) as caught:
+                _Ping.objects.encrypted_scan({'source': query}, deadline=50)
+        dests = sorted(row.destination for row in caught.exception.results)
+        self.assertEqual(sorted([self.ip2, self.ip3]), dests)
+        self.assertEqual(caught.exception.scanned, (1, 3))
+
+class SegmentFileTestCase(TestCase):
+    """Tests of a SegmentStore on its own."""
+
+    def setUp(self):
+        self.client = Client()
+        self.tmpdir = tempfile.mkdtemp()
+        # seal after every two records
+        self.store = segments.SegmentStore(self.tmpdir, ('source', 'dest'),
+                                           seal_bytes=2 * (8 + 2 * 32))
+        rows = [(b'10.0.0.1', b'10.0.0.2'), (b'10.0.0.1', b'10.0.0.3'),
+                (b'10.0.0.2', b'10.0.0.3')]
+        for pk, (source, dest) in enumerate(rows, 1):
+            values = {'source': self.client.encrypt(source),
+                      'dest': self.client.encrypt(dest)}
+            self.store.append(pk, values)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def scan(self, **query):
+        return self.store.scan([
+            (field, decode_query(self.client.query(value)))
+            for field, value in query.items()])
+
+    def test_scan(self):
+        self.assertEqual(len(self.store.segments()), 2)
+        self.assertEqual(self.scan(source=b'10.0.0.1'), {1, 2})
+        self.assertEqual(self.scan(source=b'10.0.0.1', dest=b'10.0.0.3'), {2})
+        self.assertEqual(self.scan(source=b'10.9.9.9'), set())
+
+    def test_scan_without_numpy(self):
+        numpy, segments.numpy = segments.numpy, None
+        try:
+            self.assertEqual(self.scan(dest=b'10.0.0.3'), {2, 3})
+        finally:
+            segments.numpy = numpy
+
+    def test_scan_deadline(self):
+        # the deadline passes after the first of the two segments
+        with mock.patch('time.monotonic', side_effect=[0, 100]):
+            with self.assertRaises(QueryTimeout) as caught:
+                self.store.scan([('source', decode_query(
+                    self.client.query(b'10.0.0.1')))], deadline=50)
+        self.assertEqual(caught.exception.results, {1, 2})
+        self.assertEqual(caught.exception.scanned, (1, 2))
+
+    def test_changes_during_scan(self):
+        # another writer appends, seals and compacts as the scan lists the
+        # segments, and has to wait until they are open
+        writer = threading.Thread(target=self.rewrite)
+        segment_paths = self.store.segments
+
+        def list_segments():
+            paths = segment_paths()
+            writer.start()
+            writer.join(0.2)
+            self.assertTrue(writer.is_alive())
+            return paths
+
+        with mock.patch.object(self.store, 'segments', list_segments):
+            self.assertEqual(self.scan(source=b'10.0.0.1'), {1, 2})
+        writer.join()
+        self.assertEqual(self.scan(source=b'10.0.0.1'), {1})
+
+    def rewrite(self):
+        store = segments.SegmentStore(self.tmpdir, ('source', 'dest'),
+                                      seal_bytes=self.store.seal_bytes)
+        store.append(2, {'source': self.client.encrypt(b'10.0.0.4')})
+        store.compact(lambda ids: set(ids))
+
+    def test_compact(self):
+        # row 2 is updated, row 3 is deleted
+        self.store.append(2, {'source': self.client.encrypt(b'10.0.0.4')})
+        self.store.discard(2)
+        # the count is shared with stores opened by other processes
+        other = segments.SegmentStore(self.tmpdir, ('source', 'dest'))
+        self.assertEqual(other.dead, 2)
+        self.assertTrue(self.store.needs_compaction())
+        self.store.compact(lambda ids: {1, 2} & set(ids))
+        self.assertEqual(self.store.dead, 0)
+        self.assertEqual(self.store.records(), 2)
+        self.assertEqual(self.scan(source=b'10.0.0.1'), {1})
+        self.assertEqual(self.scan(source=b'10.0.0.4'), {2})
+
+class SingleFlightTestCase(TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 42
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do('key', slow)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(
+            target=lambda: results.append(flight.do('key', slow)))
+        follower.start()
+        while flight.calls['key'].waiters == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [(42, False), (42, True)])
+
+    def test_followers_get_leader_stats(self):
+        started = threading.Event()
+        release = threading.Event()
+        leader_stats, follower_stats = ScanStats(), ScanStats()
+
+        def scan():
+            leader_stats.rows_scanned += 3
+            started.set()
+            release.wait()
+            return 42
+
+        results = {}
+        leader = threading.Thread(target=lambda: results.update(
+            leader=coalesce('test', {}, scan, leader_stats)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=lambda: results.update(
+            follower=coalesce('test', {}, scan, follower_stats)))
+        follower.start()
+        while _flights.calls[('test', ())].waiters == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results['leader'], (42, leader_stats, False))
+        self.assertEqual(results['follower'], (42, leader_stats, True))
+        self.assertEqual(results['follower'][1].rows_scanned, 3)
+
+class GroupCommitTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.tmpdir = tempfile.mkdtemp()
+        self.override = override_settings(EDB_SEGMENT_DIR=self.tmpdir)
+        self.override.enable()
+        models._segment_stores.clear()
+
+    def tearDown(self):
+        self.override.disable()
+        models._segment_stores.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def ping(self, source):
+        return _Ping(source=self.client.encrypt(source),
+                     destination=self.client.encrypt(b'10.0.0.9'))
+
+    def ingested(self):
+        return metrics.INGEST_ROWS.values.get((), 0)
+
+    def test_group_commit(self):
+        writer = GroupCommitWriter(0.5)
+        groups = []
+        commit = writer._commit
+        writer._commit = lambda jobs: (groups.append(len(jobs)),
+                                       commit(jobs))
+        sources = [str(i).encode() for i in range(5)]
+        saved = []
+        threads = [threading.Thread(target=lambda source=source: saved.append(
+            writer.save(self.ping(source)))) for source in sources]
+        ingested = self.ingested()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(groups, [5])
+        self.assertEqual(sorted(obj.pk for obj in saved),
+                         sorted(_Ping.objects.values_list('pk', flat=True)))
+        self.assertEqual(self.ingested() - ingested, 5)
+        self.assertEqual(models.segment_store(_Ping).records(), 5)
+
+    def test_bad_row_retried_alone(self):
+        def fail(obj):
+            raise ValueError
+        jobs = [_Job(self.ping(b'10.0.0.1'), None),
+                _Job(self.ping(b'10.0.0.2'), fail),
+                _Job(self.ping(b'10.0.0.3'), None)]
+        ingested = self.ingested()
+        GroupCommitWriter(0)._commit(jobs)
+        self.assertTrue(all(job.done.is_set() for job in jobs))
+        self.assertIsNone(jobs[0].error)
+        self.assertIsInstance(jobs[1].error, ValueError)
+        self.assertIsNone(jobs[1].obj.pk)
+        self.assertEqual(set(_Ping.objects.values_list('pk', flat=True)),
+                         {jobs[0].obj.pk, jobs[2].obj.pk})
+        # the rolled back group's side effects were never applied
+        self.assertEqual(self.ingested() - ingested, 2)
+        self.assertEqual(models.segment_store(_Ping).records(), 2)
+
+    def test_read_routing(self):
+        router = ReadRouter()
+        self.assertIn(READ_ALIAS, settings.DATABASES)
+        self.assertEqual(router.db_for_read(_Ping), READ_ALIAS)
+        self.assertEqual(router.db_for_write(_Ping), 'default')
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(_Ping), 'default')
+        with mock.patch.dict(settings.DATABASES):
+            del settings.DATABASES[READ_ALIAS]
+            self.assertIsNone(router.db_for_read(_Ping))
+
+    def test_sqlite_wal(self):
+        connection = mock.Mock(vendor='sqlite')
+        with override_settings(EDB_SQLITE_WAL=True):
+            connection_created.send(sender=None, connection=connection)
+        connection.cursor().execute.assert_called_once_with(
+            'PRAGMA journal_mode=WAL')
+        connection = mock.Mock(vendor='sqlite')
+        with override_settings(EDB_SQLITE_WAL=False):
+            connection_created.send(sender=None, connection=connection)
+        self.assertFalse(connection.cursor().execute.called)
@@ -0,0 +1,62 @@
+"""Plaintext time ranges that prune rows before encrypted matching.
+
+Encrypted models can name an indexed plaintext timestamp column in their
+`time_field` attribute. Requests then pass `since` and/or `until`, either
+ISO 8601 datetimes or dates, or Unix timestamps, and only rows captured in
+[since, until) are fetched and matched. Naive datetimes are taken as UTC.
+"""
+import datetime
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import APIException
+
+class InvalidTimeRange(APIException):
+    status_code = 403
+    default_detail = ("since and until must be ISO 8601 datetimes or Unix "
+                      "timestamps")
+
+def parse_time(value):
+    """Return the aware datetime for an ISO 8601 string or Unix timestamp.
+
+    A date alone stands for midnight at its start.
+
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            moment = parse_datetime(value)
+            if moment is None:
+                day = parse_date(value)
+                if day is not None:
+                    moment = datetime.datetime.combine(day, datetime.time())
+        except ValueError:
+            moment = None
+        if moment is None:
+            raise InvalidTimeRange
+    else:
+        moment = datetime.datetime.fromtimestamp(seconds, timezone.utc)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.utc)
+    return moment
+
+def pop_time_range(params, model):
+    """Remove the time range options from params.
+
+    Return a dict of queryset filters on the model's time field, empty if no
+    range was requested.
+
+    """
+    since = params.pop('since', None)
+    until = params.pop('until', None)
+    if not since and not until:
+        return {}
+    if model.time_field is None:
+        raise InvalidTimeRange("this table has no time field")
+    filters = {}
+    if since:
+        filters[model.time_field + '__gte'] = parse_time(since)
+    if until:
+        filters[model.time_field + '__lt'] = parse_time(until)
+    return filters
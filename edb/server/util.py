@@ -16,30 +16,59 @@ def match(b64field, b64query):
 
     """
     # Ensure byte strings.
-    if isinstance(b64field, str):
-        b64field = str.encode(b64field)
-    elif not isinstance(b64field, (bytes, bytearray)):
+    if not isinstance(b64field, (str, bytes, bytearray)):
         return False
-    if isinstance(b64query, str):
-        b64query = str.encode(b64query)
-    elif not isinstance(b64query, (bytes, bytearray)):
+    if not isinstance(b64query, (str, bytes, bytearray)):
         print('bad instance', type(b64query), b64query)
         return False
 
-    # Decode from base64.
+    query = decode_query(b64query)
+    if query is None:
+        return False
+    return match_decoded(b64field, *query)
+
+def decode_query(b64query):
+    """Return the (preword, word_key) pair of a query, or None if invalid.
+
+    Decoding a query once up front saves work when it is matched against many
+    fields with match_decoded.
+
+    """
+    if isinstance(b64query, str):
+        b64query = str.encode(b64query)
+    elif not isinstance(b64query, (bytes, bytearray)):
+        return None
     try:
-        field = base64.decodebytes(b64field)
         query = base64.decodebytes(b64query)
     except:
-        return False
+        return None
+    if len(query) != 2 * BLOCK_BYTES:
+        return None
+    return query[:BLOCK_BYTES], query[BLOCK_BYTES:]
 
-    # Require correct sizes.
-    if len(query) != 2 * BLOCK_BYTES or len(field) != 2 * BLOCK_BYTES:
+def match_decoded(b64field, preword, word_key):
+    """Return True if the decoded query (preword, word_key) matches the field."""
+    ciphertext = decode_field(b64field)
+    if ciphertext is None:
         return False
+    return match_ciphertext(ciphertext, preword, word_key)
+
+def decode_field(b64field):
+    """Return the raw (unsalted) ciphertext of a field, or None if invalid."""
+    if isinstance(b64field, str):
+        b64field = str.encode(b64field)
+    elif not isinstance(b64field, (bytes, bytearray)):
+        return None
+    try:
+        field = base64.decodebytes(b64field)
+    except:
+        return None
+    if len(field) != 2 * BLOCK_BYTES:
+        return None
+    return field[BLOCK_BYTES:]
 
-    # Check using Song et al.'s Final Scheme.
-    preword, word_key = query[:BLOCK_BYTES], query[BLOCK_BYTES:]
-    _, ciphertext = field[:BLOCK_BYTES], field[BLOCK_BYTES:]
+def match_ciphertext(ciphertext, preword, word_key):
+    """Check a raw (unsalted) ciphertext using Song et al.'s Final Scheme."""
     block = crypto.xor(ciphertext, preword)
     prefix, suffix = block[:LEFT_BYTES], block[LEFT_BYTES:]
     hashed_prefix = crypto.prfunction(word_key, prefix, length=MATCH_BYTES)
@@ -0,0 +1,170 @@
+"""Group commit of single-row inserts.
+
+Every create request would otherwise commit its own transaction, and on
+SQLite each commit takes the database write lock. With EDB_GROUP_COMMIT_MS
+set, creates are handed to one writer thread. It waits up to that many
+milliseconds for more rows and inserts them all (at most MAX_ROWS) in one
+transaction. Each request still blocks until its row is committed and gets
+back its id. If a group's transaction fails, its rows are retried one per
+transaction, so a bad row only fails its own request.
+
+Side effects of an insert that live outside the database, such as segment
+appends, metrics and waking subscribers, are registered with on_commit by
+the post_save receivers. They run once the row's transaction commits, so a
+group that is rolled back and retried does not apply them twice.
+
+Callers that are already in a transaction insert inline, so their rows stay
+part of it.
+"""
+import time
+import queue
+import threading
+import contextlib
+
+from django.conf import settings
+from django.db import router, transaction
+
+# Most rows committed in one group.
+MAX_ROWS = 500
+
+_local = threading.local()
+
+class _Job:
+    __slots__ = ('obj', 'after', 'done', 'error', 'callbacks')
+
+    def __init__(self, obj, after):
+        self.obj = obj
+        self.after = after
+        self.done = threading.Event()
+        self.error = None
+        self.callbacks = ()
+
+class GroupCommitWriter:
+    """Thread that inserts rows in groups.
+
+    Parameters:
+
+    window
+      seconds to wait for more rows after the first of a group arrives
+
+    max_rows (optional)
+      most rows in one group
+
+    """
+
+    def __init__(self, window, max_rows=MAX_ROWS):
+        self.window = window
+        self.max_rows = max_rows
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, obj, after=None):
+        """Insert obj once its group commits and return it; see save."""
+        job = _Job(obj, after)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return obj
+
+    def _run(self):
+        while True:
+            jobs = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(jobs) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit(jobs)
+
+    def _commit(self, jobs):
+        try:
+            with transaction.atomic():
+                for job in jobs:
+                    job.callbacks = _insert(job.obj, job.after)
+        except Exception:
+            for job in jobs:
+                # ids from the rolled back inserts are not taken, and their
+                # side effects never happened
+                job.obj.pk = None
+                job.callbacks = ()
+            for job in jobs:
+                try:
+                    with transaction.atomic():
+                        job.callbacks = _insert(job.obj, job.after)
+                except Exception as err:
+                    job.obj.pk = None
+                    job.callbacks = ()
+                    job.error = err
+        finally:
+            for job in jobs:
+                try:
+                    _run(job.callbacks)
+                except Exception as err:
+                    job.error = err
+                job.done.set()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """Return the process's group-commit writer, starting it if needed."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = GroupCommitWriter(settings.EDB_GROUP_COMMIT_MS / 1000)
+        return _writer
+
+def save(obj, after=None):
+    """Insert a new model instance and return it.
+
+    If after is given, after(obj) is called in the same transaction once obj
+    has its id, such as to save rows that refer to it.
+
+    """
+    window = getattr(settings, 'EDB_GROUP_COMMIT_MS', None)
+    using = router.db_for_write(type(obj), instance=obj)
+    if window is None or transaction.get_connection(using).in_atomic_block:
+        with transaction.atomic(using=using):
+            callbacks = _insert(obj, after)
+        _run(callbacks)
+        return obj
+    return get_writer().save(obj, after)
+
+def on_commit(func):
+    """Call func() once the row being inserted by save is committed.
+
+    Outside of save, func is called at once.
+
+    """
+    callbacks = getattr(_local, 'callbacks', None)
+    if callbacks is None:
+        func()
+    else:
+        callbacks.append(func)
+
+@contextlib.contextmanager
+def _deferred():
+    outer = getattr(_local, 'callbacks', None)
+    _local.callbacks = callbacks = []
+    try:
+        yield callbacks
+    finally:
+        _local.callbacks = outer
+
+def _insert(obj, after):
+    """Insert obj and return the callbacks to run once it commits."""
+    with _deferred() as callbacks:
+        obj.save(force_insert=True)
+        if after is not None:
+            after(obj)
+    return callbacks
+
+def _run(callbacks):
+    for func in callbacks:
+        func()
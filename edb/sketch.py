@@ -0,0 +1,136 @@
+"""Bounded-memory frequency sketches for client-side analytics.
+
+A CountMinSketch estimates how often each item occurred in a stream using
+depth * width counters, whatever the number of distinct items. Estimates
+never undercount, and with probability at least 1 - delta they overcount by
+at most epsilon * N, where N is the length of the stream, width is
+ceil(e / epsilon) and depth is ceil(ln(1 / delta)).
+
+TopK keeps the k items with the highest estimates in a heap alongside the
+sketch, which finds the heavy hitters of a stream in one pass.
+"""
+import math
+import heapq
+import zlib
+
+class CountMinSketch:
+    """Count-Min sketch of byte string items.
+
+    Parameters:
+
+    width (optional)
+      counters per row; the error bound is e / width of the stream length
+
+    depth (optional)
+      rows of counters; the bound fails with probability e ** -depth
+
+    """
+
+    def __init__(self, width=2719, depth=5):
+        if width < 1 or depth < 1:
+            raise ValueError('width and depth must be positive')
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+        self.total = 0
+
+    @classmethod
+    def from_error(cls, epsilon, delta):
+        """Return a sketch overcounting by at most epsilon * N with
+        probability at least 1 - delta."""
+        return cls(int(math.ceil(math.e / epsilon)),
+                   int(math.ceil(math.log(1 / delta))))
+
+    def _columns(self, item):
+        # double hashing: row i uses h1 + i * h2
+        first = zlib.crc32(item)
+        second = zlib.adler32(item) | 1
+        return [(first + i * second) % self.width for i in range(self.depth)]
+
+    def add(self, item, count=1):
+        """Count item and return its new estimate."""
+        self.total += count
+        estimate = None
+        for row, column in zip(self.rows, self._columns(item)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self, item):
+        """Return an upper bound on the count of item (see error)."""
+        return min(row[column]
+                   for row, column in zip(self.rows, self._columns(item)))
+
+    def error(self):
+        """Return the most an estimate overcounts, with probability
+        1 - confidence()."""
+        return int(math.ceil(math.e / self.width * self.total))
+
+    def confidence(self):
+        """Return the probability that an estimate is within error()."""
+        return 1 - math.exp(-self.depth)
+
+class TopK:
+    """The k items with the highest estimated counts in a stream.
+
+    Parameters:
+
+    k
+      number of items to keep, at least 1
+
+    sketch (optional)
+      CountMinSketch to count with, by default one with its default size
+
+    """
+
+    def __init__(self, k, sketch=None):
+        if k < 1:
+            raise ValueError('k must be positive')
+        self.k = k
+        self.sketch = sketch if sketch is not None else CountMinSketch()
+        self.counts = {}
+        # (estimate, item) entries; stale ones are skipped when popped
+        self.heap = []
+
+    def add(self, item, count=1):
+        estimate = self.sketch.add(item, count)
+        if item in self.counts:
+            self.counts[item] = estimate
+            heapq.heappush(self.heap, (estimate, item))
+        elif len(self.counts) < self.k:
+            self.counts[item] = estimate
+            heapq.heappush(self.heap, (estimate, item))
+        elif estimate > self._minimum():
+            _, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted]
+            self.counts[item] = estimate
+            heapq.heappush(self.heap, (estimate, item))
+        if len(self.heap) > 4 * self.k + 64:
+            self.heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _minimum(self):
+        """Drop stale heap entries and return the smallest current count."""
+        while True:
+            count, item = self.heap[0]
+            if self.counts.get(item) == count:
+                return count
+            heapq.heappop(self.heap)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def top(self):
+        """Return [(item, estimate, lower bound)], most frequent first.
+
+        The true count of each item lies between its lower bound and its
+        estimate, with probability sketch.confidence().
+
+        """
+        error = self.sketch.error()
+        return [(item, count, max(0, count - error))
+                for item, count in sorted(self.counts.items(),
+                                          key=lambda pair: (-pair[1],
+                                                            pair[0]))]
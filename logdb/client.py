@@ -1,19 +1,42 @@
 import os
+import sys
+import json
+import math
+import time
+import zlib
+import datetime
+import collections
+import multiprocessing
+import shlex
 
 import requests
 import click
 import prettytable
 
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import RequestException
 from edb import crypto
-from edb.client import Client as EDBClient
+from edb.client import (Client as EDBClient, IP_PREFIXES, bucket_field,
+                        bucket_scheme, bucket_scheme_field, prefix_field,
+                        prefix_query)
 from edb.errors import EDBError
+from edb.profiling import Profile
+from edb.sketch import CountMinSketch, TopK
+from logdb.mirror import Mirror
 
 def run_cli():
+    obj = {}
     try:
-        cli(obj={})
+        cli(obj=obj)
     except EDBError as err:
         print('Error:', err)
+    finally:
+        profile = obj.get('profile')
+        if profile is not None:
+            profile.stop()
+            paths = profile.write(obj['profile_prefix'])
+            print('Wrote profile to {}'.format(', '.join(paths)),
+                  file=sys.stderr)
 
 @click.group()
 @click.option('--host', default='localhost',
@@ -22,8 +45,16 @@ def run_cli():
         help='port of the server (default 8000)')
 @click.option('-k', '--keyfile', default='keyfile.json',
         help='path to the keyfile (default "keyfile.json")')
+@click.option('--shards', default='',
+        help='comma-separated host:port list of shard servers, used instead '
+             'of --host and --port')
+@click.option('--mirror', default='mirror.sqlite3',
+        help='path to the local mirror (default "mirror.sqlite3")')
+@click.option('--profile',
+        help='profile the subcommand and write PROFILE.prof, '
+             '.collapsed and .txt (worker processes are not covered)')
 @click.pass_context
-def cli(context, host, port, keyfile):
+def cli(context, host, port, keyfile, shards, mirror, profile):
     """Client command line interface.
 
     To view help for a subcommand, run:
@@ -31,12 +62,30 @@ def cli(context, host, port, keyfile):
         client SUBCOMMAND --help
     
     """
+    context.obj['global_args'] = ['--host', host, '--port', str(port),
+                                  '--keyfile', keyfile, '--shards', shards,
+                                  '--mirror', mirror]
+    context.obj['mirror'] = mirror
+    if profile and 'profile' not in context.obj:
+        # stopped and written by run_cli once the subcommand returns
+        context.obj['profile'] = Profile().start()
+        context.obj['profile_prefix'] = profile
     if context.invoked_subcommand not in ('keygen'):
+        # shell and batch sessions reuse the client across commands
+        client_args = (keyfile, host, port, shards)
+        if context.obj.get('client_args') == client_args:
+            return
         if keyfile == 'keyfile.json' and not os.path.exists(keyfile):
             print('The client requires a keyfile to proceed.')
             print('Generate using the `keygen` command.')
             context.exit()
-        context.obj['client'] = Client(keyfile=keyfile, host=host, port=port)
+        if shards:
+            context.obj['client'] = ShardedClient(keyfile=keyfile,
+                                                  shards=parse_shards(shards))
+        else:
+            context.obj['client'] = Client(keyfile=keyfile, host=host,
+                                           port=port)
+        context.obj['client_args'] = client_args
 
 @cli.command()
 @click.argument('filename', default='keyfile.json',
@@ -49,173 +98,1288 @@ def keygen(context, filename):
     print('Created keyfile at {}'.format(os.path.abspath(filename)))
 
 @cli.command()
-@click.option('-s', '--source', help='filter by source IP')
-@click.option('-d', '--destination', help='filter by destination IP')
+@click.option('-s', '--source', help='filter by source IP or network')
+@click.option('-d', '--destination',
+        help='filter by destination IP or network')
 @click.option('-p', '--protocol', help='filter by protocol IP')
+@click.option('--since', help='only packets captured at or after this time')
+@click.option('--until', help='only packets captured before this time')
+@click.option('-I', '--index', is_flag=True,
+        help='search the inverted index instead of scanning')
+@click.option('-j', '--jobs', default=0,
+        help='decrypt results in N worker processes (default 0, lazily)')
+@click.option('-L', '--local', is_flag=True,
+        help='answer from the local mirror (see sync)')
 @click.pass_context
-def lookup(context, source, destination, protocol):
+def lookup(context, source, destination, protocol, since, until, index,
+           jobs, local):
     """Look up packets in the database."""
     client = context.obj['client']
-    params = {}
-    if source: params['source'] = source.encode()
-    if destination: params['destination'] = destination.encode()
-    if protocol: params['protocol'] = protocol.encode()
-    results = client.search(**params)
-    fields = ('source', 'destination', 'protocol', 'length')
+    params = packet_query(source, destination, protocol)
+    if local:
+        results = open_mirror(context).search(since=since, until=until,
+                                              **params)
+    else:
+        results = client.search(processes=jobs, since=since, until=until,
+                                index=index, **params)
+    fields = ('source', 'destination', 'protocol', 'length', 'captured_at')
     table = prettytable.PrettyTable(fields)
     for result in results:
         row = []
-        for field in fields:
-            cell = result[field]
-            if isinstance(cell, (bytes, bytearray)):
-                try:
-                    cell = cell.decode()
-                except:
+        try:
+            for field in fields:
+                cell = result[field]
+                if cell is None:
                     cell = ''
-            row.append(cell)
+                elif isinstance(cell, (bytes, bytearray)):
+                    try:
+                        cell = cell.decode()
+                    except:
+                        cell = ''
+                row.append(cell)
+        except EDBError:
+            # skip undecryptable results
+            continue
         table.add_row(row)
     print(table)
 
+def packet_query(source, destination, protocol):
+    """Return the plaintext query for the filter options of a command.
+
+    Addresses written as networks, such as 10.1.2.0/24, are searched by
+    prefix.
+
+    """
+    params = {}
+    if source and '/' in source:
+        params.update(prefix_query('source', source))
+    elif source:
+        params['source'] = source.encode()
+    if destination and '/' in destination:
+        params.update(prefix_query('destination', destination))
+    elif destination:
+        params['destination'] = destination.encode()
+    if protocol: params['protocol'] = protocol.encode()
+    return params
+
 @cli.command()
 @click.argument('source', help='source IP address')
 @click.argument('destination', help='destination IP address')
 @click.argument('protocol', help='packet protocol')
 @click.argument('length', help='packet length')
+@click.option('--captured-at',
+        help='capture time, as an ISO 8601 datetime or Unix timestamp')
+@click.option('-P', '--prefixes', is_flag=True,
+        help='index the /8, /16 and /24 networks of both addresses')
+@click.option('-I', '--index', is_flag=True,
+        help='send keyword tags for the inverted index')
+@click.option('-H', '--histogram', is_flag=True,
+        help='store length bucket counters for `histogram`')
 @click.pass_context
-def add(context, source, destination, protocol, length):
+def add(context, source, destination, protocol, length, captured_at,
+        prefixes, index, histogram):
     """Add a row to database."""
     client = context.obj['client']
-    client.create(source=source.encode(),
+    client.create(prefixes=prefixes, index=index,
+                  buckets=LENGTH_BUCKETS if histogram else None,
+                  source=source.encode(),
                   destination=destination.encode(),
                   protocol=protocol.encode(),
-                  length=length)
+                  length=length,
+                  captured_at=captured_at)
 
 @cli.command()
 @click.argument('filename', type=click.File('r'),
         help='data file')
+@click.option('-P', '--prefixes', is_flag=True,
+        help='index the /8, /16 and /24 networks of both addresses')
+@click.option('-I', '--index', is_flag=True,
+        help='send keyword tags for the inverted index')
+@click.option('-H', '--histogram', is_flag=True,
+        help='store length bucket counters for `histogram`')
 @click.pass_context
-def addfrom(context, filename):
+def addfrom(context, filename, prefixes, index, histogram):
     """Add rows from file.
 
     The file format is simple: one row per line, with fields separated by
-    spaces.
+    spaces. A fifth field, if present, is the capture time.
 
     """
     client = context.obj['client']
     for line in filename:
-        try:
-            source, destination, protocol, length = line.strip().split()
-        except ValueError:
+        fields = line.strip().split()
+        if len(fields) not in (4, 5):
             print('Warning: skipping invalid line:', repr(line))
-        client.create(source=source.encode(),
+            continue
+        source, destination, protocol, length = fields[:4]
+        captured_at = fields[4] if len(fields) == 5 else None
+        client.create(prefixes=prefixes, index=index,
+                      buckets=LENGTH_BUCKETS if histogram else None,
+                      source=source.encode(),
                       destination=destination.encode(),
                       protocol=protocol.encode(),
-                      length=length)
+                      length=length,
+                      captured_at=captured_at)
     print('Added files. Use `lookup` to view.')
 
 @cli.command()
-@click.option('-s', '--source', help='filter by source IP')
-@click.option('-d', '--destination', help='filter by destination IP')
+@click.option('-s', '--source', help='filter by source IP or network')
+@click.option('-d', '--destination',
+        help='filter by destination IP or network')
 @click.option('-p', '--protocol', help='filter by protocol IP')
+@click.option('--since', help='only packets captured at or after this time')
+@click.option('--until', help='only packets captured before this time')
+@click.option('-I', '--index', is_flag=True,
+        help='search the inverted index instead of scanning')
+@click.option('-a', '--approx', default=0.0,
+        help='estimate from this fraction of rows (default 0, exact)')
+@click.option('-L', '--local', is_flag=True,
+        help='answer from the local mirror (see sync)')
 @click.pass_context
-def average(context, source, destination, protocol):
+def average(context, source, destination, protocol, since, until, index,
+        approx, local):
     """Compute average message length."""
     client = context.obj['client']
-    params = {}
-    if source: params['source'] = source.encode()
-    if destination: params['destination'] = destination.encode()
-    if protocol: params['protocol'] = protocol.encode()
-    print(client.average(**params))
+    params = packet_query(source, destination, protocol)
+    if local:
+        print(open_mirror(context).average(since=since, until=until, **params))
+        return
+    if approx:
+        params.update(approximate=True, fraction=approx)
+    print(client.average(since=since, until=until, index=index, **params))
 
 @cli.command()
-@click.option('-s', '--source', help='filter by source IP')
-@click.option('-d', '--destination', help='filter by destination IP')
+@click.option('-s', '--source', help='filter by source IP or network')
+@click.option('-d', '--destination',
+        help='filter by destination IP or network')
 @click.option('-p', '--protocol', help='filter by protocol IP')
+@click.option('--since', help='only packets captured at or after this time')
+@click.option('--until', help='only packets captured before this time')
+@click.option('-I', '--index', is_flag=True,
+        help='search the inverted index instead of scanning')
+@click.option('-a', '--approx', default=0.0,
+        help='estimate from this fraction of rows (default 0, exact)')
+@click.option('-L', '--local', is_flag=True,
+        help='answer from the local mirror (see sync)')
 @click.pass_context
-def count(context, source, destination, protocol):
+def count(context, source, destination, protocol, since, until, index,
+        approx, local):
     """Count messages matching a query."""
     client = context.obj['client']
-    params = {}
-    if source: params['source'] = source.encode()
-    if destination: params['destination'] = destination.encode()
-    if protocol: params['protocol'] = protocol.encode()
-    print(client.count(**params))
+    params = packet_query(source, destination, protocol)
+    if local:
+        print(open_mirror(context).count(since=since, until=until, **params))
+        return
+    if approx:
+        params.update(approximate=True, fraction=approx)
+    print(client.count(since=since, until=until, index=index, **params))
+
+@cli.command()
+@click.option('-s', '--source', help='filter by source IP or network')
+@click.option('-d', '--destination',
+        help='filter by destination IP or network')
+@click.option('-p', '--protocol', help='filter by protocol IP')
+@click.option('--since', help='only packets captured at or after this time')
+@click.option('--until', help='only packets captured before this time')
+@click.option('-I', '--index', is_flag=True,
+        help='search the inverted index instead of scanning')
+@click.option('--buckets',
+        help='comma-separated bucket bounds the packets were added with '
+             '(default those used by -H)')
+@click.option('--percentiles', default='50,95,99',
+        help='comma-separated percentiles to estimate (default 50,95,99)')
+@click.pass_context
+def histogram(context, source, destination, protocol, since, until, index,
+              buckets, percentiles):
+    """Compute a histogram and percentiles of message length.
+
+    Only packets added with -H are counted.
+
+    """
+    client = context.obj['client']
+    try:
+        bounds = ([int(bound) for bound in buckets.split(',')] if buckets
+                  else list(LENGTH_BUCKETS))
+        percentiles = [float(p) for p in percentiles.split(',')]
+    except ValueError:
+        raise EDBError('buckets and percentiles must be lists of numbers')
+    params = packet_query(source, destination, protocol)
+    counts, uncounted = client.histogram(bounds, since=since, until=until,
+                                         index=index, **params)
+    table = prettytable.PrettyTable(('length', 'count'))
+    edges = [0] + bounds
+    for i, count in enumerate(counts):
+        if i < len(bounds):
+            label = '{}-{}'.format(edges[i], bounds[i] - 1)
+        else:
+            label = '{}+'.format(edges[i])
+        table.add_row((label, count))
+    print(table)
+    for p in percentiles:
+        value = estimate_percentile(bounds, counts, p)
+        if value is None:
+            value = 'n/a'
+        elif value >= bounds[-1]:
+            value = '{}+'.format(bounds[-1])
+        else:
+            value = '{:.0f}'.format(value)
+        print('p{:g}: {}'.format(p, value))
+    if uncounted:
+        print('{} matching packets had no bucket counters for these '
+              'buckets.'.format(uncounted))
 
 @cli.command()
 @click.argument('source', help='the source IP address')
 @click.argument('destination', help='the destination IP address')
+@click.option('--since', help='only packets captured at or after this time')
+@click.option('--until', help='only packets captured before this time')
+@click.option('-L', '--local', is_flag=True,
+        help='answer from the local mirror (see sync)')
 @click.pass_context
-def correlate(context, source, destination):
+def correlate(context, source, destination, since, until, local):
     """Compute correlation between IPs."""
     client = context.obj['client']
-    print(client.correlate(source.encode(), destination.encode()))
+    if local:
+        client = open_mirror(context)
+    print(client.correlate(source.encode(), destination.encode(),
+                           since=since, until=until))
+
+@cli.command()
+@click.option('-j', '--jobs', default=0,
+        help='decrypt in N worker processes (default 0, in this process)')
+@click.option('--prune', is_flag=True,
+        help='also remove packets deleted on the server')
+@click.pass_context
+def sync(context, jobs, prune):
+    """Copy new packets into the local mirror."""
+    client = context.obj['client']
+    mirror = Mirror(context.obj['mirror'])
+    added, removed = client.sync(mirror, processes=jobs, prune=prune)
+    print('Added {} packets and removed {} from {}.'.format(
+        added, removed, mirror.path))
+
+def open_mirror(context):
+    """Return the local mirror, which must have been synced."""
+    path = context.obj['mirror']
+    if not os.path.exists(path):
+        raise EDBError('no mirror at {}; create it with `sync`'.format(path))
+    return Mirror(path)
+
+@cli.command()
+@click.option('--new-keyfile', help='path to the new keyfile, created if missing')
+@click.option('--checkpoint',
+        help='progress file for resuming (default NEW_KEYFILE.rekey)')
+@click.option('-j', '--jobs', default=0,
+        help='worker processes (default 0, one per CPU)')
+@click.option('-b', '--batch', default=500, help='rows per request')
+@click.option('-P', '--prefixes', is_flag=True,
+        help='index the /8, /16 and /24 networks of both addresses')
+@click.option('-I', '--index', is_flag=True,
+        help='send keyword tags for the inverted index')
+@click.option('-H', '--histogram', is_flag=True,
+        help='store length bucket counters for `histogram`')
+@click.pass_context
+def rekey(context, new_keyfile, checkpoint, jobs, batch, prefixes, index,
+          histogram):
+    """Re-encrypt all rows under new keys.
+
+    Rows are re-encrypted in pages and written back in place. If the job is
+    interrupted, run it again with the same options to resume. Network
+    columns, index tags and length bucket counters are only kept with -P, -I
+    and -H.
+
+    """
+    client = context.obj['client']
+    if not new_keyfile:
+        print('Error: --new-keyfile is required')
+        return
+    if not os.path.exists(new_keyfile):
+        crypto.write_keyinfo(crypto.generate_keyinfo(EDBClient.KEY_SCHEMA),
+                             new_keyfile)
+        print('Created keyfile at {}'.format(os.path.abspath(new_keyfile)))
+    new_keys = crypto.read_keyinfo(new_keyfile)
+    rekeyed, skipped = client.rekey(
+        new_keys, checkpoint or new_keyfile + '.rekey', batch=batch,
+        processes=jobs or None, prefixes=prefixes, index=index,
+        buckets=LENGTH_BUCKETS if histogram else None)
+    print('Re-encrypted {} rows ({} could not be decrypted).'.format(
+        rekeyed, skipped))
+    print('Use {} as the keyfile from now on.'.format(new_keyfile))
+
+@cli.command()
+@click.option('-f', '--field', default='source',
+        type=click.Choice(['source', 'destination', 'protocol', 'length']),
+        help='field to count (default source)')
+@click.option('-k', '--top', default=10, help='values to report (default 10)')
+@click.option('-j', '--jobs', default=0,
+        help='worker processes (default 0, one per CPU)')
+@click.option('-b', '--batch', default=1000, help='rows per request')
+@click.option('--epsilon', default=0.001,
+        help='most a count may be overestimated by, as a fraction of the '
+             'rows scanned (default 0.001)')
+@click.option('--delta', default=0.01,
+        help='chance of exceeding that bound (default 0.01)')
+@click.pass_context
+def top(context, field, top, jobs, batch, epsilon, delta):
+    """Print the most frequent values of a field.
+
+    Every packet is paged out and decrypted, but only a fixed-size sketch of
+    the counts is kept, so tables of any size can be scanned. Counts are
+    estimates: each lies in the range shown, with the given confidence.
+
+    """
+    client = context.obj['client']
+    if top < 1:
+        print('Error: --top must be at least 1')
+        return
+    sketch = CountMinSketch.from_error(epsilon, delta)
+    heavy, skipped = client.top(field, top, batch=batch,
+                                processes=jobs or None, sketch=sketch)
+    table = prettytable.PrettyTable((field, 'count', 'at least'))
+    for value, count, low in heavy.top():
+        table.add_row((value.decode(errors='replace'), count, low))
+    print(table)
+    print('{} packets scanned ({} could not be decrypted); counts are '
+          'overestimated by at most {} with {:.1%} confidence.'.format(
+              sketch.total, skipped, sketch.error(), sketch.confidence()))
+
+@cli.command()
+@click.option('-s', '--source', help='filter by source IP or network')
+@click.option('-d', '--destination',
+        help='filter by destination IP or network')
+@click.option('-p', '--protocol', help='filter by protocol IP')
+@click.pass_context
+def watch(context, source, destination, protocol):
+    """Print new packets matching a query.
+
+    The query is registered with the server, which matches each packet
+    added from then on. Press Ctrl-C to stop.
+
+    """
+    client = context.obj['client']
+    params = packet_query(source, destination, protocol)
+    fields = ('source', 'destination', 'protocol', 'length', 'captured_at')
+    try:
+        for result in client.watch(**params):
+            try:
+                row = [result[field] for field in fields]
+            except EDBError:
+                continue
+            print('\t'.join(cell.decode(errors='replace')
+                            if isinstance(cell, (bytes, bytearray))
+                            else str('' if cell is None else cell)
+                            for cell in row), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+@cli.command()
+@click.pass_context
+def shell(context):
+    """Run subcommands interactively in one session.
+
+    The keys, query tokens and server connection are kept between commands.
+    Enter `quit` or end of file to exit.
+
+    """
+    try:
+        import readline
+    except ImportError:
+        pass
+    def lines():
+        while True:
+            try:
+                line = input('client> ')
+            except EOFError:
+                print()
+                return
+            if line.strip() in ('quit', 'exit'):
+                return
+            yield line
+    run_session(context, lines())
+
+@cli.command()
+@click.argument('filename', type=click.File('r'),
+        help='file of subcommands, one per line')
+@click.pass_context
+def batch(context, filename):
+    """Run subcommands from a file in one session.
+
+    Each line holds one subcommand with its arguments, as it would be typed
+    after `client`. Blank lines and lines starting with # are ignored.
+
+    """
+    run_session(context, filename)
+
+def run_session(context, lines):
+    """Run each line as a subcommand, printing its time to stderr."""
+    for line in lines:
+        args = shlex.split(line, comments=True)
+        if not args:
+            continue
+        if args[0] in ('shell', 'batch'):
+            print('Error: cannot run {} within a session'.format(args[0]))
+            continue
+        start = time.time()
+        try:
+            cli.main(args=context.obj['global_args'] + args,
+                     prog_name='client', obj=context.obj)
+        except SystemExit:
+            pass
+        except EDBError as err:
+            print('Error:', err)
+        elapsed = time.time() - start
+        print('[{}: {:.3f}s]'.format(args[0], elapsed), file=sys.stderr)
+
+# Default sample size of approximate queries.
+APPROX_ROWS = 10000
+
+# Seconds the server holds each watch poll open when there are no matches.
+WATCH_WAIT = 25
+
+# Packet fields stored in plaintext: the capture time, so that time ranges
+# can be pruned with an index, and the fingerprint of the keys that
+# encrypted the rest (see edb.client.Client.key_id).
+PLAIN_FIELDS = ('id', 'captured_at', 'key_id')
+
+# Rows re-encrypted per request by Client.rekey.
+REKEY_BATCH = 500
+
+# Rows copied per request by Client.sync, and ids per deletion check.
+SYNC_BATCH = 1000
+ID_PAGE = 10000
+
+# Bounds of the packet length buckets stored for histograms by default;
+# see edb.client.bucket_index.
+LENGTH_BUCKETS = (64, 128, 192, 256, 384, 512, 768, 1024, 1280, 1500)
+
+# Values per group_average request: the most the server accepts.
+GROUP_BATCH = 1000
+
+# Rows per request, and per worker job, scanned by Client.top.
+TOP_BATCH = 1000
+TOP_CHUNK = 100
+
+# GET responses (and decrypted search results) each Client keeps for
+# conditional requests, and the most rows they may hold in all. Larger
+# responses are not cached.
+CACHE_SIZE = 128
+CACHE_ROWS = 10000
+
+Estimate = collections.namedtuple('Estimate', ('value', 'low', 'high'))
+Estimate.__str__ = lambda self: '{} ({}-{})'.format(*self)
 
 class Client(EDBClient):
 
-    def __init__(self, keyfile=None, host=None, port=None):
-        super(self.__class__, self).__init__(keyfile)
+    def __init__(self, keyfile=None, host=None, port=None, _keyinfo=None):
+        super().__init__(keyfile, _keyinfo)
         self.host = host or 'localhost'
         self.port = port or 8000
         self.url = 'http://{}:{}/'.format(self.host, self.port)
         self.packet_url = self.url + 'packets/'
         self.count_url = self.url + 'compute/count/'
         self.average_url = self.url + 'compute/average/'
+        self.group_average_url = self.url + 'compute/group_average/'
+        self.histogram_url = self.url + 'compute/histogram/'
         self.correlate_url = self.url + 'compute/correlate/'
+        self.subscription_url = self.url + 'subscriptions/'
+        self.bulk_url = self.url + 'packets/bulk/'
+        self.ids_url = self.url + 'packets/ids/'
+        # keep connections to the server alive between requests
+        self.session = requests.Session()
+        # (url, params) -> (ETag, response)
+        self.cache = LRUCache()
+        # search params -> (responses, results)
+        self.results = LRUCache()
+
+    def request(self, method, url, cache=True, **kwargs):
+        """Send a request and return its decoded JSON response.
+
+        GET responses that come with an ETag are cached, and repeating the
+        request sends the ETag back; if the server answers 304 Not Modified,
+        the cached response is returned (the same object as before). Pass
+        cache=False for responses that will not be asked for again.
 
-    def request(self, method, *args, **kwargs):
+        """
+        key = cached = None
+        if method == 'get' and cache:
+            key = (url, tuple(sorted((kwargs.get('params') or {}).items())))
+            cached = self.cache.get(key)
+            if cached is not None:
+                kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                         **{'If-None-Match': cached[0]})
         try:
-            resp = requests.request(method, *args, **kwargs)
+            resp = self.session.request(method, url, **kwargs)
         except RequestException as err:
             raise EDBError('could not connect to server: ' + str(err))
+        if resp.status_code == 304 and cached is not None:
+            return cached[1]
+        if resp.status_code == 204:
+            return None
+        status = resp.status_code
+        etag = resp.headers.get('ETag')
         try:
             resp = resp.json()
         except:
+            if status >= 400:
+                raise EDBError('server returned status {}'.format(status))
             raise EDBError('received invalid response from server')
-        if 'detail' in resp:
-            raise EDBError(detail)
+        if isinstance(resp, dict) and 'detail' in resp:
+            raise EDBError(resp['detail'])
+        if status >= 400:
+            raise EDBError(error_message(resp, status))
+        if key is not None and etag:
+            self.cache.put(key, (etag, resp), response_rows(resp))
         return resp
 
-    def search(self, **query):
-        encrypted_query = self.encrypt_query(query)
-        resp = self.request('get', self.packet_url, params=encrypted_query)
-        plaintexts = []
-        for model in resp:
-            try:
-                ptxt = self.decrypt_model(model, paillier_fields=['length'],
-                        exclude_fields=['id'])
-            except EDBError:
-                # ignore undecrypted results
-                pass
-            plaintexts.append(ptxt)
-        return plaintexts
+    def gather(self, url_name, params):
+        """Return the list of responses to a GET of the named URL."""
+        return [self.request('get', getattr(self, url_name), params=params)]
+
+    def search(self, processes=0, since=None, until=None, index=False,
+               **query):
+        """Search for packets matching the query.
 
-    def create(self, **model):
-        encrypted_model = self.encrypt_model(model, paillier_fields=['length'])
+        If since or until are given, only packets captured in [since, until)
+        are searched; see time_params. If index is true, the query is looked
+        up in the server's inverted index instead of matched against every
+        row; see query_params. By default, each result is a LazyModel that
+        decrypts fields on first access. If processes is nonzero, results are
+        instead decrypted eagerly across a pool of worker processes (None
+        uses one per CPU) and any rows that fail to decrypt are dropped.
+
+        """
+        encrypted_query = self.query_params(query, index)
+        encrypted_query.update(self.time_params(since, until))
+        resps = self.gather('packet_url', encrypted_query)
+        # unchanged responses are the cached objects, already decrypted
+        key = (processes != 0, tuple(sorted(encrypted_query.items())))
+        cached = self.results.get(key)
+        if (cached is not None and len(cached[0]) == len(resps)
+                and all(old is new for old, new in zip(cached[0], resps))):
+            return list(cached[1])
+        resp = [model for models in resps for model in models]
+        options = {'paillier_fields': ('length',),
+                   'exclude_fields': PLAIN_FIELDS}
+        if processes != 0:
+            results = self.decrypt_models(resp, processes=processes,
+                                          **options)
+        else:
+            results = [self.lazy_decrypt_model(model, **options)
+                       for model in resp]
+        self.results.put(key, (resps, results), len(results))
+        return list(results)
+
+    def create(self, prefixes=False, index=False, buckets=None, **model):
+        """Add a packet.
+
+        If prefixes is true, the networks containing its source and
+        destination are indexed as well, so that searches by network (see
+        edb.client.prefix_query) find it. If index is true, the packet's
+        keyword tags are sent for the server's inverted index. If buckets
+        are given, such as LENGTH_BUCKETS, the packet's length bucket is
+        stored for histograms.
+
+        """
+        encrypted_model = self.encrypt_packet(model, prefixes, index,
+                                              buckets)
         self.request('post', self.packet_url, data=encrypted_model)
 
-    def correlate(self, source, destination):
+    def encrypt_packet(self, model, prefixes=False, index=False,
+                       buckets=None):
+        """Encrypt a packet, leaving its capture time in plaintext and
+        adding the fingerprint of the keys.
+
+        The capture time may be a datetime, ISO 8601 string or Unix
+        timestamp; it is sent in ISO 8601.
+
+        """
+        if model.get('captured_at') is None:
+            model.pop('captured_at', None)
+        else:
+            model['captured_at'] = iso_time(model['captured_at'])
+        model['key_id'] = self.key_id()
+        prefix_fields = ('source', 'destination') if prefixes else ()
+        index_fields = ('source', 'destination', 'protocol') if index else ()
+        bucket_fields = {'length': buckets} if buckets else None
+        return self.encrypt_model(model,
+                                  exclude_fields=['captured_at', 'key_id'],
+                                  paillier_fields=['length'],
+                                  prefix_fields=prefix_fields,
+                                  index_fields=index_fields,
+                                  bucket_fields=bucket_fields)
+
+    def query_params(self, query, index=False):
+        """Return the encrypted params of a query.
+
+        The params hold one token per field to match against every row or,
+        if index is true, the keyword tags to look up in the inverted index.
+        Only packets added with index=True are found by indexed queries.
+
+        """
+        if index and query:
+            return {'index': self.index_query(query)}
+        return self.encrypt_query(query)
+
+    def page(self, after_id=0, limit=REKEY_BATCH, cache=True):
+        """Return up to limit encrypted packets with ids above after_id."""
+        resp = self.request('get', self.packet_url, cache=cache,
+                            params={'after_id': after_id, 'limit': limit})
+        if not isinstance(resp, list):
+            raise EDBError('received invalid response from server')
+        return resp
+
+    def pages(self, batch=TOP_BATCH):
+        """Yield every encrypted packet, a page of up to batch at a time.
+
+        The next page is fetched while the caller handles the current one.
+        Pages are not kept in the response cache, so only two are held in
+        memory however large the table.
+
+        """
+        fetcher = ThreadPoolExecutor(max_workers=1)
+        try:
+            page = fetcher.submit(self.page, 0, batch, False)
+            while True:
+                models = page.result()
+                if not models:
+                    return
+                page = fetcher.submit(self.page, models[-1]['id'], batch,
+                                      False)
+                yield models
+        finally:
+            fetcher.shutdown()
+
+    def top(self, field, k, batch=TOP_BATCH, processes=None, sketch=None):
+        """Find the k most frequent values of a field across every packet.
+
+        The table is streamed with pages and the field decrypted in a pool of
+        worker processes (None starts one per CPU, 0 decrypts in this
+        process). Counts go into a CountMinSketch (sketch, or one of the
+        default size), so memory stays bounded however many rows and
+        distinct values there are; see edb.sketch for the error bounds.
+
+        Return (heavy, skipped): a TopK of the values, as bytes, and the
+        number of packets that could not be decrypted.
+
+        """
+        heavy = TopK(k, sketch)
+        skipped = 0
+        keys = crypto.preserialize_keyinfo(self.keys)
+        pool = None
+        if processes != 0:
+            pool = multiprocessing.Pool(processes, _init_top_worker,
+                                        (keys, field))
+        else:
+            _init_top_worker(keys, field)
+        try:
+            for models in self.pages(batch):
+                chunks = [models[i:i + TOP_CHUNK]
+                          for i in range(0, len(models), TOP_CHUNK)]
+                if pool is not None:
+                    counts = pool.imap_unordered(_top_worker, chunks)
+                else:
+                    counts = map(_top_worker, chunks)
+                for values, failed in counts:
+                    for value, count in values.items():
+                        heavy.add(value, count)
+                    skipped += failed
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return heavy, skipped
+
+    def bulk_update(self, rows):
+        """Replace the fields of many encrypted packets, given with their ids."""
+        resp = self.request('post', self.bulk_url, data=json.dumps(rows),
+                            headers={'Content-Type': 'application/json'})
+        return resp['updated']
+
+    def rekey(self, new_keys, checkpoint, batch=REKEY_BATCH, processes=None,
+              prefixes=False, index=False, buckets=None):
+        """Re-encrypt every packet on the server under new_keys.
+
+        Packets are paged out by id, re-encrypted in a pool of worker
+        processes (None starts one per CPU) while the next page is fetched,
+        and written back in place. After each page, progress is saved to the
+        checkpoint file, from which an interrupted run resumes. A finished
+        run is recorded there too, since decrypting rows with the wrong keys
+        would silently corrupt them.
+
+        Each packet carries the fingerprint of its keys, which is rewritten
+        with it, so a page that was written back before its checkpoint was
+        saved is recognized when the run resumes and not re-encrypted again.
+        Packets under keys other than self's or new_keys are skipped.
+
+        Network columns, index tags and length bucket counters are written
+        for the new keys if prefixes, index and buckets are given, and
+        cleared otherwise.
+
+        Return (rekeyed, skipped): the numbers of packets re-encrypted and
+        of packets that could not be decrypted and were left as they were.
+
+        """
+        state = {'after_id': 0, 'rekeyed': 0, 'skipped': 0, 'done': False}
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as rfile:
+                state.update(json.load(rfile))
+        if state['done']:
+            raise EDBError('rekey already finished according to ' + checkpoint)
+        keys = (crypto.preserialize_keyinfo(self.keys),
+                crypto.preserialize_keyinfo(new_keys), prefixes, index,
+                buckets)
+        pool = multiprocessing.Pool(processes, _init_rekey_worker, keys)
+        fetcher = ThreadPoolExecutor(max_workers=1)
+        try:
+            page = fetcher.submit(self.page, state['after_id'], batch, False)
+            while True:
+                models = page.result()
+                if not models:
+                    break
+                page = fetcher.submit(self.page, models[-1]['id'], batch,
+                                      False)
+                results = pool.map(_rekey_worker, models, chunksize=16)
+                rows = [row for row in results if isinstance(row, dict)]
+                if rows:
+                    self.bulk_update(rows)
+                done = len(rows) + results.count(REKEYED)
+                state['after_id'] = models[-1]['id']
+                state['rekeyed'] += done
+                state['skipped'] += len(models) - done
+                save_checkpoint(state, checkpoint)
+        finally:
+            pool.close()
+            pool.join()
+            fetcher.shutdown()
+        state['done'] = True
+        save_checkpoint(state, checkpoint)
+        return state['rekeyed'], state['skipped']
+
+    def sync(self, mirror, batch=SYNC_BATCH, processes=0, prune=False):
+        """Copy the packets added since the last sync into a local Mirror.
+
+        Packets are decrypted in this process, or in a pool of worker
+        processes if processes is nonzero (None starts one per CPU); those
+        that fail to decrypt are skipped. If prune is true, packets deleted
+        on the server are removed from the mirror too.
+
+        Return (added, removed).
+
+        """
+        options = {'paillier_fields': ('length',),
+                   'exclude_fields': PLAIN_FIELDS}
+        added = 0
+        after_id = mirror.last_id()
+        while True:
+            models = self.page(after_id, batch, cache=False)
+            if not models:
+                break
+            if processes != 0:
+                packets = self.decrypt_models(models, processes=processes,
+                                              **options)
+            else:
+                packets = []
+                for model in models:
+                    try:
+                        packets.append(self.decrypt_model(model, **options))
+                    except EDBError:
+                        continue
+            after_id = models[-1]['id']
+            mirror.append(packets, after_id)
+            added += len(packets)
+        removed = self.prune_mirror(mirror) if prune else 0
+        return added, removed
+
+    def prune_mirror(self, mirror):
+        """Remove packets deleted on the server from a Mirror.
+
+        Server ids are compared with the mirror's a page at a time. Return
+        the number of packets removed.
+
+        """
+        removed = 0
+        after_id = 0
+        while True:
+            resp = self.request('get', self.ids_url,
+                                params={'after_id': after_id,
+                                        'limit': ID_PAGE})
+            ids = resp.get('ids')
+            if not isinstance(ids, list):
+                raise EDBError('received invalid response from server')
+            last_id = ids[-1] if ids else None
+            gone = set(mirror.ids(after_id, last_id)) - set(ids)
+            mirror.delete(gone)
+            removed += len(gone)
+            if not ids:
+                return removed
+            after_id = last_id
+
+    def subscribe(self, **query):
+        """Register a standing query and return its subscription id."""
+        if not query:
+            raise EDBError('a subscription needs at least one field')
+        resp = self.request('post', self.subscription_url,
+                            data=self.encrypt_query(query))
+        try:
+            return int(resp['id'])
+        except (KeyError, ValueError, TypeError):
+            raise EDBError('received invalid response from server')
+
+    def poll(self, subscription, after=0, wait=WATCH_WAIT):
+        """Return (last, packets): the packets matched after match id after.
+
+        The server waits up to wait seconds for a match. Pass last as after
+        in the next poll to acknowledge these packets.
+
+        """
+        url = '{}{}/'.format(self.subscription_url, subscription)
+        resp = self.request('get', url, params={'after': after, 'wait': wait})
+        try:
+            last, results = int(resp['last']), resp['results']
+        except (KeyError, ValueError, TypeError):
+            raise EDBError('received invalid response from server')
+        options = {'paillier_fields': ('length',),
+                   'exclude_fields': PLAIN_FIELDS}
+        return last, [self.lazy_decrypt_model(model, **options)
+                      for model in results]
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription."""
+        self.request('delete', '{}{}/'.format(self.subscription_url,
+                                                subscription))
+
+    def watch(self, **query):
+        """Yield packets matching the query as they are added.
+
+        The subscription is removed when the generator is closed.
+
+        """
+        subscription = self.subscribe(**query)
+        try:
+            last = 0
+            while True:
+                last, packets = self.poll(subscription, last)
+                yield from packets
+        finally:
+            self.unsubscribe(subscription)
+
+    def correlate(self, source, destination, since=None, until=None):
         params = self.encrypt_query({'source': source, 'destination': destination})
-        resp = self.request('get', self.correlate_url, params=params)
+        params.update(self.time_params(since, until))
+        resps = self.gather('correlate_url', params)
         try:
-            return float(resp['coefficient'])
+            srccount = sum(int(resp['source_count']) for resp in resps)
+            bothcount = sum(int(resp['both_count']) for resp in resps)
         except (ValueError, KeyError):
             raise EDBError('received invalid response from server')
+        return (bothcount / srccount) if srccount != 0 else 0.0
 
-    def count(self, **query):
-        params = self.encrypt_query(query)
-        resp = requests.get(self.count_url, params=params).json()
+    def count(self, approximate=False, fraction=None, rows=None, since=None,
+              until=None, index=False, **query):
+        """Count packets matching the query.
+
+        If approximate is true, the server only checks a random sample of
+        rows: a fraction of the table, or at most the given number of rows
+        (APPROX_ROWS if neither is given). The result is then an Estimate
+        with a 95% confidence interval. Across shards, the number of rows is
+        split between them.
+
+        """
+        params = self.query_params(query, index)
+        params.update(self.time_params(since, until))
+        if approximate:
+            params.update(self.sample_params(fraction, rows))
+        resps = self.gather('count_url', params)
         try:
-            return int(resp['count'])
-        except (ValueError, KeyError):
+            total = sum(int(resp['count']) for resp in resps)
+            if not approximate:
+                return total
+            counts = [int(resp['count']) for resp in resps]
+            lows = [int(resp['interval'][0]) for resp in resps]
+            highs = [int(resp['interval'][1]) for resp in resps]
+        except (ValueError, KeyError, IndexError, TypeError):
             raise EDBError('received invalid response from server')
+        # shards sample independently, so their errors add in quadrature
+        below = math.sqrt(sum((count - low) ** 2
+                              for count, low in zip(counts, lows)))
+        above = math.sqrt(sum((high - count) ** 2
+                              for count, high in zip(counts, highs)))
+        return Estimate(total, int(math.floor(total - below)),
+                        int(math.ceil(total + above)))
 
-    def average(self, **query):
-        params = self.encrypt_query(query)
+    def average(self, approximate=False, fraction=None, rows=None,
+                since=None, until=None, index=False, **query):
+        """Average length of packets matching the query.
+
+        If approximate is true, only a random sample of rows is averaged; see
+        count for the sample size.
+
+        """
+        params = self.query_params(query, index)
+        params.update(self.time_params(since, until))
+        if approximate:
+            params.update(self.sample_params(fraction, rows))
         key = self.keys['paillier']
         params.update(modulus=str(key.modulus), generator=str(key.generator))
-        resp = self.request('get', self.average_url, params=params)
-        if 'count' not in resp or 'sum' not in resp:
+        resps = self.gather('average_url', params)
+        if any('count' not in resp or 'sum' not in resp for resp in resps):
             raise EDBError('received invalid response from server')
-        count = self.paillier_decrypt(resp['count'])
-        total = self.paillier_decrypt(resp['sum'])
+        # multiplication mod n^2 adds the encrypted shard totals
+        nsquared = key.modulus * key.modulus
+        ctxt_count, ctxt_total = 1, 1
+        for resp in resps:
+            ctxt_count = (ctxt_count * int(resp['count'])) % nsquared
+            ctxt_total = (ctxt_total * int(resp['sum'])) % nsquared
+        count = self.paillier_decrypt(ctxt_count)
+        total = self.paillier_decrypt(ctxt_total)
         return (total / count) if count != 0 else 0
+
+    def group_average(self, field, values, since=None, until=None, **query):
+        """Average length of the packets matching each value of one field.
+
+        The server computes the averages of up to GROUP_BATCH values in a
+        single scan. Return a dict mapping each value to its average (0 if
+        nothing matched).
+
+        """
+        values = list(values)
+        averages = {}
+        for start in range(0, len(values), GROUP_BATCH):
+            averages.update(self._group_average(
+                field, values[start:start + GROUP_BATCH], since, until,
+                query))
+        return averages
+
+    def _group_average(self, field, values, since, until, query):
+        params = self.encrypt_query(query)
+        params.update(self.time_params(since, until))
+        params.update(group_by=field, groups=','.join(
+            self.query(value).strip() for value in values))
+        key = self.keys['paillier']
+        params.update(modulus=str(key.modulus), generator=str(key.generator))
+        resps = self.gather('group_average_url', params)
+        for resp in resps:
+            groups = resp.get('groups')
+            if (not isinstance(groups, list) or len(groups) != len(values)
+                    or any('count' not in group or 'sum' not in group
+                           for group in groups)):
+                raise EDBError('received invalid response from server')
+        nsquared = key.modulus * key.modulus
+        averages = {}
+        for i, value in enumerate(values):
+            ctxt_count, ctxt_total = 1, 1
+            for resp in resps:
+                group = resp['groups'][i]
+                ctxt_count = (ctxt_count * int(group['count'])) % nsquared
+                ctxt_total = (ctxt_total * int(group['sum'])) % nsquared
+            count = self.paillier_decrypt(ctxt_count)
+            total = self.paillier_decrypt(ctxt_total)
+            averages[value] = (total / count) if count != 0 else 0
+        return averages
+
+    def histogram(self, buckets=LENGTH_BUCKETS, since=None, until=None,
+                  index=False, **query):
+        """Count the packets matching the query in each length bucket.
+
+        Only packets added with the same buckets are counted; the server
+        adds up their encrypted bucket counters in a single scan. Return
+        (counts, uncounted): the len(buckets) + 1 bucket counts (see
+        edb.client.bucket_index) and the number of matching packets added
+        without counters or with other buckets. See estimate_percentile for
+        percentiles.
+
+        """
+        params = self.query_params(query, index)
+        params.update(self.time_params(since, until))
+        key = self.keys['paillier']
+        params.update(modulus=str(key.modulus), generator=str(key.generator),
+                      scheme=bucket_scheme(buckets))
+        resps = self.gather('histogram_url', params)
+        nsquared = key.modulus * key.modulus
+        ctxt, uncounted = 1, 0
+        try:
+            for resp in resps:
+                ctxt = (ctxt * int(resp['buckets'])) % nsquared
+                uncounted += int(resp['uncounted'])
+        except (ValueError, KeyError, TypeError):
+            raise EDBError('received invalid response from server')
+        return self.decrypt_buckets(ctxt, buckets), uncounted
+
+    def time_params(self, since=None, until=None):
+        """Return the query params limiting it to packets captured in
+        [since, until), each a datetime, ISO 8601 string or Unix timestamp.
+        """
+        params = {}
+        for name, value in (('since', since), ('until', until)):
+            if value is not None:
+                params[name] = iso_time(value)
+        return params
+
+    def sample_params(self, fraction=None, rows=None):
+        """Return the query params asking for a sampled result."""
+        params = {}
+        if fraction is not None:
+            params['approx'] = str(fraction)
+        if rows is not None or fraction is None:
+            params['approx_rows'] = str(rows or APPROX_ROWS)
+        return params
+
+class ShardedClient(Client):
+    """Client for a table split across several servers.
+
+    New rows are hashed to one shard. Queries are sent to every shard in
+    parallel and their responses are merged by Client.
+
+    Parameters:
+
+    keyfile (optional)
+      path to file containing client keys
+
+    shards
+      list of (host, port) pairs, one per shard server
+
+    """
+
+    def __init__(self, keyfile=None, shards=(), _keyinfo=None):
+        if not shards:
+            raise EDBError('at least one shard is required')
+        host, port = shards[0]
+        super().__init__(keyfile, host, port, _keyinfo)
+        self.shards = [Client(host=host, port=port, _keyinfo=self.keys)
+                       for host, port in shards]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards))
+
+    def gather(self, url_name, params):
+        return list(self.executor.map(
+            lambda shard: shard.gather(url_name, params)[0], self.shards))
+
+    def create(self, prefixes=False, index=False, buckets=None, **model):
+        encrypted_model = self.encrypt_packet(model, prefixes, index,
+                                              buckets)
+        shard = self.shard_for(encrypted_model)
+        shard.request('post', shard.packet_url, data=encrypted_model)
+
+    def subscribe(self, **query):
+        raise EDBError('watching is not supported across shards')
+
+    def pages(self, batch=TOP_BATCH):
+        # ids are only ordered within a shard, so page each in turn
+        for shard in self.shards:
+            yield from shard.pages(batch)
+
+    def sync(self, mirror, **options):
+        # packet ids are only unique within a shard
+        raise EDBError('mirrors are not supported across shards')
+
+    def rekey(self, new_keys, checkpoint, **options):
+        """Re-encrypt every shard in turn, each with its own checkpoint."""
+        rekeyed, skipped = 0, 0
+        for number, shard in enumerate(self.shards):
+            shard_checkpoint = '{}.{}'.format(checkpoint, number)
+            counts = shard.rekey(new_keys, shard_checkpoint, **options)
+            rekeyed += counts[0]
+            skipped += counts[1]
+        return rekeyed, skipped
+
+    def sample_params(self, fraction=None, rows=None):
+        # each shard scales its own sample up to its own rows, so the
+        # sample size is split between them
+        if fraction is None:
+            rows = -(-(rows or APPROX_ROWS) // len(self.shards))
+        return super().sample_params(fraction, rows)
+
+    def shard_for(self, encrypted_model):
+        """Return the shard that should store an encrypted row."""
+        digest = zlib.crc32(encrypted_model['source'].encode())
+        return self.shards[digest % len(self.shards)]
+
+def iso_time(value):
+    """Return a datetime, ISO 8601 string or Unix timestamp in ISO 8601.
+
+    Timestamps are taken to be UTC. Other strings are returned as they are,
+    for the server to validate.
+
+    """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    try:
+        timestamp = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    try:
+        return datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc).isoformat()
+    except (OverflowError, OSError, ValueError):
+        raise EDBError('invalid timestamp {!r}'.format(value))
+
+def error_message(resp, status):
+    """Return the message of an error response without a detail, such as
+    the field errors of a rejected row."""
+    if isinstance(resp, dict) and resp:
+        return '; '.join('{}: {}'.format(
+            field, ' '.join(map(str, errors)) if isinstance(errors, list)
+            else errors) for field, errors in sorted(resp.items()))
+    return 'server returned status {}'.format(status)
+
+class LRUCache:
+    """Least recently used cache, bounded in entries and in total rows.
+
+    Parameters:
+
+    size (optional)
+      most entries kept
+
+    max_rows (optional)
+      most rows kept in all; a value of more rows is not kept at all
+
+    """
+
+    def __init__(self, size=CACHE_SIZE, max_rows=CACHE_ROWS):
+        self.size = size
+        self.max_rows = max_rows
+        # key -> (value, rows), least recently used first
+        self.entries = collections.OrderedDict()
+        self.rows = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value stored under key, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, rows=1):
+        """Store a value of the given number of rows under key."""
+        self.discard(key)
+        if rows > self.max_rows:
+            return
+        self.entries[key] = (value, rows)
+        self.rows += rows
+        while len(self.entries) > self.size or self.rows > self.max_rows:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.rows -= evicted
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.rows -= entry[1]
+
+def response_rows(resp):
+    """Return the number of rows in a decoded response."""
+    return len(resp) if isinstance(resp, list) else 1
+
+def estimate_percentile(bounds, counts, percentile):
+    """Estimate a percentile of lengths from their bucket counts.
+
+    Values are assumed to be spread evenly within each bucket, the first
+    starting at 0. A percentile falling in the last bucket, which has no
+    upper bound, is estimated as its lower bound. Return None if there are
+    no values.
+
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = total * min(max(percentile, 0), 100) / 100
+    seen = 0
+    edges = [0] + list(bounds)
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if i == len(bounds):
+                return edges[i]
+            return edges[i] + (bounds[i] - edges[i]) * (rank - seen) / count
+        seen += count
+    return edges[-1]
+
+def save_checkpoint(state, path):
+    """Atomically replace a rekey checkpoint file."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as wfile:
+        json.dump(state, wfile)
+    os.replace(tmp_path, path)
+
+_rekey_state = None
+
+# Returned by _rekey_worker for packets already under the new keys.
+REKEYED = 'rekeyed'
+
+def _init_rekey_worker(old_keys, new_keys, prefixes, index, buckets):
+    global _rekey_state
+    old = Client(_keyinfo=crypto.postdeserialize_keyinfo(old_keys))
+    new = Client(_keyinfo=crypto.postdeserialize_keyinfo(new_keys))
+    _rekey_state = (old, new, old.key_id(), new.key_id(), prefixes, index,
+                    buckets)
+
+def _rekey_worker(model):
+    """Return the packet re-encrypted under the new keys, REKEYED if it
+    already is, or None if it is under other keys or cannot be decrypted.
+
+    Packets stored before key fingerprints were have none, and are taken to
+    be under the old keys.
+
+    """
+    old, new, old_id, new_id, prefixes, index, buckets = _rekey_state
+    key_id = model.get('key_id')
+    if key_id == new_id:
+        return REKEYED
+    if key_id and key_id != old_id:
+        return None
+    try:
+        packet = old.decrypt_model(model, exclude_fields=PLAIN_FIELDS,
+                                   paillier_fields=('length',))
+    except EDBError:
+        return None
+    pk = packet.pop('id')
+    # the capture time is plaintext and stays as it is
+    packet.pop('captured_at', None)
+    packet.pop('key_id', None)
+    row = new.encrypt_packet(packet, prefixes, index, buckets)
+    if not buckets:
+        row[bucket_field('length')] = ''
+        row[bucket_scheme_field('length')] = ''
+    if not prefixes:
+        for field in ('source', 'destination'):
+            for length in IP_PREFIXES:
+                row[prefix_field(field, length)] = ''
+    if not index:
+        row['index'] = ''
+    row['id'] = pk
+    return row
+
+_top_state = None
+
+def _init_top_worker(keys, field):
+    global _top_state
+    _top_state = (Client(_keyinfo=crypto.postdeserialize_keyinfo(keys)), field)
+
+def _top_worker(models):
+    """Return (counts, failed) for one field of a list of packets."""
+    client, field = _top_state
+    values = collections.Counter()
+    failed = 0
+    for model in models:
+        try:
+            if field == 'length':
+                value = str(client.paillier_decrypt(model[field])).encode()
+            else:
+                value = client.decrypt(model[field])
+        except (EDBError, KeyError, ValueError, TypeError):
+            failed += 1
+            continue
+        values[value] += 1
+    return values, failed
+
+def parse_shards(shards):
+    """Parse a comma-separated list of host:port pairs."""
+    pairs = []
+    for shard in shards.split(','):
+        host, _, port = shard.strip().rpartition(':')
+        try:
+            pairs.append((host or 'localhost', int(port)))
+        except ValueError:
+            raise EDBError('invalid shard {!r}, expected host:port'.format(shard))
+    return pairs
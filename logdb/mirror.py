@@ -0,0 +1,186 @@
+"""Local decrypted mirror of the packet table.
+
+`client sync` downloads the packets added since the last sync, decrypts them
+once and appends them to a local SQLite database, and `--local` answers
+queries from it. The mirror holds plaintext, so it should be protected like
+the keyfile.
+"""
+import sqlite3
+import calendar
+import datetime
+import ipaddress
+
+from edb.errors import EDBError
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packet (
+    id INTEGER PRIMARY KEY,
+    source TEXT,
+    destination TEXT,
+    protocol TEXT,
+    length INTEGER,
+    captured_at TEXT,
+    -- Unix time of captured_at, for range queries
+    captured REAL,
+    -- IPv4 addresses as integers, for network queries
+    source_ip INTEGER,
+    destination_ip INTEGER
+);
+CREATE INDEX IF NOT EXISTS packet_source ON packet (source);
+CREATE INDEX IF NOT EXISTS packet_destination ON packet (destination);
+CREATE INDEX IF NOT EXISTS packet_protocol ON packet (protocol);
+CREATE INDEX IF NOT EXISTS packet_captured ON packet (captured);
+CREATE INDEX IF NOT EXISTS packet_source_ip ON packet (source_ip);
+CREATE INDEX IF NOT EXISTS packet_destination_ip ON packet (destination_ip);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+'''
+
+FIELDS = ('source', 'destination', 'protocol', 'length', 'captured_at')
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+def parse_time(value):
+    """Return the Unix time of a timestamp or ISO 8601 UTC datetime."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    text = value
+    for suffix in ('Z', '+00:00'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+    for fmt in TIME_FORMATS:
+        try:
+            moment = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+    raise EDBError('invalid time {!r}, expected an ISO 8601 UTC datetime or '
+                   'Unix timestamp'.format(value))
+
+def ip_number(address):
+    """Return an IPv4 address as an integer, or None."""
+    try:
+        return int(ipaddress.IPv4Address(address))
+    except ValueError:
+        return None
+
+def text(value):
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode(errors='replace')
+    return value
+
+class Mirror:
+    """Local SQLite store of decrypted packets.
+
+    Parameters:
+
+    path
+      path of the SQLite database, created if missing
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def last_id(self):
+        """Return the highest server id synced so far."""
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'last_id'").fetchone()
+        return row[0] if row else 0
+
+    def append(self, packets, last_id):
+        """Store decrypted packets and advance the last synced id."""
+        rows = []
+        for packet in packets:
+            source = text(packet['source'])
+            destination = text(packet['destination'])
+            rows.append((packet['id'], source, destination,
+                         text(packet['protocol']), packet['length'],
+                         packet.get('captured_at'),
+                         parse_time(packet.get('captured_at')),
+                         ip_number(source), ip_number(destination)))
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO packet VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('last_id', ?)", (last_id,))
+
+    def ids(self, after_id=0, last_id=None):
+        """Return the stored ids in (after_id, last_id], in order."""
+        sql = 'SELECT id FROM packet WHERE id > ?'
+        args = [after_id]
+        if last_id is not None:
+            sql += ' AND id <= ?'
+            args.append(last_id)
+        return [row[0] for row in self.conn.execute(sql + ' ORDER BY id', args)]
+
+    def delete(self, ids):
+        """Remove packets deleted on the server."""
+        with self.conn:
+            self.conn.executemany('DELETE FROM packet WHERE id = ?',
+                                  [(pk,) for pk in ids])
+
+    def where(self, query, since=None, until=None):
+        """Return the SQL condition and arguments for a plaintext query.
+
+        Query keys are field names, or prefix columns such as source_p24
+        (see edb.client.prefix_query) for network queries.
+
+        """
+        clauses, args = [], []
+        for name, value in sorted(query.items()):
+            field, _, length = name.partition('_p')
+            if length.isdigit():
+                network = ipaddress.IPv4Network(text(value), strict=False)
+                clauses.append('{}_ip BETWEEN ? AND ?'.format(field))
+                args.extend([int(network.network_address),
+                             int(network.broadcast_address)])
+            elif field in FIELDS[:3]:
+                clauses.append('{} = ?'.format(field))
+                args.append(text(value))
+            else:
+                raise EDBError('cannot query field {!r}'.format(name))
+        if since is not None:
+            clauses.append('captured >= ?')
+            args.append(parse_time(since))
+        if until is not None:
+            clauses.append('captured < ?')
+            args.append(parse_time(until))
+        return ' AND '.join(clauses) or '1', args
+
+    def search(self, since=None, until=None, **query):
+        """Return the packets matching the query, as dicts."""
+        condition, args = self.where(query, since, until)
+        cursor = self.conn.execute(
+            'SELECT id, {} FROM packet WHERE {} ORDER BY id'.format(
+                ', '.join(FIELDS), condition), args)
+        return [dict(row) for row in cursor]
+
+    def count(self, since=None, until=None, **query):
+        condition, args = self.where(query, since, until)
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM packet WHERE ' + condition, args).fetchone()[0]
+
+    def average(self, since=None, until=None, **query):
+        condition, args = self.where(query, since, until)
+        average = self.conn.execute(
+            'SELECT AVG(length) FROM packet WHERE ' + condition,
+            args).fetchone()[0]
+        return average or 0
+
+    def correlate(self, source, destination, since=None, until=None):
+        srccount = self.count(since, until, source=source)
+        if srccount == 0:
+            return 0.0
+        both = self.count(since, until, source=source, destination=destination)
+        return both / srccount
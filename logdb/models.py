@@ -1,9 +1,41 @@
 from django.db import models
 
-from edb.server.models import EncryptedModel
+from edb.server.models import EncryptedModel, INDEX
 
 class Packet(EncryptedModel):
     source = models.CharField(max_length=700)
     destination = models.CharField(max_length=700)
     protocol = models.CharField(max_length=700)
     length = models.CharField(max_length=700)
+    # plaintext, so that time ranges can be pruned with the index
+    captured_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # plaintext fingerprint of the client keys the row is encrypted with
+    key_id = models.CharField(max_length=64, blank=True)
+
+    # encrypted networks containing the source and destination addresses,
+    # stored only when the client indexes prefixes
+    source_p8 = models.CharField(max_length=700, blank=True)
+    source_p16 = models.CharField(max_length=700, blank=True)
+    source_p24 = models.CharField(max_length=700, blank=True)
+    destination_p8 = models.CharField(max_length=700, blank=True)
+    destination_p16 = models.CharField(max_length=700, blank=True)
+    destination_p24 = models.CharField(max_length=700, blank=True)
+
+    # Paillier-encrypted packed counters of the length's bucket, and the
+    # plaintext fingerprint of the bucket bounds, stored only when the client
+    # asks for histograms
+    length_buckets = models.CharField(max_length=700, blank=True)
+    length_bucket_scheme = models.CharField(max_length=64, blank=True)
+
+    encrypted_fields = ('source', 'destination', 'protocol',
+                        'source_p8', 'source_p16', 'source_p24',
+                        'destination_p8', 'destination_p16', 'destination_p24')
+    paillier_fields = ('length', 'length_buckets')
+    time_field = 'captured_at'
+    search_mode = INDEX
+
+# Columns used only to search by network, left out of API responses.
+PREFIX_FIELDS = Packet.encrypted_fields[3:]
+
+# Columns used only to compute histograms, also left out of API responses.
+BUCKET_FIELDS = ('length_buckets', 'length_bucket_scheme')
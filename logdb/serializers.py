@@ -1,7 +1,15 @@
 from rest_framework import serializers
 
-from logdb.models import Packet
+from logdb.models import Packet, BUCKET_FIELDS, PREFIX_FIELDS
 
 class PacketSerializer(serializers.ModelSerializer):
     class Meta:
         model = Packet
+
+    def to_native(self, obj):
+        native = super().to_native(obj)
+        # prefix and bucket columns can be written and computed on, but are
+        # never read
+        for name in PREFIX_FIELDS + BUCKET_FIELDS:
+            native.pop(name, None)
+        return native
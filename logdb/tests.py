@@ -1,3 +1,594 @@
-from django.test import TestCase
+import io
+import contextlib
+import os
+import shutil
+import datetime
+import tempfile
+import itertools
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db.models.query import QuerySet
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from edb import crypto
+from edb.client import Client, bucket_scheme, prefix_query
+from edb.errors import EDBError
+from edb.server import etags, metrics, models, sampling, snapshots
+from edb.server.models import IndexEntry
+from edb.server.snapshots import restore, write_snapshot
+from logdb import client as logdb_client
+from logdb.models import Packet
+
+class ViewTestCase(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.api = APIClient()
+        rows = [(b'10.0.0.1', b'10.0.0.2', b'TCP', 60),
+                (b'10.0.0.1', b'10.0.0.3', b'UDP', 40),
+                (b'10.0.0.2', b'10.0.0.3', b'TCP', 50)]
+        for source, destination, protocol, length in rows:
+            model = {'source': source, 'destination': destination,
+                     'protocol': protocol, 'length': length}
+            Packet.objects.create(**self.client.encrypt_model(
+                model, paillier_fields=['length']))
+
+    def get(self, path, extra=None, **query):
+        params = self.client.encrypt_query(query)
+        params.update(extra or {})
+        return self.api.get(path, params)
+
+    def test_count(self):
+        resp = self.get('/compute/count/', protocol=b'TCP')
+        self.assertEqual(resp.data, {'count': 2})
+        self.assertNotIn('X-EDB-Rows-Scanned', resp)
+
+    def test_explain(self):
+        resp = self.get('/compute/count/', {'explain': '1'}, protocol=b'TCP')
+        self.assertEqual(resp.data['count'], 2)
+        self.assertEqual(resp.data['explain']['rows_scanned'], 3)
+        self.assertEqual(resp['X-EDB-Rows-Matched'], '2')
+        self.assertIn('match;dur=', resp['Server-Timing'])
+
+    def test_metrics(self):
+        self.get('/compute/count/', protocol=b'TCP')
+        resp = self.api.get('/metrics')
+        text = resp.content.decode()
+        self.assertIn('# TYPE edb_rows_scanned_total counter', text)
+        self.assertIn('edb_request_duration_seconds_count'
+                      '{endpoint="count"}', text)
+        # unknown paths share one series
+        self.api.get('/no/such/path/1')
+        self.api.get('/no/such/path/2')
+        text = self.api.get('/metrics').content.decode()
+        self.assertIn('edb_request_duration_seconds_count'
+                      '{endpoint="other"}', text)
+        self.assertNotIn('path', text)
+        self.assertEqual(metrics.escape_label('a\\b"c\nd'),
+                         'a\\\\b\\"c\\nd')
+
+    def test_timeout(self):
+        # every clock reading is ten seconds after the last
+        clock = mock.patch('time.monotonic',
+                           side_effect=itertools.count(0, 10).__next__)
+        with clock, self.settings(EDB_QUERY_TIMEOUT_MS=1):
+            resp = self.get('/compute/count/', protocol=b'TCP')
+            self.assertEqual(resp.status_code, 503)
+            resp = self.get('/compute/count/', {'partial': '1'},
+                            protocol=b'TCP')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.data['partial'])
+        self.assertEqual(resp.data['count'], 0)
+
+    def test_approximate_count(self):
+        resp = self.get('/compute/count/', {'approx_rows': '3'},
+                        protocol=b'TCP')
+        self.assertEqual(resp.data['count'], 2)
+        self.assertEqual(resp.data['interval'], [2, 2])
+        self.assertEqual(resp.data['sampled'], 3)
+        resp = self.get('/compute/count/', {'approx': '0.5'},
+                        protocol=b'TCP')
+        self.assertEqual(resp.data['sampled'], 2)
+        low, high = resp.data['interval']
+        self.assertTrue(low <= resp.data['count'] <= high)
+
+    def test_estimate_count(self):
+        # no matches in the sample still leaves room for some in the table
+        estimate, low, high = sampling.estimate_count(0, 100, 10000)
+        self.assertEqual((estimate, low), (0, 0))
+        self.assertTrue(300 < high < 500)
+        estimate, low, high = sampling.estimate_count(100, 100, 10000)
+        self.assertEqual((estimate, high), (10000, 10000))
+        self.assertTrue(9500 < low < 9700)
+
+    def test_sample_ids(self):
+        Packet.objects.bulk_create([Packet(source='x', destination='x',
+                                           protocol='x', length='0')
+                                    for _ in range(300)])
+        pks = list(Packet.objects.order_by('pk').values_list('pk', flat=True))
+        Packet.objects.filter(pk__in=pks[::3]).delete()
+        existing = set(pks) - set(pks[::3])
+        with mock.patch.object(QuerySet, 'order_by') as order_by:
+            ids, total = sampling.sample_ids(Packet.objects, rows=20)
+        # sampled by probing ids, not by sorting the table
+        self.assertFalse(order_by.called)
+        self.assertEqual(total, len(existing))
+        self.assertEqual(len(set(ids)), 20)
+        self.assertLessEqual(set(ids), existing)
+
+    def set_capture_times(self):
+        start = datetime.datetime(2014, 5, 1, tzinfo=timezone.utc)
+        for hour, packet in enumerate(Packet.objects.order_by('pk')):
+            packet.captured_at = start + datetime.timedelta(hours=hour)
+            packet.save()
+
+    def test_time_range(self):
+        self.set_capture_times()
+        resp = self.get('/compute/count/', {'since': '2014-05-01T01:00:00',
+                                            'explain': '1'},
+                        protocol=b'TCP')
+        self.assertEqual(resp.data['count'], 1)
+        self.assertEqual(resp.data['explain']['rows_scanned'], 2)
+        resp = self.get('/packets/', {'until': '2014-05-01T01:00:00Z'},
+                        protocol=b'TCP')
+        self.assertEqual(len(resp.data), 1)
+        self.assertEqual(resp.data[0]['captured_at'],
+                         datetime.datetime(2014, 5, 1, tzinfo=timezone.utc))
+        resp = self.get('/compute/count/', {'since': 'yesterday'},
+                        protocol=b'TCP')
+        self.assertEqual(resp.status_code, 403)
+
+    def test_prune(self):
+        self.set_capture_times()
+        call_command('edb_prune', '2014-05-01T02:00:00', stdout=mock.Mock())
+        self.assertEqual(Packet.objects.count(), 1)
+        # a date alone is midnight at its start
+        call_command('edb_prune', '2014-05-02', stdout=mock.Mock())
+        self.assertEqual(Packet.objects.count(), 0)
+
+    def test_etag(self):
+        hits = etags.ETAG_REQUESTS.values.get(('hit',), 0)
+        misses = etags.ETAG_REQUESTS.values.get(('miss',), 0)
+        params = self.client.encrypt_query({'protocol': b'TCP'})
+        resp = self.api.get('/compute/count/', params)
+        etag = resp['ETag']
+        resp = self.api.get('/compute/count/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        text = self.api.get('/metrics').content.decode()
+        self.assertIn('edb_etag_requests_total{{result="hit"}} {}'.format(
+            hits + 1), text)
+        self.assertIn('edb_etag_requests_total{{result="miss"}} {}'.format(
+            misses + 1), text)
+        resp = self.api.get('/packets/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(resp.data), 2)
+        Packet.objects.first().delete()
+        resp = self.api.get('/compute/count/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    def test_profiling(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(EDB_PROFILE_DIR=tmpdir,
+                                   EDB_PROFILE_SAMPLE=1):
+                self.get('/compute/count/', protocol=b'TCP')
+            names = os.listdir(tmpdir)
+            self.assertEqual(len(names), 3)
+            self.assertTrue(all('-count-' in name for name in names))
+            with override_settings(EDB_PROFILE_DIR=tmpdir,
+                                   EDB_PROFILE_THRESHOLD_MS=60000):
+                self.get('/compute/count/', protocol=b'TCP')
+            self.assertEqual(len(os.listdir(tmpdir)), 3)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_group_average(self):
+        key = self.client.keys['paillier']
+        tokens = [self.client.query(word).strip()
+                  for word in (b'10.0.0.2', b'10.0.0.3', b'10.0.0.9')]
+        resp = self.get('/compute/group_average/', {
+            'group_by': 'destination', 'groups': ','.join(tokens),
+            'modulus': str(key.modulus), 'generator': str(key.generator),
+        }, protocol=b'TCP')
+        sums = [(self.client.paillier_decrypt(int(group['sum'])),
+                 self.client.paillier_decrypt(int(group['count'])))
+                for group in resp.data['groups']]
+        self.assertEqual(sums, [(60, 1), (50, 1), (0, 0)])
+        # the deadline passes after the first row, which is the only one
+        # matched against the groups
+        clock = mock.patch('time.monotonic', side_effect=[0, 0, 100])
+        chunk = mock.patch.object(models, 'SCAN_CHUNK', 1)
+        with clock, chunk:
+            resp = self.get('/compute/group_average/', {
+                'group_by': 'destination', 'groups': ','.join(tokens),
+                'modulus': str(key.modulus), 'generator': str(key.generator),
+                'timeout_ms': '1000', 'partial': '1',
+            })
+        self.assertTrue(resp.data['partial'])
+        self.assertEqual([self.client.paillier_decrypt(int(group['count']))
+                          for group in resp.data['groups']], [1, 0, 0])
+        resp = self.get('/compute/group_average/', {
+            'group_by': 'length', 'groups': tokens[0],
+            'modulus': str(key.modulus), 'generator': str(key.generator),
+        })
+        self.assertEqual(resp.status_code, 403)
+
+    def test_rekey_worker(self):
+        old, new = logdb_client.Client(), logdb_client.Client()
+        logdb_client._init_rekey_worker(
+            crypto.preserialize_keyinfo(old.keys),
+            crypto.preserialize_keyinfo(new.keys), False, False, None)
+        packet = {'source': b'10.0.0.1', 'destination': b'10.0.0.2',
+                  'protocol': b'TCP', 'length': 60}
+        row = dict(old.encrypt_packet(dict(packet)), id=1)
+        rekeyed = logdb_client._rekey_worker(row)
+        self.assertEqual(rekeyed['key_id'], new.key_id())
+        self.assertEqual(new.decrypt(rekeyed['source']), b'10.0.0.1')
+        # a resumed run must not decrypt rekeyed rows with the old keys
+        self.assertEqual(logdb_client._rekey_worker(rekeyed),
+                         logdb_client.REKEYED)
+        other = dict(logdb_client.Client().encrypt_packet(dict(packet)), id=2)
+        self.assertIsNone(logdb_client._rekey_worker(other))
+
+    def test_histogram(self):
+        bounds = [50, 100]
+        for length, row_bounds in ((20, bounds), (70, bounds), (70, bounds),
+                                   (500, bounds), (70, [60])):
+            model = {'source': b'10.0.0.5', 'destination': b'10.0.0.1',
+                     'protocol': b'TCP', 'length': length}
+            Packet.objects.create(**self.client.encrypt_model(
+                model, paillier_fields=['length'],
+                bucket_fields={'length': row_bounds}))
+        key = self.client.keys['paillier']
+        resp = self.get('/compute/histogram/', {
+            'modulus': str(key.modulus), 'generator': str(key.generator),
+            'scheme': bucket_scheme(bounds),
+        }, protocol=b'TCP')
+        self.assertEqual(self.client.decrypt_buckets(
+            int(resp.data['buckets']), bounds), [1, 2, 1])
+        # rows added without counters, or with other bounds, are reported
+        # but not counted
+        self.assertEqual(resp.data['uncounted'], 3)
+        resp = self.api.get('/packets/')
+        self.assertNotIn('length_buckets', resp.data[0])
+        self.assertNotIn('length_bucket_scheme', resp.data[0])
+        resp = self.get('/compute/histogram/', {
+            'modulus': str(key.modulus), 'generator': str(key.generator)})
+        self.assertEqual(resp.status_code, 403)
+
+    def test_prefix_search(self):
+        model = {'source': b'10.0.7.1', 'destination': b'10.0.0.2',
+                 'protocol': b'TCP', 'length': 70}
+        Packet.objects.create(**self.client.encrypt_model(
+            model, paillier_fields=['length'],
+            prefix_fields=['source', 'destination']))
+        resp = self.get('/compute/count/',
+                        **prefix_query('source', '10.0.0.0/16'))
+        self.assertEqual(resp.data['count'], 1)
+        resp = self.get('/packets/',
+                        **prefix_query('destination', '10.0.0.0/24'))
+        self.assertEqual(len(resp.data), 1)
+        self.assertNotIn('source_p8', resp.data[0])
+
+    def test_index(self):
+        for source, protocol in ((b'10.0.0.9', b'TCP'), (b'10.0.0.9', b'UDP')):
+            model = {'source': source, 'destination': b'10.0.0.1',
+                     'protocol': protocol, 'length': 80}
+            data = self.client.encrypt_model(
+                model, paillier_fields=['length'],
+                index_fields=['source', 'destination', 'protocol'])
+            self.assertEqual(self.api.post('/packets/', data).status_code, 201)
+        query = {'index': self.client.index_query(
+            {'source': b'10.0.0.9', 'protocol': b'TCP'}), 'explain': '1'}
+        resp = self.api.get('/compute/count/', query)
+        self.assertEqual(resp.data['count'], 1)
+        self.assertEqual(resp.data['explain']['rows_scanned'], 1)
+        # rows added without tags are only found by scanning
+        query['index'] = self.client.index_query({'protocol': b'TCP'})
+        self.assertEqual(self.api.get('/compute/count/', query).data['count'],
+                         1)
+        # an update of a searchable field without tags drops the postings
+        pk = IndexEntry.objects.first().row
+        query['index'] = self.client.index_query({'source': b'10.0.0.9'})
+        resp = self.api.patch('/packets/{}/'.format(pk),
+                              {'source': self.client.encrypt(b'10.0.0.8')})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.api.get('/compute/count/', query).data['count'],
+                         1)
+        self.assertFalse(IndexEntry.objects.filter(row=pk).exists())
+        Packet.objects.filter(protocol__isnull=False).delete()
+        self.assertEqual(IndexEntry.objects.count(), 0)
+        resp = self.api.get('/compute/count/', {'index': 'not a tag'})
+        self.assertEqual(resp.status_code, 403)
+
+    def test_subscription(self):
+        resp = self.api.post('/subscriptions/',
+                             self.client.encrypt_query({'protocol': b'TCP'}))
+        self.assertEqual(resp.status_code, 201)
+        url = '/subscriptions/{}/'.format(resp.data['id'])
+        for protocol in (b'UDP', b'TCP'):
+            model = {'source': b'10.0.0.4', 'destination': b'10.0.0.1',
+                     'protocol': protocol, 'length': 80}
+            self.api.post('/packets/', self.client.encrypt_model(
+                model, paillier_fields=['length']))
+        resp = self.api.get(url, {'wait': '1'})
+        self.assertEqual(len(resp.data['results']), 1)
+        self.assertEqual(self.client.decrypt(
+            resp.data['results'][0]['protocol']), b'TCP')
+        resp = self.api.get(url, {'after': resp.data['last']})
+        self.assertEqual(resp.data['results'], [])
+        for wait in ('nan', 'inf', '-1'):
+            resp = self.api.get(url, {'wait': wait})
+            self.assertEqual(resp.status_code, 403)
+        self.assertEqual(self.api.delete(url).status_code, 204)
+        self.assertEqual(self.api.get(url).status_code, 404)
+
+    def test_page_and_bulk_update(self):
+        resp = self.api.get('/packets/', {'limit': '2'})
+        self.assertEqual(len(resp.data), 2)
+        resp = self.api.get('/packets/', {'after_id': resp.data[-1]['id']})
+        self.assertEqual(len(resp.data), 1)
+        pk = resp.data[0]['id']
+        rows = [{'id': pk, 'protocol': self.client.encrypt(b'ICMP')}]
+        resp = self.api.post('/packets/bulk/', rows, format='json')
+        self.assertEqual(resp.data, {'updated': 1})
+        resp = self.get('/compute/count/', protocol=b'ICMP')
+        self.assertEqual(resp.data['count'], 1)
+        resp = self.api.post('/packets/bulk/', [{'id': pk, 'bogus': 'x'}],
+                             format='json')
+        self.assertEqual(resp.status_code, 403)
+        ids = list(Packet.objects.order_by('pk').values_list('pk', flat=True))
+        resp = self.api.get('/packets/ids/', {'after_id': ids[0]})
+        self.assertEqual(resp.data, {'ids': ids[1:]})
+
+    def test_snapshot_segments(self):
+        stream = io.BytesIO()
+        write_snapshot(stream, [Packet])
+        stream.seek(0)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(EDB_SEGMENT_DIR=tmpdir):
+                models._segment_stores.clear()
+                restore(stream, flush=True)
+                store = models.segment_store(Packet)
+                self.assertEqual(store.records(), 3)
+                self.assertEqual(self.get('/compute/count/',
+                                          protocol=b'TCP').data['count'], 2)
+        finally:
+            models._segment_stores.clear()
+            shutil.rmtree(tmpdir)
+
+    def test_snapshot(self):
+        Packet.objects.filter(pk=Packet.objects.first().pk).update(
+            captured_at=datetime.datetime(2014, 5, 1, tzinfo=timezone.utc))
+        before = list(Packet.objects.order_by('pk').values())
+        stream = io.BytesIO()
+        write_snapshot(stream, [Packet])
+        stream.seek(0)
+        with self.assertRaises(EDBError):
+            restore(stream)
+        stream.seek(0)
+        restore(stream, flush=True)
+        self.assertEqual(list(Packet.objects.order_by('pk').values()), before)
+        self.assertEqual(self.get('/compute/count/',
+                                  protocol=b'TCP').data['count'], 2)
+        # restored rows are matched against subscriptions
+        resp = self.api.post('/subscriptions/',
+                             self.client.encrypt_query({'protocol': b'UDP'}))
+        stream.seek(0)
+        restore(stream, flush=True)
+        resp = self.api.get('/subscriptions/{}/'.format(resp.data['id']))
+        self.assertEqual(len(resp.data['results']), 1)
+        data = bytearray(stream.getvalue())
+        data[-30] ^= 1
+        with self.assertRaises(EDBError):
+            restore(io.BytesIO(bytes(data)), flush=True)
+
+class SnapshotTestCase(TransactionTestCase):
+
+    def test_export_in_one_transaction(self):
+        client = Client()
+        for protocol in (b'TCP', b'UDP'):
+            Packet.objects.create(**client.encrypt_model(
+                {'source': b'10.0.0.1', 'destination': b'10.0.0.2',
+                 'protocol': protocol, 'length': 60},
+                paillier_fields=['length']))
+        atomic = []
+        stream = mock.Mock()
+        stream.write.side_effect = (
+            lambda data: atomic.append(connection.in_atomic_block))
+        with mock.patch.object(snapshots, 'CHUNK_ROWS', 1):
+            write_snapshot(stream, [Packet, IndexEntry])
+        # magic, the packet table in two chunks, the empty index table and
+        # the end marker
+        self.assertEqual(len(atomic), 8)
+        self.assertTrue(all(atomic))
+        self.assertFalse(connection.in_atomic_block)
+
+class ClientTestCase(TestCase):
+    """Tests of logdb.client.Client against stubbed server responses."""
+
+    def setUp(self):
+        self.client = logdb_client.Client()
+
+    def respond(self, status, body):
+        response = mock.Mock(status_code=status, headers={})
+        response.json.return_value = body
+        return mock.patch.object(self.client.session, 'request',
+                                 return_value=response)
+
+    def test_request_errors(self):
+        with self.respond(400, {'captured_at': ['Datetime has wrong '
+                                                'format.']}):
+            with self.assertRaisesRegex(EDBError, 'captured_at: Datetime'):
+                self.client.create(source=b'10.0.0.1',
+                                   destination=b'10.0.0.2', protocol=b'TCP',
+                                   length=60, captured_at='yesterday')
+        with self.respond(403, {'detail': 'invalid parameters'}):
+            with self.assertRaisesRegex(EDBError, 'invalid parameters'):
+                self.client.count()
+
+    def test_captured_at(self):
+        row = self.client.encrypt_packet({
+            'source': b'10.0.0.1', 'destination': b'10.0.0.2',
+            'protocol': b'TCP', 'length': 60, 'captured_at': '1398945600'})
+        self.assertEqual(row['captured_at'], '2014-05-01T12:00:00+00:00')
+        resp = APIClient().post('/packets/', row)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(Packet.objects.get().captured_at,
+                         datetime.datetime(2014, 5, 1, 12,
+                                           tzinfo=timezone.utc))
+
+    def test_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            keyfile = os.path.join(tmpdir, 'keys.json')
+            crypto.write_keyinfo(crypto.generate_keyinfo(
+                Client.KEY_SCHEMA), keyfile)
+            commands = os.path.join(tmpdir, 'commands')
+            with open(commands, 'w') as wfile:
+                wfile.write('count -p TCP\n# comment\n\ncount -p UDP\n')
+            count = mock.patch.object(logdb_client.Client, 'count',
+                                      autospec=True, return_value=3)
+            stdout = mock.patch('sys.stdout', new_callable=io.StringIO)
+            stderr = mock.patch('sys.stderr', new_callable=io.StringIO)
+            with count as counts, stdout as out, stderr as err:
+                try:
+                    logdb_client.cli.main(
+                        args=['-k', keyfile, 'batch', commands],
+                        prog_name='client', obj={})
+                except SystemExit:
+                    pass
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(out.getvalue(), '3\n3\n')
+        # one client serves every command of the session
+        (first, _), (second, _) = counts.call_args_list
+        self.assertIs(first[0], second[0])
+        self.assertRegex(err.getvalue(),
+                         r'^\[count: \d+\.\d{3}s\]\n\[count: \d+\.\d{3}s\]\n$')
+
+    def test_top_needs_k(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            keyfile = os.path.join(tmpdir, 'keys.json')
+            crypto.write_keyinfo(crypto.generate_keyinfo(
+                Client.KEY_SCHEMA), keyfile)
+            top = mock.patch.object(logdb_client.Client, 'top')
+            stdout = mock.patch('sys.stdout', new_callable=io.StringIO)
+            with top as tops, stdout as out:
+                try:
+                    logdb_client.cli.main(
+                        args=['-k', keyfile, 'top', '-k', '0'],
+                        prog_name='client', obj={})
+                except SystemExit:
+                    pass
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(out.getvalue(), 'Error: --top must be at least 1\n')
+        self.assertFalse(tops.called)
+
+    def test_cache_bounds(self):
+        cache = logdb_client.LRUCache(size=3, max_rows=10)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 4)
+        cache.get('a')
+        cache.put('c', 'C', 4)
+        # over max_rows: the least recently used entry goes
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c'), cache.rows),
+                         ('A', 'C', 8))
+        cache.put('d', 'D', 11)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(len(cache), 2)
+
+class ShardedClientTestCase(TestCase):
+    """Tests of merging the responses of stubbed shards."""
+
+    def setUp(self):
+        self.client = logdb_client.ShardedClient(
+            shards=logdb_client.parse_shards('a:8000,b:8001'))
+
+    def respond(self, *bodies):
+        """Patch each shard to answer with the next body."""
+        stack = contextlib.ExitStack()
+        for shard, body in zip(self.client.shards, bodies):
+            stack.enter_context(mock.patch.object(shard, 'request',
+                                                  return_value=body))
+        return stack
+
+    def encrypt(self, value):
+        return self.client.paillier_encrypt(value)
+
+    def test_parse_shards(self):
+        self.assertEqual(logdb_client.parse_shards('a:8000, :8001'),
+                         [('a', 8000), ('localhost', 8001)])
+        with self.assertRaises(EDBError):
+            logdb_client.parse_shards('a:8000,b')
+
+    def test_count(self):
+        with self.respond({'count': 2}, {'count': 3}):
+            self.assertEqual(self.client.count(protocol=b'TCP'), 5)
+        with self.respond({'count': 20, 'interval': [17, 24]},
+                          {'count': 30, 'interval': [26, 33]}):
+            estimate = self.client.count(approximate=True, rows=1001)
+            # the sample is split between the shards
+            for shard in self.client.shards:
+                params = shard.request.call_args[1]['params']
+                self.assertEqual(params['approx_rows'], '501')
+        # half-widths add in quadrature: 5 below and 5 above
+        self.assertEqual(tuple(estimate), (50, 45, 55))
+
+    def test_correlate(self):
+        with self.respond({'source_count': 3, 'both_count': 1},
+                          {'source_count': 1, 'both_count': 1}):
+            self.assertEqual(self.client.correlate(b'10.0.0.1',
+                                                   b'10.0.0.2'), 0.5)
+
+    def test_average(self):
+        # one shard matched 60 and 40, the other 50
+        with self.respond({'count': self.encrypt(2), 'sum': self.encrypt(100)},
+                          {'count': self.encrypt(1), 'sum': self.encrypt(50)}):
+            self.assertEqual(self.client.average(protocol=b'TCP'), 50)
+
+    def test_group_average(self):
+        groups = [[{'count': self.encrypt(1), 'sum': self.encrypt(60)},
+                   {'count': self.encrypt(0), 'sum': self.encrypt(0)}],
+                  [{'count': self.encrypt(1), 'sum': self.encrypt(40)},
+                   {'count': self.encrypt(2), 'sum': self.encrypt(90)}]]
+        with self.respond({'groups': groups[0]}, {'groups': groups[1]}):
+            averages = self.client.group_average(
+                'source', [b'10.0.0.1', b'10.0.0.2'])
+        self.assertEqual(averages, {b'10.0.0.1': 50, b'10.0.0.2': 45})
+        with self.respond({'groups': groups[0]}, {'groups': groups[1][:1]}):
+            with self.assertRaises(EDBError):
+                self.client.group_average('source', [b'10.0.0.1',
+                                                     b'10.0.0.2'])
+        # more values than the server takes are sent in several requests
+        with self.respond({'groups': groups[0][:1]},
+                          {'groups': groups[1][:1]}):
+            with mock.patch.object(logdb_client, 'GROUP_BATCH', 1):
+                averages = self.client.group_average(
+                    'source', [b'10.0.0.1', b'10.0.0.2'])
+            self.assertEqual(self.client.shards[0].request.call_count, 2)
+        self.assertEqual(averages, {b'10.0.0.1': 50, b'10.0.0.2': 50})
+
+    def test_histogram(self):
+        bounds = (64, 128)
+        def buckets(*lengths):
+            total = 1
+            key = self.client.keys['paillier']
+            for length in lengths:
+                total = total * int(self.encrypt(self.client.bucket_plaintext(
+                    bounds, length))) % (key.modulus * key.modulus)
+            return str(total)
+        with self.respond({'buckets': buckets(60, 100), 'uncounted': 1},
+                          {'buckets': buckets(40, 200), 'uncounted': 2}):
+            counts, uncounted = self.client.histogram(bounds)
+        self.assertEqual(counts, [2, 1, 1])
+        self.assertEqual(uncounted, 3)
@@ -1,14 +1,25 @@
 from django.conf.urls import include, url
 from rest_framework import routers, urls as drf_urls
 
+from edb.server import metrics
 from logdb import views
 
 router = routers.DefaultRouter()
 router.register(r'packets', views.PacketViewSet)
 
 urlpatterns = [
+    # before the router, which would take these for packet ids
+    url(r'^packets/bulk/?$', views.bulk_update, name='packet-bulk'),
+    url(r'^packets/ids/?$', views.packet_ids, name='packet-ids'),
     url(r'^', include(router.urls)),
-    url(r'^compute/average', views.average),
-    url(r'^compute/count', views.count),
-    url(r'^compute/correlate', views.correlate),
+    url(r'^compute/average', views.average, name='average'),
+    url(r'^compute/group_average', views.group_average,
+        name='group-average'),
+    url(r'^compute/histogram', views.histogram, name='histogram'),
+    url(r'^compute/count', views.count, name='count'),
+    url(r'^compute/correlate', views.correlate, name='correlate'),
+    url(r'^subscriptions/?$', views.subscribe, name='subscription-list'),
+    url(r'^subscriptions/(?P<pk>\d+)/?$', views.subscription,
+        name='subscription-detail'),
+    url(r'^metrics/?$', metrics.metrics_view, name='metrics'),
 ]
@@ -1,11 +1,20 @@
+from django.http import Http404
 from rest_framework import viewsets
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
 
 from edb import crypto, paillier
-from edb.server import util
-from edb.server.mixins import EncryptedSearchMixin
+from edb.server import (bulk, deadlines, index, metrics, sampling,
+                        subscriptions, util)
+from edb.server.coalesce import coalesce, mark
+from edb.server.deadlines import mark_partial, pop_deadline
+from edb.server.etags import conditional
+from edb.server.sampling import pop_sample
+from edb.server.mixins import EncryptedSearchMixin, pop_page
+from edb.server.models import Subscription
+from edb.server.stats import ScanStats, annotate, pop_explain
+from edb.server.timerange import pop_time_range
 from logdb.serializers import PacketSerializer
 from logdb.models import Packet
 
@@ -18,51 +27,300 @@ class PubKeyRequired(APIException):
     default_detail = "must provide public key for homomorphic operations"
 
 @api_view(['GET'])
+@conditional(Packet)
 def average(request):
     params = request.QUERY_PARAMS.dict()
+    explain = pop_explain(params)
+    stats = ScanStats()
+    query = dict(params)
+    deadline, partial = pop_deadline(params)
+    fraction, rows = pop_sample(params)
+    filters = pop_time_range(params, Packet)
+    tags = pop_tags(params, fraction, rows)
+    key = pop_public_key(params)
 
-    # get the paillier key
-    modulus = params.pop('modulus', None)
-    generator = params.pop('generator', None)
-    if modulus is None or generator is None:
-        raise PubKeyRequired
-    try:
-        modulus = int(modulus)
-        generator = int(generator)
-    except ValueError:
-        raise PubKeyRequired("invalid public key")
-    key = paillier.PublicKey(modulus, generator)
+    def scan():
+        ids = None
+        if tags is not None:
+            ids = index.lookup(Packet, tags)
+        elif fraction is not None or rows is not None:
+            ids, total = sampling.sample_ids(Packet.objects, fraction, rows,
+                                             filters)
+        packets, scanned = deadlines.scan(Packet.objects, params, stats,
+                                          deadline, partial, ids, filters)
+        try:
+            lengths = [int(packet.length) for packet in packets]
+        except ValueError:
+            raise APIException("invalid database state -- "
+                               "non-int packet lengths")
+        with stats.phase('paillier'):
+            ctxt_sum, ctxt_count = paillier.average(key, lengths)
+        metrics.PAILLIER_OPS.inc(len(lengths), op='multiply')
+        metrics.PAILLIER_OPS.inc(op='encrypt')
+        data = {'sum': ctxt_sum, 'count': ctxt_count}
+        if fraction is not None or rows is not None:
+            sampling.approximate(data, sampling.sampled_rows(ids, scanned),
+                                 total)
+        return data, scanned
 
-    packets = Packet.objects.encrypted_filter(**params)
-    try:
-        lengths = [int(packet.length) for packet in packets]
-    except ValueError:
-        raise APIException("invalid database state -- non-int packet lengths")
+    (data, scanned), stats, shared = coalesce('average', query, scan,
+                                              stats)
+    return respond(data, stats, explain, shared, scanned)
+
+# Most tokens accepted by one group_average query.
+MAX_GROUPS = 1000
 
-    ctxt_sum, ctxt_count = paillier.average(key, lengths)
+@api_view(['GET'])
+@conditional(Packet)
+def group_average(request):
+    """Encrypted sum and count of lengths for each of many tokens.
 
-    return Response({'sum': ctxt_sum, 'count': ctxt_count})
+    `group_by` names a searchable field and `groups` is a comma-separated
+    list of query tokens for it. The table is scanned once, and each row's
+    length ciphertext is multiplied into the sum of every token its field
+    matches. Other params are queries that every counted row must match.
+
+    """
+    params = request.QUERY_PARAMS.dict()
+    explain = pop_explain(params)
+    stats = ScanStats()
+    query = dict(params)
+    deadline, partial = pop_deadline(params)
+    filters = pop_time_range(params, Packet)
+    key = pop_public_key(params)
+    field = params.pop('group_by', None)
+    if field not in Packet.searchable_fields():
+        raise InvalidParams("group_by must name a searchable field")
+    tokens = [token for token in params.pop('groups', '').split(',')
+              if token.strip()]
+    if not tokens or len(tokens) > MAX_GROUPS:
+        raise InvalidParams("groups must hold 1 to {} comma-separated "
+                            "tokens".format(MAX_GROUPS))
+    groups = [util.decode_query(token) for token in tokens]
+    if None in groups:
+        raise InvalidParams("invalid group token")
+
+    def scan():
+        lengths = [[] for _ in groups]
+
+        def match_groups(packets):
+            for packet in packets:
+                ciphertext = util.decode_field(getattr(packet, field))
+                if ciphertext is None:
+                    continue
+                for group, decoded in zip(lengths, groups):
+                    if util.match_ciphertext(ciphertext, *decoded):
+                        group.append(packet.length)
+
+        # matched chunk by chunk, so that the deadline bounds the groups too
+        _, scanned = deadlines.scan(Packet.objects, params, stats, deadline,
+                                    partial, filters=filters,
+                                    visit=match_groups)
+        try:
+            lengths = [[int(length) for length in group]
+                       for group in lengths]
+        except ValueError:
+            raise APIException("invalid database state -- "
+                               "non-int packet lengths")
+        results = []
+        with stats.phase('paillier'):
+            for group in lengths:
+                ctxt_sum, ctxt_count = paillier.average(key, group)
+                results.append({'sum': ctxt_sum, 'count': ctxt_count})
+        metrics.PAILLIER_OPS.inc(sum(map(len, lengths)), op='multiply')
+        metrics.PAILLIER_OPS.inc(len(lengths), op='encrypt')
+        return {'groups': results}, scanned
+
+    (data, scanned), stats, shared = coalesce('group_average', query, scan,
+                                              stats)
+    return respond(data, stats, explain, shared, scanned)
 
 @api_view(['GET'])
+@conditional(Packet)
+def histogram(request):
+    """Encrypted bucket counts of the lengths of matching packets.
+
+    Each packet added with bucket counters holds one Paillier ciphertext of
+    its length's bucket, packed so that multiplying them sums every bucket
+    at once, and the fingerprint of the bucket bounds. `scheme` names the
+    fingerprint to count. The response holds the product of the matching
+    packets' counters of that scheme and the number of matching packets
+    that were added without them, or with other bounds, and so are not
+    counted.
+
+    """
+    params = request.QUERY_PARAMS.dict()
+    explain = pop_explain(params)
+    stats = ScanStats()
+    query = dict(params)
+    deadline, partial = pop_deadline(params)
+    filters = pop_time_range(params, Packet)
+    tags = index.pop_tags(params, Packet)
+    key = pop_public_key(params)
+    scheme = params.pop('scheme', None)
+    if not scheme:
+        raise InvalidParams("scheme must give the bucket scheme to count")
+
+    def scan():
+        ids = None if tags is None else index.lookup(Packet, tags)
+        packets, scanned = deadlines.scan(Packet.objects, params, stats,
+                                          deadline, partial, ids, filters)
+        try:
+            counters = [int(packet.length_buckets) for packet in packets
+                        if packet.length_buckets
+                        and packet.length_bucket_scheme == scheme]
+        except ValueError:
+            raise APIException("invalid database state -- "
+                               "non-int bucket counters")
+        with stats.phase('paillier'):
+            ctxt = paillier.total(key, counters)
+        metrics.PAILLIER_OPS.inc(len(counters), op='multiply')
+        metrics.PAILLIER_OPS.inc(op='encrypt')
+        data = {'buckets': ctxt, 'uncounted': len(packets) - len(counters)}
+        return data, scanned
+
+    (data, scanned), stats, shared = coalesce('histogram', query, scan,
+                                              stats)
+    return respond(data, stats, explain, shared, scanned)
+
+@api_view(['GET'])
+@conditional(Packet)
 def correlate(request):
     params = request.QUERY_PARAMS.dict()
+    explain = pop_explain(params)
+    stats = ScanStats()
+    query = dict(params)
+    deadline, partial = pop_deadline(params)
+    filters = pop_time_range(params, Packet)
     if set(params.keys()) != {'source', 'destination'}:
         raise InvalidParams("requires source and desination params")
     src = params['source']
     dst = params['destination']
-    srccount = len(Packet.objects.encrypted_filter(source=src))
-    if srccount == 0:
-        coef = 0
-    else:
-        bothcount = len(Packet.objects.encrypted_filter(**params))
-        coef = bothcount / srccount
-    return Response({'coefficient': coef})
+
+    def scan():
+        packets, scanned = deadlines.scan(Packet.objects, {'source': src},
+                                          stats, deadline, partial,
+                                          filters=filters)
+        srccount = len(packets)
+        if srccount == 0:
+            bothcount = 0
+            coef = 0
+        else:
+            packets, both_scanned = deadlines.scan(Packet.objects, params,
+                                                   stats, deadline, partial,
+                                                   filters=filters)
+            scanned = scanned or both_scanned
+            bothcount = len(packets)
+            coef = bothcount / srccount
+        # the counts let sharded clients merge results across servers
+        return {'coefficient': coef, 'source_count': srccount,
+                'both_count': bothcount}, scanned
+
+    (data, scanned), stats, shared = coalesce('correlate', query, scan,
+                                              stats)
+    return respond(data, stats, explain, shared, scanned)
 
 @api_view(['GET'])
+@conditional(Packet)
 def count(request):
     params = request.QUERY_PARAMS.dict()
-    packets = Packet.objects.encrypted_filter(**params)
-    return Response({'count': len(packets)})
+    explain = pop_explain(params)
+    stats = ScanStats()
+    query = dict(params)
+    deadline, partial = pop_deadline(params)
+    fraction, rows = pop_sample(params)
+    filters = pop_time_range(params, Packet)
+    tags = pop_tags(params, fraction, rows)
+
+    def scan():
+        if fraction is None and rows is None:
+            ids = None if tags is None else index.lookup(Packet, tags)
+            packets, scanned = deadlines.scan(Packet.objects, params, stats,
+                                              deadline, partial, ids,
+                                              filters)
+            return {'count': len(packets)}, scanned
+        ids, total = sampling.sample_ids(Packet.objects, fraction, rows,
+                                         filters)
+        packets, scanned = deadlines.scan(Packet.objects, params, stats,
+                                          deadline, partial, ids, filters)
+        sampled = sampling.sampled_rows(ids, scanned)
+        estimate, low, high = sampling.estimate_count(len(packets), sampled,
+                                                      total)
+        data = {'count': estimate, 'interval': [low, high]}
+        return sampling.approximate(data, sampled, total), scanned
+
+    (data, scanned), stats, shared = coalesce('count', query, scan,
+                                              stats)
+    return respond(data, stats, explain, shared, scanned)
+
+@api_view(['POST'])
+def bulk_update(request):
+    return Response({'updated': bulk.update_rows(Packet, request.DATA)})
+
+# Most ids returned by one request to packet_ids.
+ID_PAGE = 10000
+
+@api_view(['GET'])
+def packet_ids(request):
+    """List packet ids in order, so that mirrors can find deleted rows."""
+    filters, limit = pop_page(request.QUERY_PARAMS.dict())
+    limit = ID_PAGE if limit is None else min(limit, ID_PAGE)
+    ids = Packet.objects.filter(**filters).order_by('pk')
+    return Response({'ids': list(ids.values_list('pk', flat=True)[:limit])})
+
+@api_view(['POST'])
+def subscribe(request):
+    queries = dict(request.DATA.items())
+    subscription = subscriptions.subscribe(Packet, queries)
+    return Response({'id': subscription.pk}, status=201)
+
+@api_view(['GET', 'DELETE'])
+def subscription(request, pk):
+    try:
+        subscription = Subscription.objects.get(
+            pk=pk, table=Packet._meta.db_table)
+    except Subscription.DoesNotExist:
+        raise Http404
+    if request.method == 'DELETE':
+        subscriptions.unsubscribe(Packet, subscription)
+        return Response(status=204)
+    after, wait = subscriptions.pop_poll(request.QUERY_PARAMS)
+    matches = subscriptions.poll(subscription, after, wait)
+    packets = Packet.objects.in_bulk([match.row for match in matches])
+    # rows deleted since they matched are left out
+    results = [packets[match.row] for match in matches
+               if match.row in packets]
+    return Response({
+        'last': matches[-1].pk if matches else after,
+        'results': PacketSerializer(results, many=True).data,
+    })
+
+def pop_tags(params, fraction, rows):
+    """Return the index tags of a compute query, which cannot be sampled."""
+    tags = index.pop_tags(params, Packet)
+    if tags is not None and (fraction is not None or rows is not None):
+        raise InvalidParams("indexed queries cannot be approximate")
+    return tags
+
+def pop_public_key(params):
+    """Remove the Paillier public key from params and return it."""
+    modulus = params.pop('modulus', None)
+    generator = params.pop('generator', None)
+    if modulus is None or generator is None:
+        raise PubKeyRequired
+    try:
+        modulus = int(modulus)
+        generator = int(generator)
+    except ValueError:
+        raise PubKeyRequired("invalid public key")
+    return paillier.PublicKey(modulus, generator)
+
+def respond(data, stats, explain, shared, scanned):
+    """Return the response for a compute view."""
+    response = Response(dict(data))
+    annotate(response, stats, explain)
+    mark_partial(response, scanned)
+    return mark(response, shared)
 
 
 # CRUD view with encrypted search
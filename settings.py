@@ -42,6 +42,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'edb.server.metrics.MetricsMiddleware',
+    'edb.server.profiling.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -58,13 +60,26 @@ WSGI_APPLICATION = 'edb.server.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 
+# set EDB_DATABASE to run several servers (shards) side by side
+DATABASE_PATH = os.environ.get('EDB_DATABASE',
+                               os.path.join(BASE_DIR, 'db.sqlite3'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'NAME': DATABASE_PATH,
+    },
+    # separate connections for queries, so that ingest does not hold up
+    # scans (see edb.server.routers)
+    'read': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_PATH,
+        'TEST_MIRROR': 'default',
+    },
 }
 
+DATABASE_ROUTERS = ['edb.server.routers.ReadRouter']
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -84,6 +99,47 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# EDB storage
+
+# Directory for the optional fixed-width ciphertext segment stores used to
+# scan encrypted tables. Disabled if None; after enabling, populate it with
+# `manage.py edb_segments rebuild`, and run `manage.py edb_segments compact`
+# periodically (from cron, say) to drop records of updated and deleted rows.
+EDB_SEGMENT_DIR = None
+
+# Report rows scanned and per-phase timings of every encrypted query in
+# response headers. Individual requests can ask with `explain=1`.
+EDB_QUERY_STATS = False
+
+# Default limit on the scan time of an encrypted query, in milliseconds, or
+# None for no limit. Requests can set their own with `timeout_ms`.
+EDB_QUERY_TIMEOUT_MS = None
+
+# Let identical concurrent queries share one scan.
+EDB_COALESCE_QUERIES = True
+
+# Put SQLite databases in write-ahead log mode, so that reads run alongside
+# a write instead of waiting for its lock.
+EDB_SQLITE_WAL = True
+
+# Milliseconds the writer thread waits to group concurrently created rows
+# into one transaction (see edb.server.writer), or None to commit each row
+# in its own request.
+EDB_GROUP_COMMIT_MS = 2
+
+# Shared directory where each server process saves its metrics, so that
+# /metrics reports totals across processes. If None, /metrics only covers
+# the process that serves it.
+EDB_METRICS_DIR = None
+
+# Directory where request profiles are written (see edb.server.profiling),
+# or None to disable profiling. EDB_PROFILE_SAMPLE is the fraction of
+# requests profiled in full; if EDB_PROFILE_THRESHOLD_MS is set, the others
+# are stack-sampled and kept if they take longer.
+EDB_PROFILE_DIR = None
+EDB_PROFILE_SAMPLE = 0
+EDB_PROFILE_THRESHOLD_MS = None
+
 # REST framework
 # http://www.django-rest-framework.org/
 
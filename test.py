@@ -1,12 +1,23 @@
 """Run tests on EDB."""
 
+import json
+import time
 import shutil
+import sqlite3
 import os.path
 import tempfile
+import threading
 
 from unittest import TestCase, main
+from urllib.parse import urlencode
 from edb import crypto, paillier, constants
-from edb.client import Client
+from edb.client import Client, prefix_query
+from edb.errors import EDBError
+from edb import profiling
+from edb.profiling import Profile, StackSampler
+from edb.server import lite
+from edb.sketch import CountMinSketch, TopK
+from logdb.mirror import Mirror
 
 PASSPHRASE = b'hunter2 is not a good password'
 
@@ -20,6 +31,91 @@ class TestClient(TestCase):
         ctxt = self.client.encrypt(ptxt)
         self.assertEqual(ptxt, self.client.decrypt(ctxt))
 
+    def test_wrong_keys(self):
+        other = Client()
+        self.assertNotEqual(self.client.key_id(), other.key_id())
+        ctxts = [self.client.encrypt(str(i).encode()) for i in range(200)]
+        failures = 0
+        for ctxt in ctxts:
+            try:
+                other.decrypt(ctxt)
+            except EDBError:
+                failures += 1
+        # wrong keys give valid padding about once in 255 words
+        self.assertGreater(failures, 190)
+
+    def test_lazy_decrypt_model(self):
+        options = {'exclude_fields': ['id'], 'paillier_fields': ['length']}
+        model = {'id': 7, 'source': b'10.0.0.1', 'length': 57}
+        ctxt = self.client.encrypt_model(model, **options)
+        lazy = self.client.lazy_decrypt_model(ctxt, **options)
+        self.assertEqual(lazy['source'], b'10.0.0.1')
+        self.assertEqual(dict(lazy), model)
+        broken = self.client.lazy_decrypt_model({'source': 'bad'})
+        with self.assertRaises(EDBError):
+            broken['source']
+
+    def test_decrypt_models(self):
+        options = {'exclude_fields': ['id'], 'paillier_fields': ['length']}
+        models = [{'id': i, 'source': b'10.0.0.1', 'length': i}
+                  for i in range(3)]
+        ctxts = [self.client.encrypt_model(model, **options)
+                 for model in models]
+        ctxts.insert(1, {'id': 9, 'source': 'bad', 'length': '1'})
+        # the row that fails to decrypt is dropped
+        self.assertEqual(self.client.decrypt_models(ctxts, processes=1,
+                                                    **options), models)
+
+    def test_prefix_fields(self):
+        model = {'source': b'10.1.2.3', 'protocol': b'TCP'}
+        ctxt = self.client.encrypt_model(model, prefix_fields=['source'])
+        self.assertEqual(self.client.decrypt(ctxt['source_p16']),
+                         b'10.1.0.0/16')
+        self.assertNotIn('protocol_p8', ctxt)
+        self.assertEqual(prefix_query('source', '10.1.2.9/24'),
+                         {'source_p24': b'10.1.2.0/24'})
+        self.assertEqual(prefix_query('source', '10.1.2.9/32'),
+                         {'source': b'10.1.2.9'})
+        with self.assertRaises(EDBError):
+            prefix_query('source', '10.1.2.0/20')
+
+    def test_profile(self):
+        with Profile() as profile:
+            for i in range(200):
+                self.client.encrypt(str(i).encode())
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = profile.write(os.path.join(tmpdir, 'encrypt'))
+            self.assertEqual(len(paths), 3)
+            with open(os.path.join(tmpdir, 'encrypt.txt')) as rfile:
+                self.assertIn('edb/crypto.py', rfile.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_samplers_share_thread(self):
+        def spin(seconds):
+            end = time.time() + seconds
+            while time.time() < end:
+                pass
+        background = threading.Thread(target=spin, args=(0.2,))
+        background.start()
+        first = StackSampler()
+        second = StackSampler(background.ident)
+        first.start()
+        second.start()
+        thread = profiling._sampling.thread
+        spin(0.1)
+        self.assertIs(profiling._sampling.thread, thread)
+        first.stop()
+        second.stop()
+        background.join()
+        self.assertTrue(first.stacks)
+        self.assertTrue(second.stacks)
+        self.assertTrue(all('spin' in stack for stack in second.stacks))
+        count = sum(first.stacks.values())
+        spin(0.05)
+        self.assertEqual(sum(first.stacks.values()), count)
+
     def test_keyfile(self):
         keyinfo = crypto.generate_keyinfo(Client.KEY_SCHEMA)
         tmpdir = tempfile.mkdtemp()
@@ -33,6 +129,133 @@ class TestClient(TestCase):
         finally:
             shutil.rmtree(tmpdir)
 
+class TestLiteApplication(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'db.sqlite3')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE logdb_packet (id integer PRIMARY KEY, '
+                     'source text, destination text, protocol text, '
+                     'length text, captured_at datetime, key_id text)')
+        rows = [(b'10.0.0.1', b'10.0.0.2', b'TCP', 60),
+                (b'10.0.0.1', b'10.0.0.3', b'UDP', 40),
+                (b'10.0.0.2', b'10.0.0.3', b'TCP', 50)]
+        for row in rows:
+            model = dict(zip(lite.SEARCH_FIELDS, row))
+            model = self.client.encrypt_model(model, paillier_fields=['length'])
+            conn.execute('INSERT INTO logdb_packet (source, destination, '
+                         'protocol, length) VALUES (:source, :destination, '
+                         ':protocol, :length)', model)
+        conn.commit()
+        conn.close()
+        self.app = lite.LiteApplication(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get(self, path, extra=None, **query):
+        params = self.client.encrypt_query(query)
+        params.update(extra or {})
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': urlencode(params),
+        }
+        status = []
+        body = self.app(environ, lambda line, headers: status.append(line))
+        return status[0], json.loads(b''.join(body).decode())
+
+    def test_search(self):
+        status, body = self.get('/packets/', source=b'10.0.0.1')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(len(body), 2)
+        self.assertEqual(set(body[0]), set(lite.FIELDS))
+
+    def test_paging(self):
+        _, body = self.get('/packets/', {'after_id': 1, 'limit': 1})
+        self.assertEqual([row['id'] for row in body], [2])
+        _, body = self.get('/packets', {'after_id': 1})
+        self.assertEqual([row['id'] for row in body], [2, 3])
+        status, _ = self.get('/packets/', {'limit': -1})
+        self.assertEqual(status, '403 FORBIDDEN')
+
+    def test_unsupported(self):
+        status, _ = self.get('/packets/1/')
+        self.assertEqual(status, '404 NOT FOUND')
+        status, _ = self.get('/packets/', {'timeout_ms': 100})
+        self.assertEqual(status, '403 FORBIDDEN')
+
+    def test_count(self):
+        status, body = self.get('/compute/count/', protocol=b'TCP')
+        self.assertEqual(body, {'count': 2})
+
+    def test_correlate(self):
+        status, body = self.get('/compute/correlate/',
+                                source=b'10.0.0.1', destination=b'10.0.0.3')
+        self.assertEqual(body['coefficient'], 0.5)
+        self.assertEqual(body['source_count'], 2)
+
+    def test_average_requires_key(self):
+        status, body = self.get('/compute/average/', protocol=b'TCP')
+        self.assertEqual(status, '403 FORBIDDEN')
+
+class TestMirror(TestCase):
+
+    def setUp(self):
+        self.mirror = Mirror(':memory:')
+        self.mirror.append([
+            {'id': 1, 'source': b'10.0.0.1', 'destination': b'10.0.1.2',
+             'protocol': b'TCP', 'length': 60,
+             'captured_at': '2014-05-01T12:00:00Z'},
+            {'id': 3, 'source': b'10.0.1.5', 'destination': b'10.0.0.1',
+             'protocol': b'UDP', 'length': 100, 'captured_at': None},
+        ], 4)
+
+    def test_query(self):
+        self.assertEqual(self.mirror.last_id(), 4)
+        self.assertEqual(self.mirror.count(protocol=b'TCP'), 1)
+        self.assertEqual(self.mirror.count(**prefix_query('source',
+                                                          '10.0.0.0/16')), 2)
+        self.assertEqual(self.mirror.average(source=b'10.0.1.5'), 100)
+        self.assertEqual(self.mirror.count(since='2014-05-01'), 1)
+        self.assertEqual(self.mirror.count(until=1398945600), 0)
+        self.assertEqual(self.mirror.correlate(b'10.0.0.1', b'10.0.1.2'), 1.0)
+        with self.assertRaises(EDBError):
+            self.mirror.count(length=60)
+
+    def test_delete(self):
+        self.assertEqual(self.mirror.ids(after_id=1), [3])
+        self.mirror.delete([3])
+        self.assertEqual([row['id'] for row in self.mirror.search()], [1])
+
+class TestSketch(TestCase):
+
+    def test_count_min(self):
+        sketch = CountMinSketch.from_error(0.01, 0.01)
+        self.assertEqual((sketch.width, sketch.depth), (272, 5))
+        for i in range(1000):
+            sketch.add(str(i % 100).encode())
+        for i in range(100):
+            estimate = sketch.estimate(str(i).encode())
+            self.assertGreaterEqual(estimate, 10)
+            self.assertLessEqual(estimate, 10 + sketch.error())
+
+    def test_top_k(self):
+        heavy = TopK(3, CountMinSketch(width=64, depth=4))
+        stream = [b'a'] * 50 + [b'b'] * 30 + [b'c'] * 20
+        stream += [str(i).encode() for i in range(200)]
+        for i, item in enumerate(stream):
+            heavy.add(stream[(i * 7) % len(stream)])
+        top = heavy.top()
+        self.assertEqual([item for item, _, _ in top], [b'a', b'b', b'c'])
+        for (_, estimate, low), count in zip(top, (50, 30, 20)):
+            self.assertLessEqual(low, count)
+            self.assertGreaterEqual(estimate, count)
+        with self.assertRaises(ValueError):
+            TopK(0)
+
 class TestCrypto(TestCase):
 
     def setUp(self):
@@ -119,6 +342,15 @@ class TestCrypto(TestCase):
         final_ptxt = paillier.decrypt(key, ctxt1 * ctxt2)
         self.assertEqual(final_ptxt, ptxt1 + ptxt2)
 
+    def test_paillier_packing(self):
+        key = paillier.generate_keys(512)
+        self.assertEqual(paillier.slots(key, 32), 15)
+        ctxts = [paillier.encrypt(key, paillier.pack(counters, 32))
+                 for counters in ([1, 0, 0], [0, 0, 1], [0, 0, 1])]
+        total = paillier.decrypt(key, paillier.total(key, ctxts))
+        self.assertEqual(paillier.unpack(total, 3, 32), [1, 0, 2])
+        self.assertEqual(paillier.decrypt(key, paillier.total(key, [])), 0)
+
     def test_paillier_key_generation(self):
         key = paillier.generate_keys(bits = 128)
         public = key.public()